@@ -1,4 +1,6 @@
 import math
+import copy
+from array import array
 
 # This set stores all cards available in a game of dominion as strings
 # The strings should be exact matches of the isotropic names
@@ -28,6 +30,44 @@ potion_cards = set()
 victory_point_symbol = unichr(9660) # u"\u25BC"
 potion_cost_symbol = unichr(9673) # u"\u25C9"
 
+# Card Registry
+# -------------
+# Each card is given a dense integer id (in the order the cards are added) when it is added. Piles of cards are stored as
+# arrays of card counts indexed by these ids, rather than dictionaries keyed by the card names, and the type of each card
+# is stored as bitflags so it can be checked without looking the name up in each of the card type sets.
+# The card names are still used everywhere outside of the piles (the parser, the features, etc.).
+card_names = []
+card_ids = {}
+card_flags = []
+
+action_flag = 1
+victory_flag = 2
+treasure_flag = 4
+curse_flag = 8
+prize_flag = 16
+plus_action_flag = 32
+plus_buy_flag = 64
+drawing_flag = 128
+cursing_flag = 256
+trashing_flag = 512
+attack_flag = 1024
+supply_flag = 2048
+potion_flag = 4096
+deck_points_flag = 8192 # Victory cards whose points depend on the rest of the deck
+
+# The ids of the cards of each type, in id order. These are filled in as the cards are added.
+action_card_ids = []
+victory_card_ids = []
+treasure_card_ids = []
+
+# The victory points each card is worth, for the cards whose points don't depend on the rest of the deck
+card_points = {'Estate': 1, 'Duchy': 3, 'Province': 6, 'Colony': 10, 'Great Hall': 1, 'Harem': 2, 'Nobles': 2, 'Island': 2, 'Farmland': 2}
+# The cards whose points do depend on the rest of the deck (these are scored by DominionPlayer.get_card_points, and get the deck_points_flag)
+deck_dependent_cards = ['Gardens', 'Duke', 'Vineyard', 'Fairgrounds', 'Silk Road']
+
+# Recompute the deck stats from scratch at the start of each turn, and check them against the ones kept as cards are gained and trashed
+validate_deck_stats = False
+
 # This does not check plural cards - the card must be sanitized if its plural
 def is_card(card):
     return card in cards
@@ -44,6 +84,13 @@ def clean_card(card):
     
 def assert_card(card):
     assert is_card(card), "invalid card: {0}".format(card)
+    
+# Returns the id of a card, asserting that it is valid (like assert_card)
+def get_card_id(card):
+    try:
+        return card_ids[card]
+    except KeyError:
+        assert False, "invalid card: {0}".format(card)
         
 # Converts plural cards to singular, and returns None if the card is not valid
 # This should be called by the parser before passing cards in
@@ -73,63 +120,72 @@ def is_treasure(card):
 def is_curse(card):
     return card in curse_cards
 
-def incr_value(map, val):
-    if val in map:
-        map[val] += 1
-    else:
-        map[val] = 1
-        
-def decr_value(map, val):
-    if val in map:
-        map[val] -= 1
-    else:
-        # Should thi assert be ignored? Masquerade can cause unknown things to happen in the state.
-        #assert False, 'Decrementing card pile that doesn\'t exist: {0}'.format(val)
-        pass
+# Returns a new, empty pile with room for every card
+def new_pile():
+    return array('h', [0]) * len(card_names)
     
-def move_card(a, b, card):
-    decr_value(a, card)
-    incr_value(b, card)
+# The cards that have ever been in a pile are kept as a bitmask of their ids (see remove_from_pile)
+def card_mask(card_ids):
+    mask = 0
+    for card_id in card_ids:
+        mask |= 1 << card_id
+    return mask
     
+# Removes a card from a pile, given the cards that have ever been in it (as a card_mask).
+# Masquerade can cause unknown things to happen in the state, so a card that was never in the pile is ignored. A card
+# that was in it is still removed when the pile has run out, so the count goes negative and validation reports it.
+def remove_from_pile(pile, card_id, seen):
+    if seen >> card_id & 1:
+        pile[card_id] -= 1
+        
 # Moves all cards from a to b
 def move_cards(a, b):
-    for key in a.keys():
-        if key in b:
-            b[key] += a[key]
-        else:
-            b[key] = a[key]
-        a[key] = 0
+    for card_id in xrange(len(a)):
+        b[card_id] += a[card_id]
+        a[card_id] = 0
         
+# Converts a pile to a dictionary from the card names to how many of them are in the pile (skipping the cards that aren't in it)
+def pile_to_dict(pile):
+    return dict((card_names[card_id], pile[card_id]) for card_id in xrange(len(pile)) if pile[card_id] != 0)
+    
 def print_deck(deck):
-    for card in deck.keys():
-        print '{1} {0}(s)'.format(card, deck[card])
+    for (card, count) in pile_to_dict(deck).iteritems():
+        print '{1} {0}(s)'.format(card, count)
         
 def compare_decks(expected, actual):
     ret = []
-    # Make sure everything that was expected is there
-    for (card, count) in expected.iteritems():
-        if card not in actual:
-            ret.append('{0}: Expected {1} Found None'.format(card, count))
-        else:
-            # The expected card was found in the actual deck, check counts
-            if count != actual[card]:
-                ret.append('{0}: Expected {1} Found {2}'.format(card, count, actual[card]))
-    # Look for cards that are there that shouldn't be
-    for (card, count) in actual.iteritems():
-        if card not in expected and count != 0:
-            ret.append('{0}: Unexpected {1}'.format(card, count))
+    if expected == actual:
+        return ret
+    for card_id in xrange(len(expected)):
+        if expected[card_id] != actual[card_id]:
+            if expected[card_id] == 0:
+                # Look for cards that are there that shouldn't be
+                ret.append('{0}: Unexpected {1}'.format(card_names[card_id], actual[card_id]))
+            elif actual[card_id] == 0:
+                ret.append('{0}: Expected {1} Found None'.format(card_names[card_id], expected[card_id]))
+            else:
+                ret.append('{0}: Expected {1} Found {2}'.format(card_names[card_id], expected[card_id], actual[card_id]))
     return ret
     
-class DominionPlayer:
+class DominionPlayer(object):
+    # The attributes are declared as slots, as there is a player object for every player in every game parsed
+    __slots__ = ['game', 'name', 'final_score', 'final_deck', 'deck', 'deck_seen', 'deck_backup', 'deck_shared', 'vp', 'pirate_ship_tokens',
+                 'deck_cards', 'deck_action_cards', 'deck_victory_cards', 'deck_treasure_cards', 'deck_different_cards', 'deck_points',
+                 'output_weight', 'action_card_count', 'victory_card_count', 'treasure_card_count', 'deck_size', 'different_cards',
+                 'current_score', 'gained_victory', 'gained_core_victory']
     
     def __init__(self, game, name):
         self.game = game
         self.name = name
-        self.final_deck = {}
-        # Piles are implemented as a dictionary from card names to how many of them are in the pile
+        self.final_deck = new_pile()
+        # Piles are implemented as an array of how many of each card (by id) are in the pile
         # Because drawing doesn't tell us exactly what they drew, this will now just hold the deck.
-        self.deck = {}
-        self.deck_backup = {}
+        self.deck = new_pile()
+        # The cards that have ever been in the deck (see remove_from_pile)
+        self.deck_seen = 0
+        self.deck_backup = new_pile()
+        # Set when the deck is shared with a snapshot, so it is copied before it is changed
+        self.deck_shared = False
         #self.discard_pile = {}
         #self.hand = {}
         # Duration cards, actions/money during turn, etc.
@@ -140,11 +196,21 @@ class DominionPlayer:
         self.vp = 0
         self.pirate_ship_tokens = 0
         
+        # These are kept up to date as cards are gained and trashed
+        self.deck_cards = 0
+        self.deck_action_cards = 0
+        self.deck_victory_cards = 0
+        self.deck_treasure_cards = 0
+        self.deck_different_cards = 0
+        self.deck_points = 0 # Points from the cards that don't depend on the rest of the deck
+        
+        # These are a snapshot of the stats above, taken at the start of each of the player's turns
         self.output_weight = None
         self.action_card_count = 0
         self.victory_card_count = 0
         self.treasure_card_count = 0
         self.deck_size = 0
+        self.different_cards = 0
         self.current_score = 0
         self.gained_victory = False
         self.gained_core_victory = False
@@ -156,7 +222,7 @@ class DominionPlayer:
         return self.final_score
         
     def add_final_deck(self, card):
-        incr_value(self.final_deck, card)
+        self.final_deck[card_ids[card]] += 1
         
     def check_deck(self):
         ret = []
@@ -189,70 +255,74 @@ class DominionPlayer:
         return self.current_score
         
     def update_properties(self):
-        self.action_card_count = 0.0
-        self.victory_card_count = 0.0
-        self.treasure_card_count = 0.0
-        self.deck_size = 0.0
-        self.deck_backup.clear()
-        for card in self.deck.keys():
-            if self.deck[card] > 0:
-                self.deck_backup[card] = self.deck[card]
-            cards = self.deck[card]
-            if is_action(card):
-                self.action_card_count += cards
-            if is_victory(card):
-                self.victory_card_count += cards
-            if is_treasure(card):
-                self.treasure_card_count += cards
-            self.deck_size += cards
+        deck = self.deck
+        self.deck_backup = deck[:]
+        self.action_card_count = float(self.deck_action_cards)
+        self.victory_card_count = float(self.deck_victory_cards)
+        self.treasure_card_count = float(self.deck_treasure_cards)
+        self.deck_size = float(self.deck_cards)
+        self.different_cards = self.deck_different_cards
         # Get the number of points in the deck
-        self.current_score = self.vp
-        for victory_card in victory_cards:
-            if victory_card in self.deck_backup:
-                self.current_score += self.deck[victory_card] * self.get_card_points(victory_card)
+        self.current_score = self.vp + self.deck_points
+        for card_id in deck_dependent_card_ids:
+            if deck[card_id] > 0:
+                self.current_score += deck[card_id] * self.get_card_points(card_names[card_id])
+        if validate_deck_stats:
+            self.validate_properties()
+            
+    # Recomputes the stats from update_properties from the whole deck, and asserts that they match
+    def validate_properties(self):
+        deck = self.deck
+        assert self.action_card_count == sum([deck[card_id] for card_id in action_card_ids]), "Action card count mismatch for {0}".format(self.name.encode('utf-8'))
+        assert self.victory_card_count == sum([deck[card_id] for card_id in victory_card_ids]), "Victory card count mismatch for {0}".format(self.name.encode('utf-8'))
+        assert self.treasure_card_count == sum([deck[card_id] for card_id in treasure_card_ids]), "Treasure card count mismatch for {0}".format(self.name.encode('utf-8'))
+        assert self.deck_size == sum(deck), "Deck size mismatch for {0}".format(self.name.encode('utf-8'))
+        assert self.different_cards == len(deck) - deck.count(0), "Different card count mismatch for {0}".format(self.name.encode('utf-8'))
+        score = self.vp
+        for card_id in victory_card_ids:
+            if deck[card_id] > 0:
+                score += deck[card_id] * self.get_card_points(card_names[card_id])
+        assert self.current_score == score, "Score mismatch for {0}: {1} != {2}".format(self.name.encode('utf-8'), self.current_score, score)
                 
     # Assumes the current action, treasure, victory, etc. card counts cached are correct
     # Uses the deck backup to count specific cards.
     def get_card_points(self, card):
-        if card == 'Estate':
-            return 1
-        elif card == 'Duchy':
-            return 3
-        elif card == 'Province':
-            return 6
-        elif card == 'Colony':
-            return 10
+        card_id = card_ids.get(card)
+        if card_id is None:
+            return 0
+        elif not card_flags[card_id] & deck_points_flag:
+            return card_point_values[card_id]
         elif card == 'Gardens':
             return math.floor(self.deck_size / 10.0)
-        elif card == 'Great Hall':
-            return 1
         elif card == 'Duke':
-            if 'Duchy' in self.deck_backup:
-                return self.deck_backup['Duchy']
-            else:
-                return 0
-        elif card == 'Harem':
-            return 2
-        elif card == 'Nobles':
-            return 2
-        elif card == 'Island':
-            return 2
+            return self.deck_backup[duchy_id]
         elif card == 'Vineyard':
             return math.floor(self.action_card_count / 3.0)
         elif card == 'Fairgrounds':
-            return math.floor(len(self.deck_backup.keys()) / 5.0)
+            return math.floor(self.different_cards / 5.0)
         elif card == 'Silk Road':
             return math.floor(self.victory_card_count / 4.0)
-        elif card == 'Farmland':
-            return 2
         else:
             return 0
         
     def get_card_count(self, card):
-        if card in self.deck_backup:
-            return self.deck_backup[card]
+        if card in card_ids:
+            return self.deck_backup[card_ids[card]]
         else:
             return 0
+            
+    # Returns a copy of the player for a snapshot of the game. The deck is shared until either of them changes it.
+    # The deck backup and final deck aren't changed in place once the game has started, so they are always shared.
+    def snapshot(self, game):
+        snapshot = copy.copy(self)
+        snapshot.game = game
+        self.deck_shared = True
+        snapshot.deck_shared = True
+        return snapshot
+        
+    def unshare_deck(self):
+        self.deck = self.deck[:]
+        self.deck_shared = False
         
     # Game State Modifiers
     
@@ -295,16 +365,46 @@ class DominionPlayer:
         ##self.cards_in_hand -= 1
         pass
         
-    def gain(self, card):
-        #incr_value(self.discard_pile, card)
-        incr_value(self.deck, card)
-        if is_victory(card):
+    # Adds (count = 1) or removes (count = -1) a card from the deck stats
+    def count_card(self, card_id, count):
+        flags = card_flags[card_id]
+        self.deck_cards += count
+        if flags & action_flag:
+            self.deck_action_cards += count
+        if flags & victory_flag:
+            self.deck_victory_cards += count
+            self.deck_points += card_point_values[card_id] * count
+        if flags & treasure_flag:
+            self.deck_treasure_cards += count
+        
+    def gain(self, card_id):
+        #self.discard_pile[card_id] += 1
+        if self.deck_shared:
+            self.unshare_deck()
+        if self.deck[card_id] == 0:
+            self.deck_different_cards += 1
+        self.deck[card_id] += 1
+        if self.deck[card_id] == 0:
+            # Back up from an overdrawn count
+            self.deck_different_cards -= 1
+        self.deck_seen |= 1 << card_id
+        self.count_card(card_id, 1)
+        if card_flags[card_id] & victory_flag:
             self.gained_victory = True
-            if card == 'Estate' or card == 'Duchy' or card == 'Province' or card == 'Colony':
+            if card_id in core_victory_ids:
                 self.gained_core_victory = True
         
-    def trash(self, card):
-        decr_value(self.deck, card)
+    def trash(self, card_id):
+        # Masquerade can cause unknown things to happen in the state, so the card may never have been in the deck (see remove_from_pile)
+        if self.deck_seen >> card_id & 1:
+            if self.deck_shared:
+                self.unshare_deck()
+            if self.deck[card_id] == 0:
+                self.deck_different_cards += 1
+            self.deck[card_id] -= 1
+            if self.deck[card_id] == 0:
+                self.deck_different_cards -= 1
+            self.count_card(card_id, -1)
         
     def add_vp(self, vp):
         self.vp += vp
@@ -312,18 +412,44 @@ class DominionPlayer:
     def add_pirate_ship_token(self, tokens):
         self.pirate_ship_tokens += tokens
     
+# The turn context of a DominionGame. These are reset in place by start_new_turn (the lists are cleared rather than replaced).
+turn_context_slots = ['current_player', 'possessor', 'turn_number', 'money', 'actions', 'buys', 'cards_gained', 'cards_bought',
+                      'last_player_to_gain', 'last_card_gained', 'copper_value', 'noble_brigand_thief_gain_pending', 'prohibited',
+                      'cost_reduction', 'revealed', 'last_reveal_player']
+
 # This class stores information about the state of a game of dominion
-class DominionGame:
+class DominionGame(object):
+    # The attributes are declared as slots, as there is a game object for every log parsed
+    __slots__ = ['supply', 'supply_ids', 'in_supply', 'supply_flags', 'initial_supply', 'empty_pile_count', 'players', 'num_players',
+                 'initial_supply_table', 'trash_pile', 'trash_seen', 'prizes', 'embargoes', 'shared_piles', 'final_trash', 'turn_snapshots',
+                 # Game meta-data
+                 'empty_piles', 'winner', 'game_id', 'year', 'month', 'day', 'hour', 'minute', 'second', 'masquerade_used'] + turn_context_slots
     
     def __init__(self):
-        self.supply = {}
+        # The supply pile for cards not in the supply is always empty. The ids of the cards in the supply are kept separately.
+        self.supply = new_pile()
+        self.supply_ids = []
+        # Supply index: which cards are in the supply (1 or 0 by id), the card flags of all of the cards in it together,
+        # the starting size of each pile and how many piles are empty. The last three are filled in by init_game.
+        self.in_supply = bytearray(len(card_names))
+        self.supply_flags = 0
+        self.initial_supply = new_pile()
+        self.empty_pile_count = 0
         self.players = {}
         self.num_players = 0
-        self.trash_pile = {}
-        self.prizes = {}
-        self.embargoes = {}
+        self.initial_supply_table = get_initial_supply_table(self.num_players)
+        self.trash_pile = new_pile()
+        # The cards that have ever been trashed (see remove_from_pile)
+        self.trash_seen = 0
+        self.prizes = new_pile()
+        self.embargoes = new_pile()
+        # The names of the piles above that are shared with a snapshot, so they are copied before they are changed
+        self.shared_piles = set()
+        
+        self.final_trash = new_pile()
         
-        self.final_trash = {}
+        # Keeps a snapshot of the game at the start of each turn, when set to a TurnSnapshots (see enable_turn_snapshots)
+        self.turn_snapshots = None
         
         # Game meta-data
         self.empty_piles = []
@@ -370,6 +496,7 @@ class DominionGame:
     def add_player(self, player):
         self.players[player] = DominionPlayer(self, player)
         self.num_players = len(self.players)
+        self.initial_supply_table = get_initial_supply_table(self.num_players)
         
     def set_final_score(self, player, score):
         player = self.get_player(player)
@@ -383,8 +510,7 @@ class DominionGame:
             player.add_final_deck(card)
         
     def add_final_trash(self, card):
-        assert_card(card)
-        incr_value(self.final_trash, card)
+        self.final_trash[get_card_id(card)] += 1
         
     def get_average_final_score(self):
         total = 0.0
@@ -421,8 +547,11 @@ class DominionGame:
         self.game_id = game_id
         
     def add_card_to_supply(self, card):
-        assert_card(card)
-        self.supply[card] = 0
+        card_id = get_card_id(card)
+        if not self.in_supply[card_id]:
+            self.supply_ids.append(card_id)
+            self.in_supply[card_id] = 1
+        self.supply[card_id] = 0
         
     # This sets up the initial card counts for each of the cards in the supply, and players decks and such
     def init_game(self):
@@ -435,8 +564,13 @@ class DominionGame:
         self.add_card_to_supply('Province')
         self.add_card_to_supply('Curse')
         # Setup initial supply counts for each card in the supply
-        for card in self.supply.keys():
-            self.supply[card] = self.card_initial_supply(card)
+        for card_id in self.supply_ids:
+            self.supply[card_id] = self.initial_supply_table[card_id]
+        self.initial_supply = self.supply[:]
+        self.supply_flags = 0
+        for card_id in self.supply_ids:
+            self.supply_flags |= card_flags[card_id]
+        self.empty_pile_count = len([card_id for card_id in self.supply_ids if self.supply[card_id] == 0])
         # Initialize the players starting decks
         for player in self.players.values():
             for i in range(7):
@@ -449,9 +583,9 @@ class DominionGame:
             player.gained_core_victory = False
         # Initialize the prizes (even if Tournament isn't in play. It might be in the Black Market deck or something. No harm in setting it up.)
         for card in prize_cards:
-            self.prizes[card] = 1
+            self.prizes[card_ids[card]] = 1
         # Reset the embargoes
-        self.embargoes = {}
+        self.embargoes = new_pile()
         
     def validate_final_state(self):
         # Masquerade does strange, unknowable things to the game's state. Just assume that 
@@ -460,8 +594,8 @@ class DominionGame:
             # Validate that the empty piles are empty
             # Note that this can't check the non-empty piles.
             for card in self.empty_piles:
-                if self.supply[card] != 0:
-                    ret.append('Mismatch: {0} supply pile should be empty - has {1} left'.format(card, self.supply[card]))
+                if self.supply[card_ids[card]] != 0:
+                    ret.append('Mismatch: {0} supply pile should be empty - has {1} left'.format(card, self.supply[card_ids[card]]))
             # Validate the trash
             errors = compare_decks(self.final_trash, self.trash_pile)
             if errors:
@@ -513,6 +647,9 @@ class DominionGame:
         del self.prohibited[:]
         
         self.reset_revealed()
+        
+        if self.turn_snapshots is not None:
+            self.turn_snapshots.add(self.snapshot())
     
     # This should not be used for treasure cards with non-variable values (e.g., Copper, Quarry, etc.)
     # Treasure cards with variable costs should use this (e.g., Bank, Philosopher's Stone)
@@ -560,7 +697,7 @@ class DominionGame:
         self.get_player().cleanup()
         
     def play(self, card):
-        assert_card(card)
+        get_card_id(card)
         self.get_player().play(card)
         # If the card isn't a treasure, this will return 0, so this is safe for any card played.
         # At some point, some things might need to be processed here, but I don't know for sure now.
@@ -583,7 +720,7 @@ class DominionGame:
     
     # Gives a card from the supply to a player
     def gain(self, card, player = None, source = 'supply', end_of_possession = False):
-        assert_card(card)
+        card_id = get_card_id(card)
         # If someone gets a Masquerade, then remember it, as it means we can't validate the final game state.
         if card == 'Masquerade':
             self.masquerade_used = True
@@ -611,26 +748,42 @@ class DominionGame:
             # However, Possession causes this to be called too (they are seemingly indistinguishable except by looking at the state)
             # So, when there is a possessing player, any gains will be automatically redirected.
             if self.noble_brigand_thief_gain_pending:
-                decr_value(self.trash_pile, card)
+                if self.shared_piles:
+                    self.unshare_pile('trash_pile')
+                remove_from_pile(self.trash_pile, card_id, self.trash_seen)
             else:
                 if not end_of_possession:
                     # This is the possession case.
-                    decr_value(self.supply, card)
+                    self.take_from_supply(card_id)
                 else:
                     # This is a card being discarded at the end of a possession turn, so it was already trashed, and should now be moved back to the players deck who lost it.
-                    decr_value(self.trash_pile, card)
+                    if self.shared_piles:
+                        self.unshare_pile('trash_pile')
+                    remove_from_pile(self.trash_pile, card_id, self.trash_seen)
         elif source == 'prizes':
-            decr_value(self.prizes, card)
+            if self.shared_piles:
+                self.unshare_pile('prizes')
+            remove_from_pile(self.prizes, card_id, prize_card_mask)
         else:
             # If this card is not in the supply it must be from the black market deck
-            if card in self.supply.keys():
-                decr_value(self.supply, card)
+            if self.in_supply[card_id]:
+                self.take_from_supply(card_id)
             else:
-                assert 'Black Market' in self.supply.keys(), "Gaining card from 'supply' which is not in the supply, and Black Market is not in the supply."
-        self.get_player(player).gain(card)
+                assert self.in_supply[black_market_id], "Gaining card from 'supply' which is not in the supply, and Black Market is not in the supply."
+        self.get_player(player).gain(card_id)
+        
+    # Removes a card from its supply pile, keeping track of the piles that have run out.
+    # Cards that aren't in the supply are ignored (see remove_from_pile), but a pile that has run out goes negative.
+    def take_from_supply(self, card_id):
+        if self.in_supply[card_id]:
+            if self.shared_piles:
+                self.unshare_pile('supply')
+            self.supply[card_id] -= 1
+            if self.supply[card_id] == 0:
+                self.empty_pile_count += 1
         
     def trash(self, card, player = None):
-        assert_card(card)
+        card_id = get_card_id(card)
         # If a watchtower was revealed just before this,
         if player is None and len(self.revealed) == 1 and self.revealed[0] == 'Watchtower':
             # The card being trashed should match the card that was being gained before
@@ -638,9 +791,12 @@ class DominionGame:
             #assert self.last_card_gained == card, "Redirecting trashing a {0} to player '{1}' after Watchtower: Expected {2}".format(card, self.get_player(self.last_player_to_gain).name, self.last_card_gained)
             # Then this card should be trashed by another player
             player = self.last_player_to_gain
-        incr_value(self.trash_pile, card)
+        if self.shared_piles:
+            self.unshare_pile('trash_pile')
+        self.trash_pile[card_id] += 1
+        self.trash_seen |= 1 << card_id
         # Cards trashed by possession are returned to the players deck at the end of their turn
-        self.get_player(player).trash(card)
+        self.get_player(player).trash(card_id)
         
     def add_vp(self, vp = 1, player = None):
         self.get_player(player).add_vp(vp)
@@ -649,28 +805,68 @@ class DominionGame:
         self.get_player(player).add_pirate_ship_token(tokens)
         
     def embargo(self, card):
-        incr_value(self.embargoes, card)
+        if self.shared_piles:
+            self.unshare_pile('embargoes')
+        self.embargoes[get_card_id(card)] += 1
         
     def reset_revealed(self):
-        self.revealed = []
+        del self.revealed[:]
         self.last_reveal_player = None
         
     # Used by Ambassador to return a card from a player's deck to the supply
     def return_to_supply(self, card, player = None, trader = False):
-        assert_card(card)
+        card_id = get_card_id(card)
         # If this is a trader, and there was no line showing that the card being returned was actually gained just before this, then don't return it.
         # Trader has this problem when combined with Ill-Gotten Gains' free Copper.
         # But, to prevent the case of Mountebank's two consequtive gains, additionally check to see if the player returning a card isn't the same as the current player
         if self.last_card_gained != card and self.get_player() is self.get_player(player) and trader:
             return
-        self.get_player(player).trash(card)
-        incr_value(self.supply, card)
+        self.get_player(player).trash(card_id)
+        if self.shared_piles:
+            self.unshare_pile('supply')
+        if self.supply[card_id] == 0 and self.in_supply[card_id]:
+            self.empty_pile_count -= 1
+        self.supply[card_id] += 1
         
     def reveal(self, card, player):
         assert_card(card)
         self.revealed.append(card)
         self.last_reveal_player = player
                 
+    # Snapshots
+    # ---------
+    # A snapshot is a copy of the game (and its players) that shares its piles with the game until one of them changes them.
+    # The lists in the turn context are small, so they are just copied.
+    # The supply index and the final decks and trash are only changed before the game starts, so they are always shared.
+    
+    def snapshot(self):
+        snapshot = copy.copy(self)
+        snapshot.turn_snapshots = None
+        snapshot.players = dict((name, player.snapshot(snapshot)) for (name, player) in self.players.iteritems())
+        snapshot.supply_ids = self.supply_ids[:]
+        snapshot.empty_piles = self.empty_piles[:]
+        snapshot.cards_gained = self.cards_gained[:]
+        snapshot.cards_bought = self.cards_bought[:]
+        snapshot.prohibited = self.prohibited[:]
+        snapshot.revealed = self.revealed[:]
+        # Some of the turn context refers to the players themselves, rather than by name
+        if isinstance(self.last_player_to_gain, DominionPlayer):
+            snapshot.last_player_to_gain = snapshot.players[self.last_player_to_gain.name]
+        if isinstance(self.last_reveal_player, DominionPlayer):
+            snapshot.last_reveal_player = snapshot.players[self.last_reveal_player.name]
+        self.shared_piles = set(shared_game_piles)
+        snapshot.shared_piles = set(shared_game_piles)
+        return snapshot
+        
+    def unshare_pile(self, name):
+        if name in self.shared_piles:
+            setattr(self, name, getattr(self, name)[:])
+            self.shared_piles.remove(name)
+            
+    # Keeps a snapshot of the game at the start of every turn from now on
+    def enable_turn_snapshots(self):
+        self.turn_snapshots = TurnSnapshots()
+        
     # Utility methods
     # ---------------
     
@@ -696,14 +892,15 @@ class DominionGame:
         return self.cards_bought
         
     def get_cards_in_supply(self):
-        return self.supply.keys()
+        return [card_names[card_id] for card_id in self.supply_ids]
             
     def is_card_in_supply(self, card):
-        return card in self.supply.keys()
+        card_id = card_ids.get(card)
+        return card_id is not None and self.in_supply[card_id] == 1
         
     def get_supply_count(self, card, use_initial_value = False):
-        if card in self.supply.keys():
-            return self.supply[card]
+        if self.is_card_in_supply(card):
+            return self.supply[card_ids[card]]
         else:
             if use_initial_value:
                 return self.victory_card_initial_supply(card)
@@ -711,144 +908,206 @@ class DominionGame:
                 return None
                 
     def get_card_acquired_count(self, card):
-        if card in self.supply.keys():
-            initial_supply = self.card_initial_supply(card)
+        if self.is_card_in_supply(card):
+            initial_supply = self.initial_supply[card_ids[card]]
             # Estates and Copper start lower, so factor that in
             if card == 'Estate':
                 initial_supply -= 3 * self.num_players
             elif card == 'Copper':
                 initial_supply -= 7 * self.num_players
-            return initial_supply - self.supply[card]
+            return initial_supply - self.supply[card_ids[card]]
         else:
             # If the card isn't in the supply, then don't count it as being acquired
             # (This doesn't deal super well with Black Market, but that should be fine)
             return 0
                 
     def supply_contains_any(self, cards):
-        for card in self.supply.keys():
-            if card in cards:
+        for card_id in self.supply_ids:
+            if card_names[card_id] in cards:
                 return True
         return False
         
+    # Checks whether any card in the supply has the given card flag (e.g. attack_flag for attack cards)
+    def supply_contains_type(self, flag):
+        return self.supply_flags & flag != 0
+        
     def get_num_empty_piles(self):
-        total = 0
-        for count in self.supply.values():
-            if count == 0:
-                total += 1
-        return total
+        return self.empty_pile_count
         
     def get_revealed(self):
         return self.revealed
     
+    # The card metadata for the number of players in the game is looked up in the tables built from the calc_* functions below
     def card_initial_supply(self, card):
-        if is_victory(card):
-            return self.victory_card_initial_supply(card)
-        elif is_curse(card):
-            return self.curse_card_initial_supply()
-        elif is_treasure(card):
-            return self.treasure_card_initial_supply(card)
-        else:
-            # All other cards start with 10 in the supply (except some from Dark Ages, but those aren't supported)
-            return 10
+        return self.initial_supply_table[card_ids[card]]
     
-    # Depending on the number of players, the victory card piles start with different sizes
     def victory_card_initial_supply(self, card):
-        if card == 'Province':
-            if self.num_players == 2:
-                return 8
-            elif self.num_players == 3 or self.num_players == 4:
-                return 12
-            # As per Intrigue's instructions, there are more Provinces in 5 and 6 player games.
-            # Other victory cards are unaffected.
-            elif self.num_players == 5:
-                return 15
-            elif self.num_players == 6:
-                return 18
-            # It appears isotropic supports up to 8 players, and it just uses 21 provinces
-            else:
-                return 21
-        
-        # Estates need to have enough cards to give each player 3, and still have 8 or 12 left
-        if card == 'Estate':
-            if self.num_players == 2:
-                return 8 + 6
-            else:
-                return 12 + self.num_players * 3
-        
-        if self.num_players == 2:
-            return 8
-        else:
-            return 12
+        return calc_victory_card_initial_supply(card, self.num_players)
         
     def curse_card_initial_supply(self):
-        return (self.num_players - 1) * 10
+        return calc_curse_card_initial_supply(self.num_players)
         
     def treasure_card_initial_supply(self, card):
-        if card == 'Potion':
-            return 16
-        if card == 'Platinum':
+        return calc_treasure_card_initial_supply(card, self.num_players)
+        
+    def treasure_card_value(self, card):
+        card_id = card_ids[card]
+        if card_id == copper_id:
+            return self.copper_value
+        return card_treasure_values[card_id]
+            
+# The piles of the game that are shared with its snapshots
+shared_game_piles = ['supply', 'trash_pile', 'prizes', 'embargoes']
+
+# Stores the snapshots taken at the start of each turn of a game, so any turn can be looked up directly.
+# Turns are numbered from 0 in the order they were played (possession and extra turns each count as a turn).
+# The snapshots themselves shouldn't be changed. get_game returns a copy that can be played on from that turn.
+class TurnSnapshots(object):
+    __slots__ = ['snapshots', 'turn_indexes']
+    
+    def __init__(self):
+        self.snapshots = []
+        # Maps (turn number, player name) to the index of the first snapshot for that player's turn
+        self.turn_indexes = {}
+        
+    def add(self, snapshot):
+        key = (snapshot.turn_number, snapshot.current_player)
+        if key not in self.turn_indexes:
+            self.turn_indexes[key] = len(self.snapshots)
+        self.snapshots.append(snapshot)
+        
+    def __len__(self):
+        return len(self.snapshots)
+        
+    def get(self, index):
+        return self.snapshots[index]
+        
+    # Returns the snapshot for the start of a player's turn (by the game's turn numbers), or None if there wasn't one
+    def get_turn(self, turn_number, player):
+        index = self.turn_indexes.get((turn_number, player))
+        if index is None:
+            return None
+        return self.snapshots[index]
+        
+    def get_game(self, index):
+        return self.snapshots[index].snapshot()
+        
+# Card Metadata
+# -------------
+# These compute the metadata for each card. The tables at the bottom of the file are built from them, holding the values
+# for each card (by id), so the game can look them up instead of going through these branches.
+
+def calc_card_initial_supply(card, num_players):
+    if is_victory(card):
+        return calc_victory_card_initial_supply(card, num_players)
+    elif is_curse(card):
+        return calc_curse_card_initial_supply(num_players)
+    elif is_treasure(card):
+        return calc_treasure_card_initial_supply(card, num_players)
+    else:
+        # All other cards start with 10 in the supply (except some from Dark Ages, but those aren't supported)
+        return 10
+
+# Depending on the number of players, the victory card piles start with different sizes
+def calc_victory_card_initial_supply(card, num_players):
+    if card == 'Province':
+        if num_players == 2:
+            return 8
+        elif num_players == 3 or num_players == 4:
             return 12
-        if card == 'Harem':
-            return self.victory_card_initial_supply(card)
-        if self.num_players <= 4:
-            if card == 'Copper':
-                return 60
-            elif card == 'Silver':
-                return 40
-            elif card == 'Gold':
-                return 30
-            else:
-                # Other treasures must be kingdom cards
-                return 10
+        # As per Intrigue's instructions, there are more Provinces in 5 and 6 player games.
+        # Other victory cards are unaffected.
+        elif num_players == 5:
+            return 15
+        elif num_players == 6:
+            return 18
+        # It appears isotropic supports up to 8 players, and it just uses 21 provinces
         else:
-            if card == 'Copper':
-                return 120
-            elif card == 'Silver':
-                return 80
-            elif card == 'Gold':
-                return 60
-            else:
-                return 10
-                
-    def treasure_card_value(self, card):
+            return 21
+    
+    # Estates need to have enough cards to give each player 3, and still have 8 or 12 left
+    if card == 'Estate':
+        if num_players == 2:
+            return 8 + 6
+        else:
+            return 12 + num_players * 3
+    
+    if num_players == 2:
+        return 8
+    else:
+        return 12
+    
+def calc_curse_card_initial_supply(num_players):
+    return (num_players - 1) * 10
+    
+def calc_treasure_card_initial_supply(card, num_players):
+    if card == 'Potion':
+        return 16
+    if card == 'Platinum':
+        return 12
+    if card == 'Harem':
+        return calc_victory_card_initial_supply(card, num_players)
+    if num_players <= 4:
         if card == 'Copper':
-            return self.copper_value
+            return 60
         elif card == 'Silver':
-            return 2
+            return 40
         elif card == 'Gold':
-            return 3
-        elif card == 'Platinum':
-            return 5
-        elif card == 'Harem':
-            return 2
-        elif card == 'Contraband':
-            return 3
-        elif card == 'Hoard':
-            return 2
-        elif card == 'Loan':
-            return 1
-        elif card == 'Quarry':
-            return 1
-        elif card == 'Royal Seal':
-            return 2
-        elif card == 'Talisman':
-            return 1
-        elif card == 'Cache':
-            return 3
-        # Fool's Gold has a +$n line following it.
-        #elif card == 'Fool\'s Gold':
-        #    return self.fools_gold_value
-        elif card == 'Ill-Gotten Gains':
-            return 1
-        elif card == 'Diadem':
-            return 2
-        elif card == 'Stash':
-            return 2
-        # There are other treasure cards, but they have variable values, so there should be a +$x line following them
+            return 30
         else:
-            return 0
+            # Other treasures must be kingdom cards
+            return 10
+    else:
+        if card == 'Copper':
+            return 120
+        elif card == 'Silver':
+            return 80
+        elif card == 'Gold':
+            return 60
+        else:
+            return 10
             
+def calc_treasure_card_value(card):
+    if card == 'Copper':
+        # Coppersmith changes this during the turn (see DominionGame.treasure_card_value)
+        return 1
+    elif card == 'Silver':
+        return 2
+    elif card == 'Gold':
+        return 3
+    elif card == 'Platinum':
+        return 5
+    elif card == 'Harem':
+        return 2
+    elif card == 'Contraband':
+        return 3
+    elif card == 'Hoard':
+        return 2
+    elif card == 'Loan':
+        return 1
+    elif card == 'Quarry':
+        return 1
+    elif card == 'Royal Seal':
+        return 2
+    elif card == 'Talisman':
+        return 1
+    elif card == 'Cache':
+        return 3
+    # Fool's Gold has a +$n line following it.
+    #elif card == 'Fool\'s Gold':
+    #    return self.fools_gold_value
+    elif card == 'Ill-Gotten Gains':
+        return 1
+    elif card == 'Diadem':
+        return 2
+    elif card == 'Stash':
+        return 2
+    # There are other treasure cards, but they have variable values, so there should be a +$x line following them
+    else:
+        return 0
+
 def add_card(card, plural = None, actions=False, buys=False, draws=False, curse=False, trash=False, attack=False, supply=True, potion=False):
+    register_card(card, actions, buys, draws, curse, trash, attack, supply, potion)
     cards.add(card)
     clean_cards[card.replace(' ', '').replace('-', '').replace("'", '').replace('_', '').lower()] = card
     if plural is None:
@@ -873,6 +1132,26 @@ def add_card(card, plural = None, actions=False, buys=False, draws=False, curse=
     if potion:
         potion_cards.add(card)
 
+# Gives the card the next id, with its type flags (the card type sets have already been updated by the add_*_card functions)
+def register_card(card, actions, buys, draws, curse, trash, attack, supply, potion):
+    flags = 0
+    for (flag, is_type) in [(action_flag, card in action_cards), (victory_flag, card in victory_cards), (treasure_flag, card in treasure_cards),
+                            (curse_flag, card in curse_cards), (prize_flag, card in prize_cards), (plus_action_flag, actions),
+                            (plus_buy_flag, buys), (drawing_flag, draws), (cursing_flag, curse), (trashing_flag, trash),
+                            (attack_flag, attack), (supply_flag, supply), (potion_flag, potion)]:
+        if is_type:
+            flags |= flag
+    card_id = len(card_names)
+    card_names.append(card)
+    card_ids[card] = card_id
+    card_flags.append(flags)
+    if flags & action_flag:
+        action_card_ids.append(card_id)
+    if flags & victory_flag:
+        victory_card_ids.append(card_id)
+    if flags & treasure_flag:
+        treasure_card_ids.append(card_id)
+    
 def add_action_card(card, plural = None, actions=False, buys=False, draws=False, curse=False, trash=False, attack=False, supply=True, potion=False):
     action_cards.add(card)
     add_card(card, plural, actions, buys, draws, curse, trash, attack, supply, potion)
@@ -1100,6 +1379,29 @@ add_action_card('Governor', draws=True, trash=True)
 add_action_card('Walled Village', actions=True)
 add_action_card('Black Market')
 
+# Ids of the cards that the game state checks for directly
+duchy_id = card_ids['Duchy']
+black_market_id = card_ids['Black Market']
+prize_card_mask = card_mask(card_ids[card] for card in prize_cards)
+core_victory_ids = frozenset([card_ids['Estate'], card_ids['Duchy'], card_ids['Province'], card_ids['Colony']])
+deck_dependent_card_ids = [card_ids[card] for card in deck_dependent_cards]
+copper_id = card_ids['Copper']
+
+# Card metadata tables, by card id
+for card_id in deck_dependent_card_ids:
+    card_flags[card_id] |= deck_points_flag
+card_point_values = [card_points.get(card, 0) for card in card_names]
+card_treasure_values = [calc_treasure_card_value(card) for card in card_names]
+# The initial supply of each card, for each number of players. Every DominionGame uses the one for its number of players.
+initial_supply_tables = {}
+
+def get_initial_supply_table(num_players):
+    if num_players not in initial_supply_tables:
+        initial_supply_tables[num_players] = array('h', [calc_card_initial_supply(card, num_players) for card in card_names])
+    return initial_supply_tables[num_players]
+    
+for num_players in range(2, 9):
+    get_initial_supply_table(num_players)
 
 # It would seem that isotropic doesn't have Dark Ages cards publicly available, so sadly, these cards
 # will likely never be seen or trained...
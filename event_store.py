@@ -0,0 +1,327 @@
+from dominion import *
+from isotropic import parse_started_event, turn_complete_event, parse_complete_event
+import struct
+import inspect
+
+# Event Store
+# -----------
+# Parsing the html logs is the slow part of extracting features, and it has to be redone every time a feature changes.
+# Instead, the parser can record every change it makes to the DominionGame (the same calls the regex matchers make:
+# the header, supply, players and scores, then each turn start, play, buy, gain, trash, vp, money, actions, buys, etc.)
+# as a compact binary stream of events, with cards and players stored as integer ids. Replaying the events rebuilds
+# the exact same game state, and fires the same handler events the parser would have, without touching any regexes.
+#
+# Store file layout (all integers little endian):
+#  magic, then the card table (a uint16 count, then each card name as a uint8 length and utf-8 bytes), which maps the
+#  card ids back to names. Then a uint32 length followed by the events for each game.
+# Each event is a uint8 event code (the index of the DominionGame method in game_events), followed by the arguments:
+#  c: card id (uint16, 0xFFFF for None)
+#  p: player id (uint8, in the order the players were added, 0xFF for None)
+#  h: int16
+#  n: int32 (None is stored as -2^31)
+#  b: bool (uint8)
+#  o: where a card is gained from (uint8 index into card_sources)
+#  s: string (uint16 byte length and utf-8 bytes, 0xFFFF for None)
+
+event_store_magic = 'TACTEVT1'
+
+# The DominionGame methods that are recorded, with the format of their arguments.
+# Methods that don't change the game state (draw, discard, reshuffle, cleanup) aren't recorded.
+game_events = [
+    ('set_timestamp', 'hhhhhh'),
+    ('set_game_id', 's'),
+    ('set_winner', 's'),
+    ('add_empty_pile', 'c'),
+    ('add_card_to_supply', 'c'),
+    ('add_player', 's'),
+    ('set_final_score', 'ph'),
+    ('add_final_deck', 'cp'),
+    ('add_final_trash', 'c'),
+    ('init_game', ''),
+    ('start_new_turn', 'pnpb'),
+    ('add_money', 'h'),
+    ('add_actions', 'h'),
+    ('add_buys', 'h'),
+    ('reduce_cost', 'h'),
+    ('set_copper_value', 'h'),
+    ('prohibit', 'c'),
+    ('play', 'c'),
+    ('buy', 'cpo'),
+    ('gain', 'cpob'),
+    ('trash', 'cp'),
+    ('add_vp', 'hp'),
+    ('add_pirate_ship_token', 'hp'),
+    ('embargo', 'c'),
+    ('reset_revealed', ''),
+    ('return_to_supply', 'cpb'),
+    ('reveal', 'cp'),
+]
+game_event_codes = dict((game_events[i][0], i) for i in range(len(game_events)))
+start_new_turn_code = game_event_codes['start_new_turn']
+set_timestamp_code = game_event_codes['set_timestamp']
+add_player_code = game_event_codes['add_player']
+# The final decks and trash are only used to validate the game, which was already done when it was recorded
+validation_codes = set([game_event_codes['add_final_deck'], game_event_codes['add_final_trash']])
+
+card_sources = ['supply', 'trash', 'prizes']
+card_source_ids = dict((card_sources[i], i) for i in range(len(card_sources)))
+
+struct_formats = {'c': 'H', 'p': 'B', 'h': 'h', 'n': 'i', 'b': 'B', 'o': 'B'}
+no_card = 0xFFFF
+no_player = 0xFF
+no_int = -0x80000000
+no_string = 0xFFFF
+
+record_length = struct.Struct('<I')
+string_length = struct.Struct('<H')
+event_code = struct.Struct('<B')
+# The structs for each event's arguments (None for events with strings, which are packed piece by piece)
+event_structs = [struct.Struct('<' + ''.join(struct_formats[arg] for arg in args)) if 's' not in args else None for (name, args) in game_events]
+
+# A DominionGame that records the methods called on it (by the parser), so the game can be written to an event store.
+# Only the outermost call is recorded, as replaying it will make the same inner calls (buy calls gain, and so on).
+class RecordingGame(DominionGame):
+    __slots__ = ['events', 'depth']
+
+    def __init__(self):
+        DominionGame.__init__(self)
+        self.events = []
+        self.depth = 0
+
+# Builds a method for RecordingGame that calls the DominionGame method, then records it with all of its arguments filled in
+def recorded_method(name, code):
+    method = getattr(DominionGame, name)
+    arg_names, varargs, keywords, defaults = inspect.getargspec(method)
+    arg_names = arg_names[1:] # Skip self
+    defaults = list(defaults) if defaults else []
+    defaults = [None] * (len(arg_names) - len(defaults)) + defaults
+    def record(self, *args, **kwargs):
+        self.depth += 1
+        try:
+            ret = method(self, *args, **kwargs)
+        finally:
+            self.depth -= 1
+        if self.depth == 0:
+            if kwargs:
+                args = list(args) + defaults[len(args):]
+                for (key, value) in kwargs.iteritems():
+                    args[arg_names.index(key)] = value
+            elif len(args) < len(arg_names):
+                args = args + tuple(defaults[len(args):])
+            self.events.append((code, args))
+        return ret
+    return record
+
+for name, args in game_events:
+    setattr(RecordingGame, name, recorded_method(name, game_event_codes[name]))
+
+# Card ids are the index of each card in the sorted card list. The card table in each store maps them back to names,
+# so stores stay readable if cards are added later.
+def get_card_table():
+    return sorted(cards)
+
+def pack_string(s):
+    if s is None:
+        return string_length.pack(no_string)
+    s = s.encode('utf-8')
+    return string_length.pack(len(s)) + s
+
+def unpack_string(data, offset):
+    length = string_length.unpack_from(data, offset)[0]
+    offset += string_length.size
+    if length == no_string:
+        return None, offset
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+# Converts an argument to the integer it is stored as
+def encode_arg(arg_type, value, card_ids, player_ids):
+    if arg_type == 'c':
+        return card_ids[value] if value is not None else no_card
+    elif arg_type == 'p':
+        if value is None:
+            return no_player
+        # Players are passed around both by name and as the player object
+        return player_ids[value if isinstance(value, basestring) else value.name]
+    elif arg_type == 'n':
+        return value if value is not None else no_int
+    elif arg_type == 'b':
+        return 1 if value else 0
+    elif arg_type == 'o':
+        return card_source_ids[value]
+    else:
+        return value
+
+# Decoding is the bulk of replaying, so each stored integer is turned back into its argument by indexing into a
+# lookup table for its type. The card and player tables have their None ids filled in, and int16s are used as is.
+class NullableInts(dict):
+    def __missing__(self, key):
+        return key
+
+nullable_ints = NullableInts({no_int: None})
+booleans = [False, True]
+
+# Returns a card table padded out so that any card id (including no_card) can be looked up in it
+def get_card_lookup(card_table):
+    return card_table + [None] * (no_card + 1 - len(card_table))
+
+# Returns the events recorded by a RecordingGame as a string, or None if the game couldn't be recorded
+# (for example, if a card name that isn't a card was passed to a method that doesn't check it)
+def encode_game(game, card_ids):
+    data = []
+    player_ids = {}
+    try:
+        for code, args in game.events:
+            name, arg_types = game_events[code]
+            if name == 'add_player':
+                player_ids[args[0]] = len(player_ids)
+            if event_structs[code] is not None:
+                data.append(event_code.pack(code) + event_structs[code].pack(*[encode_arg(arg_types[i], args[i], card_ids, player_ids) for i in range(len(args))]))
+            else:
+                data.append(event_code.pack(code))
+                for i in range(len(args)):
+                    if arg_types[i] == 's':
+                        data.append(pack_string(args[i]))
+                    else:
+                        data.append(struct.pack('<' + struct_formats[arg_types[i]], encode_arg(arg_types[i], args[i], card_ids, player_ids)))
+    except (KeyError, struct.error):
+        # Something was passed that can't be stored (or is out of range)
+        return None
+    return ''.join(data)
+
+# Yields the (event code, arguments) for each event in the encoded events for a game
+def decode_game(data, card_lookup):
+    players = [None] * (no_player + 1)
+    player_count = 0
+    lookups = {'c': card_lookup, 'p': players, 'h': None, 'n': nullable_ints, 'b': booleans, 'o': card_sources, 's': None}
+    event_lookups = [[lookups[arg_type] for arg_type in arg_types] for (name, arg_types) in game_events]
+    offset = 0
+    end = len(data)
+    while offset < end:
+        code = ord(data[offset])
+        offset += 1
+        event_struct = event_structs[code]
+        if event_struct is not None:
+            values = event_struct.unpack_from(data, offset)
+            offset += event_struct.size
+            args = [value if lookup is None else lookup[value] for (lookup, value) in zip(event_lookups[code], values)]
+        else:
+            # Events with strings are unpacked piece by piece
+            args = []
+            for arg_type, lookup in zip(game_events[code][1], event_lookups[code]):
+                if arg_type == 's':
+                    value, offset = unpack_string(data, offset)
+                else:
+                    arg_struct = struct.Struct('<' + struct_formats[arg_type])
+                    value = arg_struct.unpack_from(data, offset)[0]
+                    offset += arg_struct.size
+                    if lookup is not None:
+                        value = lookup[value]
+                args.append(value)
+            if code == add_player_code:
+                players[player_count] = args[0]
+                player_count += 1
+        yield code, args
+
+# Writes games to a new event store file
+class EventStoreWriter:
+
+    def __init__(self, filename):
+        self.card_table = get_card_table()
+        self.card_ids = dict((self.card_table[i], i) for i in range(len(self.card_table)))
+        self.games = 0
+        self.skipped_games = 0
+        self.file = open(filename, 'wb')
+        self.file.write(event_store_magic)
+        self.file.write(string_length.pack(len(self.card_table)))
+        for card in self.card_table:
+            card = card.encode('utf-8')
+            self.file.write(event_code.pack(len(card)) + card)
+
+    # Writes a game recorded by a RecordingGame
+    def write_game(self, game):
+        self.write_encoded_game(encode_game(game, self.card_ids))
+
+    # Writes a game that was already encoded (by a worker process)
+    def write_encoded_game(self, data):
+        if data is None:
+            self.skipped_games += 1
+            return
+        self.file.write(record_length.pack(len(data)))
+        self.file.write(data)
+        self.games += 1
+
+    def close(self):
+        self.file.close()
+
+def read_card_table(file):
+    assert file.read(len(event_store_magic)) == event_store_magic, 'Not an event store'
+    count = string_length.unpack(file.read(string_length.size))[0]
+    card_table = []
+    for i in range(count):
+        length = event_code.unpack(file.read(event_code.size))[0]
+        card_table.append(file.read(length).decode('utf-8'))
+    return card_table
+
+# Yields the (card lookup, encoded events) for each game in an event store
+def read_event_store(filename):
+    with open(filename, 'rb') as file:
+        card_lookup = get_card_lookup(read_card_table(file))
+        while True:
+            header = file.read(record_length.size)
+            if len(header) < record_length.size:
+                break
+            yield card_lookup, file.read(record_length.unpack(header)[0])
+
+# Rebuilds games from an event store and fires the same events as the IsotropicParser, so the same handlers can be registered on it.
+# The turn complete event fires at the end of each turn, which is right before the next turn starts, and at the end of the game.
+class GameReplayer:
+
+    def __init__(self):
+        self.event_handlers = {}
+        self.game = None
+        self.games = 0
+        # Replay the final decks and trash as well, so the game can be validated again
+        self.validate = False
+        # Keep a snapshot of the game at the start of each turn (in game.turn_snapshots)
+        self.keep_turn_snapshots = False
+
+    def register_handler(self, event, handler):
+        self.event_handlers[event] = handler
+
+    def handle_event(self, event):
+        if event in self.event_handlers:
+            self.event_handlers[event](self.game)
+
+    # Replays a single game, returning 0 (the games in the store all parsed completely)
+    def replay(self, card_lookup, data):
+        self.game = DominionGame()
+        if self.keep_turn_snapshots:
+            self.game.enable_turn_snapshots()
+        methods = [getattr(self.game, name) for (name, arg_types) in game_events]
+        skipped = validation_codes if not self.validate else ()
+        started = False
+        in_turn = False
+        for code, args in decode_game(data, card_lookup):
+            # The parser fires the parse started event once the timestamp is set
+            if not started and code != set_timestamp_code:
+                self.handle_event(parse_started_event)
+                started = True
+            if code == start_new_turn_code:
+                if in_turn:
+                    self.handle_event(turn_complete_event)
+                in_turn = True
+            elif code in skipped:
+                continue
+            methods[code](*args)
+        if not started:
+            self.handle_event(parse_started_event)
+        if in_turn:
+            self.handle_event(turn_complete_event)
+        self.handle_event(parse_complete_event)
+        self.games += 1
+        return 0
+
+    # Replays every game in an event store
+    def replay_store(self, filename):
+        for card_lookup, data in read_event_store(filename):
+            self.replay(card_lookup, data)
@@ -0,0 +1,193 @@
+import os
+import os.path
+import sys
+import json
+import shutil
+import struct
+from array import array
+
+# Column Store
+# ------------
+# An alternative to features.sql3 for training: the instances are written as flat binary columns that can be opened
+# with numpy.memmap (without copying anything), instead of being read out of SQLite row by row.
+#
+# The store is a directory holding:
+#  schema.json: the features (names, values, and their column in the feature matrix), the card bought labels, the
+#   files below with their dtype and shape, and the rows for each card bought.
+#  features.f32: a float32 matrix with a row per instance and a column per feature (C order). Features without a value
+#   (like the timestamp of a log whose name doesn't have it) are NaN.
+#  card_bought.u16: the card bought for each instance, as a uint16 index into the card bought labels.
+#  output_weight.f32: the output weight for each instance, as a float32.
+#  game_id.u64: the Game Id feature for each instance, as a uint64 (it doesn't fit in a float32, so it isn't one of the
+#   columns of the feature matrix).
+# All of the values are in the byte order given in the schema (the byte order of the machine that wrote them).
+#
+# The rows are grouped by card bought (in the order of the labels), so the instances for a card are the contiguous
+# rows offset to offset + count. While the features are being extracted, the rows for each card are spilled to a
+# temporary file per card, which are joined together when the store is closed.
+
+column_store_version = 2
+schema_filename = 'schema.json'
+spill_dirname = 'spill'
+
+# The files in each store, with their array and numpy type codes
+column_files = [
+    ('features', 'features.f32', 'f', 'f4'),
+    ('card_bought', 'card_bought.u16', 'H', 'u2'),
+    ('output_weight', 'output_weight.f32', 'f', 'f4'),
+    ('game_id', 'game_id.u64', 'Q', 'u8'),
+]
+# The feature that is written to game_id.u64 instead of the feature matrix
+game_id_feature = 'game_id'
+# The game ids are packed with struct, as array has no type code that is always 64 bits
+game_id_struct = struct.Struct('=Q')
+nan = float('nan')
+
+def get_dtype(type_code):
+    return ('<' if sys.byteorder == 'little' else '>') + type_code
+
+# Writes instances (the features, then the card bought label and output weight, as the FeatureExtractor builds them)
+# to a new column store
+class ColumnWriter:
+
+    def __init__(self, path, features, labels, batch_size=4096):
+        self.path = path
+        # The position of the game id in the rows (if there is one), which is taken out of the rest of the features
+        sql_names = [feature.sql_name for feature in features]
+        self.game_id_column = sql_names.index(game_id_feature) if game_id_feature in sql_names else None
+        self.features = [feature for feature in features if feature.sql_name != game_id_feature]
+        self.labels = list(labels)
+        self.label_ids = dict((self.labels[i], i) for i in range(len(self.labels)))
+        self.batch_size = batch_size
+        self.rows = 0
+        self.card_rows = [0] * len(self.labels)
+
+        # The rows waiting to be spilled for each card: the features followed by the output weight, and the game ids
+        self.pending = [array('f') for label in self.labels]
+        self.pending_game_ids = [[] for label in self.labels]
+        self.pending_rows = 0
+
+        self.spill_path = os.path.join(self.path, spill_dirname)
+        if os.path.exists(self.spill_path):
+            shutil.rmtree(self.spill_path)
+        os.makedirs(self.spill_path)
+
+    def get_label_id(self, label):
+        # Cards bought that aren't in the labels (cards that aren't in the supply) are added to the end
+        if label not in self.label_ids:
+            self.label_ids[label] = len(self.labels)
+            self.labels.append(label)
+            self.card_rows.append(0)
+            self.pending.append(array('f'))
+            self.pending_game_ids.append([])
+        return self.label_ids[label]
+
+    def add_rows(self, rows):
+        for row in rows:
+            label_id = self.get_label_id(row[-2])
+            values = list(row[:-2])
+            if self.game_id_column is not None:
+                game_id = values.pop(self.game_id_column)
+                self.pending_game_ids[label_id].append(int(game_id) if game_id is not None else 0)
+            if None in values:
+                values = [value if value is not None else nan for value in values]
+            self.pending[label_id].extend(values)
+            self.pending[label_id].append(row[-1] if row[-1] is not None else nan)
+            self.card_rows[label_id] += 1
+        self.rows += len(rows)
+        self.pending_rows += len(rows)
+        if self.pending_rows >= self.batch_size:
+            self.spill()
+
+    def get_spill_filename(self, label_id, extension='f32'):
+        return os.path.join(self.spill_path, '{0}.{1}'.format(label_id, extension))
+
+    # Appends the pending rows for each card to its spill files
+    def spill(self):
+        for label_id in range(len(self.pending)):
+            if self.pending[label_id]:
+                with open(self.get_spill_filename(label_id), 'ab') as file:
+                    self.pending[label_id].tofile(file)
+                del self.pending[label_id][:]
+            if self.pending_game_ids[label_id]:
+                with open(self.get_spill_filename(label_id, 'u64'), 'ab') as file:
+                    file.write(''.join(game_id_struct.pack(game_id) for game_id in self.pending_game_ids[label_id]))
+                del self.pending_game_ids[label_id][:]
+        self.pending_rows = 0
+
+    # Joins the spill files into the columns (grouped by card), and writes the schema
+    def close(self):
+        self.spill()
+        width = len(self.features) + 1
+        chunk_rows = max(1, self.batch_size)
+        files = dict((name, open(os.path.join(self.path, filename), 'wb')) for (name, filename, type_code, dtype) in self.get_column_files())
+        cards = {}
+        offset = 0
+        for label_id in range(len(self.labels)):
+            count = self.card_rows[label_id]
+            cards[self.labels[label_id]] = {'offset': offset, 'count': count}
+            offset += count
+            if count == 0:
+                continue
+            with open(self.get_spill_filename(label_id), 'rb') as spill:
+                remaining = count
+                while remaining > 0:
+                    rows = min(chunk_rows, remaining)
+                    chunk = array('f')
+                    chunk.fromfile(spill, rows * width)
+                    # The output weight is the last value in each row
+                    weights = chunk[width - 1::width]
+                    del chunk[width - 1::width]
+                    chunk.tofile(files['features'])
+                    weights.tofile(files['output_weight'])
+                    array('H', [label_id] * rows).tofile(files['card_bought'])
+                    remaining -= rows
+            if self.game_id_column is not None:
+                # The game ids were already packed as they were spilled
+                with open(self.get_spill_filename(label_id, 'u64'), 'rb') as spill:
+                    shutil.copyfileobj(spill, files['game_id'])
+        for file in files.values():
+            file.close()
+        shutil.rmtree(self.spill_path)
+
+        shapes = {'features': [self.rows, len(self.features)], 'card_bought': [self.rows], 'output_weight': [self.rows], 'game_id': [self.rows]}
+        schema = {
+            'version': column_store_version,
+            'rows': self.rows,
+            'features': [{'name': self.features[i].name, 'sql_name': self.features[i].sql_name, 'values': self.features[i].values, 'column': i} for i in range(len(self.features))],
+            'card_bought_labels': self.labels,
+            'cards': cards,
+            'files': dict((name, {'file': filename, 'dtype': get_dtype(dtype), 'shape': shapes[name]}) for (name, filename, type_code, dtype) in self.get_column_files()),
+        }
+        with open(os.path.join(self.path, schema_filename), 'w') as file:
+            json.dump(schema, file, indent=2, sort_keys=True)
+
+    # The files in the store (game_id.u64 is left out if there's no game id feature)
+    def get_column_files(self):
+        return [column_file for column_file in column_files if column_file[0] != 'game_id' or self.game_id_column is not None]
+
+def read_schema(path):
+    with open(os.path.join(path, schema_filename)) as file:
+        schema = json.load(file)
+    assert schema['version'] == column_store_version, 'Unsupported column store version: {0}'.format(schema['version'])
+    return schema
+
+# Opens the columns in a column store as read only numpy memmaps, returning the schema and a dict of the columns
+def open_columns(path):
+    import numpy
+    schema = read_schema(path)
+    columns = {}
+    for name, info in schema['files'].items():
+        if schema['rows'] == 0:
+            # Empty files can't be mapped
+            columns[name] = numpy.zeros(info['shape'], dtype=info['dtype'])
+        else:
+            columns[name] = numpy.memmap(os.path.join(path, info['file']), dtype=info['dtype'], mode='r', shape=tuple(info['shape']))
+    return schema, columns
+
+# Returns the rows of the columns for a card bought (views into the memmaps, nothing is copied)
+def get_card_columns(schema, columns, label):
+    card = schema['cards'].get(label, {'offset': 0, 'count': 0})
+    start = card['offset']
+    end = start + card['count']
+    return dict((name, column[start:end]) for (name, column) in columns.items())
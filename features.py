@@ -7,6 +7,17 @@ import time
 from optparse import OptionParser
 import sqlite3
 import re
+import tarfile
+import hashlib
+import datetime
+import isotropic
+import dominion
+import multiprocessing
+import itertools
+import signal
+from cStringIO import StringIO
+from event_store import RecordingGame, EventStoreWriter, GameReplayer, encode_game, get_card_table
+from feature_columns import ColumnWriter
 
 def pr(s):
     print s.encode('utf-8')
@@ -18,32 +29,60 @@ def sqlclean(s):
     return re.sub(r'[\W]+', '', s.replace(" ", "_").lower())
     
     
+# Shared Values
+# -------------
+# Values that many features need (like the controlling player) are registered once as shared values. Each feature lists
+# the values it takes as arguments (its inputs): any of the shared values, or 'game' and 'bought' (the card bought).
+# A FeaturePlan computes each shared value once per turn (or once per card bought, if it depends on the card bought),
+# rather than once for every feature that uses it. Shared values can take other shared values registered before them.
+shared_values = {}
+shared_value_names = []
+
+def add_shared_value(name, func, inputs = ['game']):
+    shared_values[name] = (func, inputs)
+    shared_value_names.append(name)
+    
+# Computes a single value on its own, along with the shared values it takes
+def get_shared_value(name, game, bought):
+    if name == 'game':
+        return game
+    elif name == 'bought':
+        return bought
+    func, inputs = shared_values[name]
+    return func(*[get_shared_value(input, game, bought) for input in inputs])
+    
+# Using game.get_player(game.possessor) gets the stats for the controlling player - either the possessor, or the regular player (as it will be None if there isn't a possessor, in which case the regular player will be retrieved.)
+add_shared_value('player', lambda game: game.get_player(game.possessor))
+add_shared_value('deck_divisor', lambda player: player.get_deck_size() if player.get_deck_size() != 0 else 1, ['player'])
+    
 class Feature:
     features = []
     sql_names = {}
     
-    def __init__(self, name, func, values):
+    def __init__(self, name, func, values, inputs):
         self.name = name
         self.arff_name = clean(name)
         self.sql_name = sqlclean(name)
         Feature.sql_names[self.sql_name] = self
         self.func = func
         self.values = values
+        self.inputs = inputs
         
+    # Computes the feature on its own (the FeatureExtractor computes all of the features at once with a FeaturePlan)
     def extract(self, game, bought):
-        return self.func(game, bought)
+        return self.func(*[get_shared_value(input, game, bought) for input in self.inputs])
 
-def add_feature(func, name, values = 'REAL'):
-    Feature.features.append(Feature(name, func, values))
+def add_feature(func, name, values = 'REAL', inputs = ['game']):
+    Feature.features.append(Feature(name, func, values, inputs))
     
 def add_card_feature(card):
-    add_feature(lambda game, bought: 1 if game.is_card_in_supply(card) else 0, '{0} in Supply?'.format(card), [0, 1])
+    add_feature(lambda game: 1 if game.is_card_in_supply(card) else 0, '{0} in Supply?'.format(card), [0, 1])
     
 def add_card_acquired_feature(card):
-    add_feature(lambda game, bought: game.get_card_acquired_count(card) / game.card_initial_supply(card) if game.card_initial_supply(card) != 0 else 0, "{0} Acquired".format(pluralize_card(card)))
+    add_feature(lambda game: game.get_card_acquired_count(card) / game.card_initial_supply(card) if game.card_initial_supply(card) != 0 else 0, "{0} Acquired".format(pluralize_card(card)))
     
 def add_my_card_feature(card):
-    add_feature(lambda game, bought: game.get_player(game.possessor).get_card_count(card) / game.card_initial_supply(card) if game.card_initial_supply(card) != 0 else 0, "{0} In Player Deck".format(pluralize_card(card)))
+    add_feature(lambda game, player: player.get_card_count(card) / game.card_initial_supply(card) if game.card_initial_supply(card) != 0 else 0, "{0} In Player Deck".format(pluralize_card(card)), inputs=['game', 'player'])
     
 # Binners
 # Bins money to 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12+
@@ -86,24 +125,24 @@ for card in sorted(supply_cards):
     # Python lambda's make this need to be a separate function. That way, card is a new scope.
     #add_card_feature(card)
     pass
-add_feature(lambda game, bought: game.get_num_players() / 6.0, "Number of Players")
-add_feature(lambda game, bought: 1 if game.supply_contains_any(plus_action_cards) else 0, "+Action Cards in Supply?", [0, 1]) # +2 Action or more cards only. Chaining cards (+1 Action) don't count.
-add_feature(lambda game, bought: 1 if game.supply_contains_any(plus_buy_cards) else 0, "+Buy Cards in Supply?", [0, 1])
-add_feature(lambda game, bought: 1 if game.supply_contains_any(drawing_cards) else 0, "Drawing Cards in Supply?", [0, 1]) # +2 Cards or more only. 
-add_feature(lambda game, bought: 1 if game.supply_contains_any(cursing_cards) else 0, "Cursing Cards in Supply?", [0, 1])
-add_feature(lambda game, bought: 1 if game.supply_contains_any(trashing_cards) else 0, "Trashing Cards in Supply?", [0, 1])
-add_feature(lambda game, bought: 1 if game.supply_contains_any(attack_cards) else 0, "Attack Cards in Supply?", [0, 1])
-add_feature(lambda game, bought: 1 if game.supply_contains_any(potion_cards) else 0, "Potion Cards in Supply?", [0, 1])
+add_feature(lambda game: game.get_num_players() / 6.0, "Number of Players")
+add_feature(lambda game: 1 if game.supply_contains_type(plus_action_flag) else 0, "+Action Cards in Supply?", [0, 1]) # +2 Action or more cards only. Chaining cards (+1 Action) don't count.
+add_feature(lambda game: 1 if game.supply_contains_type(plus_buy_flag) else 0, "+Buy Cards in Supply?", [0, 1])
+add_feature(lambda game: 1 if game.supply_contains_type(drawing_flag) else 0, "Drawing Cards in Supply?", [0, 1]) # +2 Cards or more only. 
+add_feature(lambda game: 1 if game.supply_contains_type(cursing_flag) else 0, "Cursing Cards in Supply?", [0, 1])
+add_feature(lambda game: 1 if game.supply_contains_type(trashing_flag) else 0, "Trashing Cards in Supply?", [0, 1])
+add_feature(lambda game: 1 if game.supply_contains_type(attack_flag) else 0, "Attack Cards in Supply?", [0, 1])
+add_feature(lambda game: 1 if game.supply_contains_type(potion_flag) else 0, "Potion Cards in Supply?", [0, 1])
 
 # Move context features
 # This is normalized by looking at the max in the 8 gb dataset. 61 was the max, so this should be good.
-add_feature(lambda game, bought: (game.turn_number - 1.0) / 50.0, "Turn Number")
-add_feature(lambda game, bought: bin_money_feature(game.money), "Money")
-add_feature(lambda game, bought: bin_buys_feature(game.buys), "Buys")
-add_feature(lambda game, bought: bin_actions_feature(game.actions), "Actions")
+add_feature(lambda game: (game.turn_number - 1.0) / 50.0, "Turn Number")
+add_feature(lambda game: bin_money_feature(game.money), "Money")
+add_feature(lambda game: bin_buys_feature(game.buys), "Buys")
+add_feature(lambda game: bin_actions_feature(game.actions), "Actions")
 
 # Game state features
-add_feature(lambda game, bought: game.get_num_empty_piles() / 3.0, "Empty Piles")
+add_feature(lambda game: game.get_num_empty_piles() / 3.0, "Empty Piles")
 # Add features for how many of each victory card have been bought so far (in games where they aren't in the supply, they are now set to 0 to indicate that none have been bought)
 for card in sorted(victory_cards):
     # Again, this needs to be in a separate function to make the card get stored in the closure
@@ -111,47 +150,144 @@ for card in sorted(victory_cards):
 add_card_acquired_feature('Curse')
 
 # Player deck stats
-# Using game.get_player(game.possessor) gets the stats for the controlling player - either the possessor, or the regular player (as it will be None if there isn't a possessor, in which case the regular player will be retrieved.)
+# These use the stats for the controlling player (see the 'player' shared value)
 # This will need to be normalized by the runner
 # Again, these are normalized by looking at the max of the large dataset
-add_feature(lambda game, bought: game.get_player(game.possessor).get_deck_size() / 100.0, "Player Deck Size")
-add_feature(lambda game, bought: game.get_player(game.possessor).get_action_card_count() / 40.0, "Player Deck Action Cards")
-add_feature(lambda game, bought: game.get_player(game.possessor).get_victory_card_count() / 20.0, "Player Deck Victory Cards")
-add_feature(lambda game, bought: game.get_player(game.possessor).get_treasure_card_count() / 60.0, "Player Deck Treasure Cards")
-add_feature(lambda game, bought: game.get_player(game.possessor).get_action_card_count() / (game.get_player(game.possessor).get_deck_size() if game.get_player(game.possessor).get_deck_size() != 0 else 1), "Player Deck Action Card Ratio")
-add_feature(lambda game, bought: game.get_player(game.possessor).get_victory_card_count() / (game.get_player(game.possessor).get_deck_size() if game.get_player(game.possessor).get_deck_size() != 0 else 1), "Player Deck Victory Card Ratio")
-add_feature(lambda game, bought: game.get_player(game.possessor).get_treasure_card_count() / (game.get_player(game.possessor).get_deck_size() if game.get_player(game.possessor).get_deck_size() != 0 else 1), "Player Deck Treasure Card Ratio")
+add_feature(lambda player: player.get_deck_size() / 100.0, "Player Deck Size", inputs=['player'])
+add_feature(lambda player: player.get_action_card_count() / 40.0, "Player Deck Action Cards", inputs=['player'])
+add_feature(lambda player: player.get_victory_card_count() / 20.0, "Player Deck Victory Cards", inputs=['player'])
+add_feature(lambda player: player.get_treasure_card_count() / 60.0, "Player Deck Treasure Cards", inputs=['player'])
+add_feature(lambda player, deck_divisor: player.get_action_card_count() / deck_divisor, "Player Deck Action Card Ratio", inputs=['player', 'deck_divisor'])
+add_feature(lambda player, deck_divisor: player.get_victory_card_count() / deck_divisor, "Player Deck Victory Card Ratio", inputs=['player', 'deck_divisor'])
+add_feature(lambda player, deck_divisor: player.get_treasure_card_count() / deck_divisor, "Player Deck Treasure Card Ratio", inputs=['player', 'deck_divisor'])
 # How many of each card are in my deck?
 for card in sorted(cards):
     #add_my_card_feature(card)
     pass
 # How many of the card that was bought are already in my deck?
-add_feature(lambda game, bought: game.get_player(game.possessor).get_card_count(bought) / game.card_initial_supply(bought) if bought != "None" else 0, "Already In Player Deck")
+# This is the only feature that depends on the card bought
+add_feature(lambda game, player, bought: player.get_card_count(bought) / game.card_initial_supply(bought) if bought != "None" else 0, "Already In Player Deck", inputs=['game', 'player', 'bought'])
     
 # Output features
-add_feature(lambda game, bought: game.get_player(game.possessor).get_current_score(), "Player Current Score")
-add_feature(lambda game, bought: game.get_player(game.possessor).get_final_score() - game.get_player(game.possessor).get_current_score(), "Player Score Increase")
-add_feature(lambda game, bought: game.get_player(game.possessor).get_final_score(), "Player Final Score")
-add_feature(lambda game, bought: game.get_average_final_score(), "Average Final Score")
-add_feature(lambda game, bought: 1 if game.get_player(game.possessor) is game.get_player(game.winner) else 0, "Player_Won", [0, 1])
-add_feature(lambda game, bought: 1 if game.get_player(game.possessor).gained_victory else 0, "Player Gained Victory Cards", [0, 1])
-add_feature(lambda game, bought: 1 if game.get_player(game.possessor).gained_core_victory else 0, "Player Gained Core Victory Cards", [0, 1])
+add_feature(lambda player: player.get_current_score(), "Player Current Score", inputs=['player'])
+add_feature(lambda player: player.get_final_score() - player.get_current_score(), "Player Score Increase", inputs=['player'])
+add_feature(lambda player: player.get_final_score(), "Player Final Score", inputs=['player'])
+add_feature(lambda game: game.get_average_final_score(), "Average Final Score")
+add_feature(lambda game, player: 1 if player is game.get_player(game.winner) else 0, "Player_Won", [0, 1], inputs=['game', 'player'])
+add_feature(lambda player: 1 if player.gained_victory else 0, "Player Gained Victory Cards", [0, 1], inputs=['player'])
+add_feature(lambda player: 1 if player.gained_core_victory else 0, "Player Gained Core Victory Cards", [0, 1], inputs=['player'])
 
 # Timestamp features
-add_feature(lambda game, bought: int(game.game_id, 16), "Game Id")
-add_feature(lambda game, bought: game.year, "Game Year")
-add_feature(lambda game, bought: game.month, "Game Month")
-add_feature(lambda game, bought: game.day, "Game Day")
-add_feature(lambda game, bought: game.hour, "Game Hour")
-add_feature(lambda game, bought: game.minute, "Game Minute")
-add_feature(lambda game, bought: game.second, "Game Second")
+add_feature(lambda game: int(game.game_id, 16), "Game Id")
+add_feature(lambda game: game.year, "Game Year")
+add_feature(lambda game: game.month, "Game Month")
+add_feature(lambda game: game.day, "Game Day")
+add_feature(lambda game: game.hour, "Game Hour")
+add_feature(lambda game: game.minute, "Game Minute")
+add_feature(lambda game: game.second, "Game Second")
+
+    
+    
+# Extraction Plan
+# ---------------
+# Splits a list of features into the steps that extract them all at once. The shared values are computed into slots in a
+# list of values (in the order they were added, after the game and the card bought), and each feature is called with
+# the slots it takes. Anything that depends on the card bought (directly or through a shared value) is computed for each
+# card bought, and everything else once per turn, into a row that is allocated once and reused for every instance.
+# Each step is a (slot or column, function, input slots) tuple.
+class FeaturePlan:
+    
+    def __init__(self, features):
+        slots = {'game': 0, 'bought': 1}
+        card_dependent = set(['bought'])
+        self.turn_values = []
+        self.card_values = []
+        for name in shared_value_names:
+            func, inputs = shared_values[name]
+            slots[name] = len(slots)
+            step = (slots[name], func, [slots[input] for input in inputs])
+            if card_dependent.intersection(inputs):
+                card_dependent.add(name)
+                self.card_values.append(step)
+            else:
+                self.turn_values.append(step)
+        self.turn_features = []
+        self.card_features = []
+        for column in range(len(features)):
+            step = (column, features[column].func, [slots[input] for input in features[column].inputs])
+            if card_dependent.intersection(features[column].inputs):
+                self.card_features.append(step)
+            else:
+                self.turn_features.append(step)
+        self.values = [None] * len(slots)
+        self.row = [None] * len(features)
+        
+    # Computes the shared values and columns that don't depend on the card bought
+    def extract_turn(self, game):
+        values = self.values
+        row = self.row
+        values[0] = game
+        for slot, func, inputs in self.turn_values:
+            values[slot] = func(*[values[input] for input in inputs])
+        for column, func, inputs in self.turn_features:
+            row[column] = func(*[values[input] for input in inputs])
+            
+    # Fills in the rest of the row for a card bought (after extract_turn), and returns a copy of it
+    def extract_card(self, bought):
+        values = self.values
+        row = self.row
+        values[1] = bought
+        for slot, func, inputs in self.card_values:
+            values[slot] = func(*[values[input] for input in inputs])
+        for column, func, inputs in self.card_features:
+            row[column] = func(*[values[input] for input in inputs])
+        return row[:]
+        
+# The PRAGMAs the features db is opened with. The db is rebuilt from scratch each run, so it's loaded without a journal
+# on disk or waiting for each write to reach the disk.
+default_sql_pragmas = [
+    ('page_size', '4096'),
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-65536'), # In KiB when negative (64 MiB)
+]
+# An incremental db is kept between runs, so it needs a journal that survives a crash part way through a game
+incremental_sql_pragmas = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', '-65536'),
+]
 
+# The values the card bought output can take
+def get_card_bought_labels():
+    return ['None'] + map(clean, sorted(supply_cards))
     
+# How the games are split between the sets (the use of each instance), as the fraction of the games that go in each set.
+# These match the trainer's defaults: 80% of the games for training, and 20% of those held out for validation.
+default_split = [
+    ('training', 0.64),
+    ('validation', 0.16),
+    ('testing', 0.2),
+]
+
+# Returns the use and randomizer for the instances of a game. Both come from a hash of the game id, so every instance of
+# a game lands in the same set (turns from a game can't leak between sets), and a game gets the same use and randomizer
+# on every run.
+def get_game_split(game_id, split):
+    digest = hashlib.md5(str(game_id)).digest()
+    position = int(digest[:8].encode('hex'), 16) / float(1 << 64)
+    randomizer = int(digest[8:12].encode('hex'), 16) >> 1
+    total = sum(fraction for (use, fraction) in split)
+    for use, fraction in split:
+        position -= fraction / total
+        if position < 0:
+            return [use, randomizer]
+    return [split[-1][0], randomizer]
     
 # This class handles logging features to be trained on
 class FeatureExtractor:
     
-    def __init__(self, filename, arff=True, sql=False):
+    def __init__(self, filename, arff=True, sql=False, sql_pragmas=None, sql_batch_size=1000, columns_path=None, incremental=False, split=None):
         self.dbcon = None
         self.db = None
         
@@ -159,8 +295,26 @@ class FeatureExtractor:
         self.pending_instances = []
         self.files = 0
         self.ignored_files = 0
+        self.filtered_files = 0
         self.instances = 0
         
+        # Rows are inserted into the db sql_batch_size at a time, each batch in a single transaction
+        self.sql_rows = []
+        self.sql_batch_size = sql_batch_size
+        self.sql_pragmas = sql_pragmas if sql_pragmas is not None else default_sql_pragmas
+        self.sql_rows_inserted = 0
+        self.sql_insert_time = 0.0
+        self.sql_index_time = 0.0
+        
+        # The games in the db: the game id and the log each one came from (which are kept between runs when incremental)
+        self.incremental = incremental
+        self.split = split if split is not None else default_split
+        self.game_id = None
+        self.sql_games = []
+        self.logs = {}
+        self.game_ids = set()
+        self.skipped_logs = 0
+        
         self.arff = arff
         if self.arff:
             self.file = open(filename, 'w')
@@ -172,29 +326,61 @@ class FeatureExtractor:
         if self.sql:
             self.init_db()
         
+        # Also write the instances to a column store, if there's a path for one. An incremental db only sees the games
+        # that are new in each run, so its column store is written out of the whole db when it's closed instead.
+        self.columns = None
+        self.columns_path = columns_path
+        if columns_path and not (self.sql and self.incremental):
+            self.columns = ColumnWriter(columns_path, self.features, get_card_bought_labels())
+        
     def close(self):
         if self.arff:
             self.file.close()
+        if self.columns:
+            self.columns.close()
         if self.sql:
-            # Create the indexes
-            sql = "CREATE INDEX IF NOT EXISTS card_bought_index ON instances (card_bought);"
+            self.insert_sql_rows()
+            # Create the indexes now that all the rows are loaded (it's faster than keeping them up to date during the load)
+            start = time.time()
+            # Reading a set of instances for a card is a direct scan of this index (it also covers reading all of them)
+            sql = "CREATE INDEX IF NOT EXISTS card_bought_use_index ON instances (card_bought, use);"
+            self.db.execute(sql)
+            sql = "DROP INDEX IF EXISTS card_bought_index;"
             self.db.execute(sql)
             #sql = "CREATE INDEX IF NOT EXISTS use_index ON instances (use);"
             #self.db.execute(sql)
             sql = "CREATE INDEX IF NOT EXISTS game_second_index ON instances (game_second);"
             self.db.execute(sql)
+            sql = "CREATE INDEX IF NOT EXISTS game_id_index ON instances (game_id);"
+            self.db.execute(sql)
             
             self.dbcon.commit()
+            self.sql_index_time = time.time() - start
+            if self.columns_path and self.incremental:
+                self.write_columns_from_db()
             self.dbcon.close()
         
+    # Writes the column store from every row in the db (the games kept from earlier runs as well as the new ones)
+    def write_columns_from_db(self):
+        columns = ColumnWriter(self.columns_path, self.features, get_card_bought_labels())
+        sql = "SELECT {0}, card_bought, card_output_weight FROM instances ORDER BY id;".format(', '.join(feature.sql_name for feature in self.features))
+        self.db.execute(sql)
+        while True:
+            rows = self.db.fetchmany(columns.batch_size)
+            if not rows:
+                break
+            columns.add_rows(rows)
+        columns.close()
+        
     def init_features(self):
         # Add the features
         for feature in Feature.features:
             self.add_feature(feature)
+        self.plan = FeaturePlan(self.features)
         
         if self.arff:
             # Output features are hard coded in.
-            self.file.write("@ATTRIBUTE 'Card_Bought' {None," + ','.join(map(clean, sorted(supply_cards))) + '}\n')
+            self.file.write("@ATTRIBUTE 'Card_Bought' {" + ','.join(get_card_bought_labels()) + '}\n')
             self.file.write("@ATTRIBUTE 'Card_Output_Weight' REAL\n")
             #self.file.write("@ATTRIBUTE 'Player_Final_Score' REAL\n")
             #self.file.write("@ATTRIBUTE 'Average_Final_Score' REAL\n")
@@ -211,9 +397,23 @@ class FeatureExtractor:
         self.dbcon = sqlite3.connect("features.sql3")
         self.db = self.dbcon.cursor()
         
-        # Drop the table if it was already there
-        sql = "DROP TABLE IF EXISTS instances;"
-        self.db.execute(sql)
+        # The page size only takes effect when the db is vacuumed below, and the rest are set after that
+        self.set_sql_pragmas([(name, value) for (name, value) in self.sql_pragmas if name == 'page_size'])
+        
+        # An incremental db keeps the games that are already in it, as long as the features haven't changed since
+        rebuild = True
+        if self.incremental:
+            columns = [name for (cid, name, type, notnull, default, pk) in self.db.execute("PRAGMA table_info(instances);")]
+            rebuild = columns != self.get_sql_column_names()
+            if rebuild and columns:
+                print 'The features have changed since features.sql3 was built, so it will be rebuilt'
+        
+        if rebuild:
+            # Drop the tables (and their indexes) if they were already there
+            sql = "DROP TABLE IF EXISTS instances;"
+            self.db.execute(sql)
+            sql = "DROP TABLE IF EXISTS games;"
+            self.db.execute(sql)
         
         # Create the table
         sql = """
@@ -232,10 +432,45 @@ class FeatureExtractor:
         #print sql
         self.db.execute(sql)
         
-        # Shrink the db size back down
-        sql = "VACUUM;"
+        # The games that are in the instances table (by the id in the log, which the Game Id feature is the value of),
+        # and the log (and version of the code) each one was extracted from
+        sql = """
+            CREATE TABLE IF NOT EXISTS games (
+                game_id TEXT PRIMARY KEY,
+                path TEXT,
+                size INT,
+                mtime REAL,
+                version TEXT
+            );
+        """
         self.db.execute(sql)
         
+        if rebuild:
+            # Shrink the db size back down
+            sql = "VACUUM;"
+            self.db.execute(sql)
+        
+        self.set_sql_pragmas([(name, value) for (name, value) in self.sql_pragmas if name != 'page_size'])
+        
+        # A change to the split changes the use of the rows, so it counts as a new version as well
+        self.version = get_features_version(repr(self.split))
+        if self.incremental:
+            # Games are replaced one at a time, so their rows have to be found quickly from the start
+            sql = "CREATE INDEX IF NOT EXISTS game_id_index ON instances (game_id);"
+            self.db.execute(sql)
+            self.dbcon.commit()
+            for game_id, path, size, mtime, version in self.db.execute("SELECT game_id, path, size, mtime, version FROM games;"):
+                self.game_ids.add(game_id)
+                if path is not None:
+                    self.logs[path] = (game_id, size, mtime, version)
+        
+        # Every row is bound to the same statement
+        self.insert_sql = "INSERT INTO instances VALUES (NULL, {0});".format(', '.join(['?'] * (len(self.features) + 4)))
+        
+    def set_sql_pragmas(self, pragmas):
+        for (name, value) in pragmas:
+            self.db.execute("PRAGMA {0} = {1};".format(name, value))
+        
     def get_sql_type(self, values):
         if isinstance(values, basestring) and (values.lower() == 'real' or values.lower() == 'continuous'):
             return 'REAL'
@@ -246,56 +481,85 @@ class FeatureExtractor:
                 return 'TEXT'
         return None
         
+    def get_sql_column_names(self):
+        return ['id'] + [feature.sql_name for feature in self.features] + ['card_bought', 'card_output_weight', 'use', 'randomizer']
+        
     def get_sql_create_columns(self):
         cols = []
         for feature in self.features:
             cols.append('{0} {1},'.format(feature.sql_name, self.get_sql_type(feature.values)))
         return cols
         
-    def add_sql_instance(self, instance):
-        sql = """
-            INSERT INTO instances VALUES (
-                NULL,
-                {0},
-                NULL,
-                NULL
-            );
-        """.format(''.join(self.get_sql_values(instance))) # '\n                '
+    # Inserts the rows waiting to be inserted, in one transaction
+    def insert_sql_rows(self):
+        if not self.sql_rows:
+            return
+        start = time.time()
+        self.db.executemany(self.insert_sql, self.sql_rows)
+        # The games go in the same transaction as their rows
+        self.db.executemany("INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?);", self.sql_games)
+        del self.sql_games[:]
+        self.dbcon.commit()
+        self.sql_insert_time += time.time() - start
+        self.sql_rows_inserted += len(self.sql_rows)
+        del self.sql_rows[:]
         
-        #print sql
-        self.db.execute(sql)
+    def sql_insert_stats(self):
+        rate = self.sql_rows_inserted / self.sql_insert_time if self.sql_insert_time > 0 else 0
+        return 'Inserted {0} rows in {1:.2f} seconds ({2:.0f} rows/sec), then built the indexes in {3:.2f} seconds'.format(self.sql_rows_inserted, self.sql_insert_time, rate, self.sql_index_time)
         
-    def get_sql_values(self, instance):
-        cols = []
-        for i in range(len(self.features)):
-            if self.features[i].values == 'TEXT':
-                cols.append("'{0}',".format(instance[i]))
-            else:
-                cols.append('{0},'.format(instance[i]))
-        cols.append("'{0}',".format(instance[-2]))
-        cols.append('{0}'.format(instance[-1]))
-        #cols.append('{0},'.format(instance[-2]))
-        #cols.append('{0}'.format(instance[-1]))
-        return cols
+    # Checks if a log is already in the db, extracted from the same version of the log by the same version of the code
+    def has_log(self, path, size, mtime):
+        entry = self.logs.get(path)
+        return entry is not None and entry[1:] == (size, mtime, self.version)
+        
+    # Records the game that was just flushed as coming from a log (or from nowhere, for replayed games). When
+    # incremental, the game replaces any rows already in the db for it (or for the log), and is committed on its own.
+    def game_processed(self, path, size, mtime):
+        if not self.sql:
+            return
+        if self.incremental:
+            self.remove_game(self.game_id)
+            if path in self.logs:
+                self.remove_game(self.logs[path][0])
+        self.sql_games.append((self.game_id, path, size, mtime, self.version))
+        self.game_ids.add(self.game_id)
+        if path is not None:
+            self.logs[path] = (self.game_id, size, mtime, self.version)
+        if self.incremental:
+            self.insert_sql_rows()
+            
+    # Removes the rows of a log that no longer parses from an incremental db
+    def log_failed(self, path):
+        if self.sql and self.incremental and path in self.logs:
+            self.remove_game(self.logs.pop(path)[0])
+            self.dbcon.commit()
+            
+    def remove_game(self, game_id):
+        if game_id in self.game_ids:
+            self.db.execute("DELETE FROM instances WHERE game_id = ?;", (int(game_id, 16),))
+            self.db.execute("DELETE FROM games WHERE game_id = ?;", (game_id,))
+            self.game_ids.discard(game_id)
         
     def parsing_line_handler(self, game, line_num, line):
         #print 'Parsing line: {0}'.format(line)
         pass
         
     def turn_complete_handler(self, game):
-        # Each card bought is a separate instance
+        # Hack in some code to only log instances for winning players
+        if ignore_losers and game.get_player(game.possessor) is not game.get_player(game.winner):
+            return
+        # Extract the information from the current game state once, then log an instance for each card bought
+        self.plan.extract_turn(game)
         if game.get_cards_bought():
             for card in game.get_cards_bought():
                 self.write_instance(game, card)
         else:
             self.write_instance(game, 'None')
         
+    # Logs an instance for a card bought, once the plan has extracted the features for the turn
     def write_instance(self, game, card):
-        # Hack in some code to only log instances for winning players
-        if ignore_losers and game.get_player(game.possessor) is not game.get_player(game.winner):
-            return
-        # Extract the information from the current game state and log it
-        instance = [feature.extract(game, card) for feature in self.features]
+        instance = self.plan.extract_card(card)
         instance.append(clean(card))
         instance.append(game.calc_output_weight(game.possessor)) # Using game.possessor will use either the possessing player, or the current player if there isn't a possessor.
         #instance.append(game.get_player(game.possessor).get_final_score())
@@ -308,10 +572,15 @@ class FeatureExtractor:
             self.instances += 1
             if self.arff:
                 self.file.write(','.join([str(feature) for feature in instance]) + '\n')
-            if self.sql:
-                self.add_sql_instance(instance)
-                #if self.instances % 100 == 0:
-                #    self.dbcon.commit()
+        if self.columns:
+            self.columns.add_rows(self.pending_instances)
+        if self.sql:
+            # The use and randomizer go in the last two columns
+            split = get_game_split(self.game_id, self.split)
+            self.sql_rows.extend([instance + split for instance in self.pending_instances])
+            # When incremental, the rows are inserted once the game is recorded
+            if len(self.sql_rows) >= self.sql_batch_size and not self.incremental:
+                self.insert_sql_rows()
         del self.pending_instances[:]
         
     def unhandled_line_handler(self, game, line_num, line):
@@ -328,74 +597,343 @@ class FeatureExtractor:
         pass
             
     def parse_complete_handler(self, game):
+        # Games parsed in a worker process have their id set before this is called
+        if game is not None:
+            self.game_id = game.game_id
         self.files += 1
         self.flush_instances()
         
     def parse_aborted_handler(self, game, line_num, error):
-        self.ignored_files += 1
+        if error == filtered_abort:
+            self.filtered_files += 1
+        else:
+            self.ignored_files += 1
         del self.pending_instances[:]
         
-subdir_path = os.path.join('{0:04}', '{1:02}', '{2:02}')
-log_path = 'games'
-ignore_folder = 'ignored'
-ignore_path = os.path.join(log_path, ignore_folder)
-error_folder = 'error'
-error_path = os.path.join(log_path, error_folder)
-unhandled_folder = 'unhandled'
-unhandled_path = os.path.join(log_path, unhandled_folder)
-if not os.path.exists(ignore_path):
-    os.makedirs(ignore_path)
-if not os.path.exists(error_path):
-    os.makedirs(error_path)
-if not os.path.exists(unhandled_path):
-    os.makedirs(unhandled_path)
-    
-def rename(filename, src, dest):
-    old = os.path.join(src, filename)
-    new = os.path.join(dest, filename)
-    if old != new:
-        print 'Moving {0} from\n {1}\n to\n {2}'.format(filename, src, dest)
-        if not os.path.exists(dest):
-            os.makedirs(dest)
-        try:
-            os.rename(old, new)
-        except OSError:
-            # The file must have already existed, so try to delete the old file and replace it
-            if os.path.exists(new):
-                os.remove(new)
-            # Now try again
-            os.rename(old, new)
+# Processing Manifest
+# -------------------
+# Records how each log parsed, keyed by its path, so the logs never have to be moved around to keep track of it.
+# An entry only counts for the same size and modification time of the log, and the same version of the parser, so
+# logs are processed again once they change or the parser does.
+# Logs that parsed are processed on every run (features.sql3 is rebuilt from scratch each time, unless -incremental is
+# given, which skips the logs already in it), but logs that were ignored, errored or had unhandled lines are skipped
+# until they are asked for with -i, -e or -u.
+
+ok_status = 'ok'
+unhandled_status = 'unhandled'
+error_status = 'error'
+ignored_status = 'ignored'
+
+# Returns the status that is recorded for the result of parsing a log
+def get_status(error):
+    if error > 0:
+        return unhandled_status
+    elif error == assertion_abort or error == invalid_end_state_abort:
+        return error_status
+    elif error < 0:
+        return ignored_status
+    else:
+        return ok_status
+        
+# The parser version is a hash of the parser and game code, so that any change to either counts as a new version
+def get_parser_version():
+    version = hashlib.md5()
+    for module in [isotropic, dominion]:
+        with open(os.path.splitext(module.__file__)[0] + '.py', 'rb') as f:
+            version.update(f.read())
+    return version.hexdigest()
     
+# The features version covers the feature extraction code (and any other settings passed in) as well as the parser
+def get_features_version(settings=''):
+    version = hashlib.md5(get_parser_version() + settings)
+    with open(os.path.splitext(__file__)[0] + '.py', 'rb') as f:
+        version.update(f.read())
+    return version.hexdigest()
+    
+class ProcessingManifest:
+
+    def __init__(self, filename):
+        self.parser_version = get_parser_version()
+        self.dbcon = sqlite3.connect(filename)
+        self.db = self.dbcon.cursor()
+        sql = """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INT,
+                mtime REAL,
+                status TEXT,
+                abort_code INT,
+                reason TEXT,
+                parser_version TEXT
+            );
+        """
+        self.db.execute(sql)
+        sql = "CREATE INDEX IF NOT EXISTS status_index ON files (status);"
+        self.db.execute(sql)
+        # Load the entries up front, as every log is looked up
+        self.entries = {}
+        for path, size, mtime, status, parser_version in self.db.execute("SELECT path, size, mtime, status, parser_version FROM files;"):
+            self.entries[path] = (size, mtime, status, parser_version)
+        # Logs that were processed during this run
+        self.processed = set()
+        self.pending_commits = 0
+        
+    # Returns the status a log was last processed with, or None if it hasn't been processed in its current state (or by this parser)
+    def get_status(self, path, size, mtime):
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != size or entry[1] != mtime or entry[3] != self.parser_version:
+            return None
+        return entry[2]
+        
+    # Returns the paths of the logs that were last processed with a status
+    def get_paths(self, status):
+        return [path for (path,) in self.db.execute("SELECT path FROM files WHERE status = ? ORDER BY path DESC;", (status,)).fetchall()]
+        
+    def record(self, path, size, mtime, error, reason):
+        status = get_status(error)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?);", (path, size, mtime, status, error, reason if error < 0 else None, self.parser_version))
+        self.entries[path] = (size, mtime, status, self.parser_version)
+        self.processed.add(path)
+        self.pending_commits += 1
+        if self.pending_commits >= 1000:
+            self.dbcon.commit()
+            self.pending_commits = 0
+            
+    def remove(self, path):
+        self.db.execute("DELETE FROM files WHERE path = ?;", (path,))
+        self.entries.pop(path, None)
+        self.processed.add(path)
+        
+    def close(self):
+        self.dbcon.commit()
+        self.dbcon.close()
+        
+log_path = 'games'
+manifest_path = 'manifest.sql3'
+# Daily archives, as downloaded by log_downloader.py (before and after extraction)
+archive_paths = ['gamelogs', os.path.join('gamelogs', 'extracted')]
+archive_regex = re.compile(r'\d+\-\d+\-\d+\.tar\.bz2$')
+# Parsed games, recorded with -events and replayed with -replay
+event_store_path = 'games.events'
+
+# Checks if a log (or an archive member) should be processed on this run, based on how it was last processed
+def should_process(path, size, mtime):
+    if path in manifest.processed:
+        return False
+    if features.incremental and features.has_log(path, size, mtime):
+        features.skipped_logs += 1
+        return False
+    status = manifest.get_status(path, size, mtime)
+    if status is None or status == ok_status:
+        return True
+    elif status == ignored_status:
+        return process_ignored
+    elif status == error_status:
+        return process_errors
+    else:
+        return process_unhandled
+        
 def process_file(dirname, filename):
-    match = re.match(r'game-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})-(?P<hour>\d{2})(?P<minute>\d{2})(?P<second>\d{2})-[\d\w]{8}\.html', filename)
-    if match:
-        year = int(match.group('year'))
-        month = int(match.group('month'))
-        day = int(match.group('day'))
-        hour = int(match.group('hour'))
-        minute = int(match.group('minute'))
-        second = int(match.group('second'))
     file = os.path.join(dirname, filename)
     print 'Parsing: {0}'.format(file)
     error = parser.read(file)
+    file_processed(dirname, filename, error, abort_string(error))
+    
+# Records how a log parsed in the manifest. This is split out of process_file so that logs parsed in
+# a worker process (with -j) are recorded the same way they would be in a serial run.
+def file_processed(dirname, filename, error, reason):
+    file = os.path.join(dirname, filename)
     if error > 0:
         print '{0} unhandled lines in file: {1}'.format(error, file)
-        rename(filename, dirname, unhandled_path)
     elif error < 0:
-        print 'Aborting: {0}'.format(abort_string(error))
-        if error == assertion_abort or error == invalid_end_state_abort:
-            rename(filename, dirname, error_path)
-        elif error == incomplete_file_abort:
-            # Delete the file, as reextracting it will put the complete file here.
-            os.remove(file)
-        else:
-            rename(filename, dirname, os.path.join(ignore_path, subdir_path.format(year, month, day)))
+        print 'Aborting: {0}'.format(reason)
+    if error == incomplete_file_abort:
+        # Delete the file, as reextracting it will put the complete file here.
+        os.remove(file)
+        manifest.remove(file)
+    elif error == filtered_abort:
+        # Whether a game is filtered out depends on the filter given for this run, so it isn't recorded
+        pass
+    else:
+        stat = os.stat(file)
+        manifest.record(file, stat.st_size, stat.st_mtime, error, reason)
+        log_processed(file, stat.st_size, stat.st_mtime, error)
+        
+# Records a log in the features db, once its instances have been flushed
+def log_processed(path, size, mtime, error):
+    if error == 0:
+        features.game_processed(path, size, mtime)
     else:
-        rename(filename, dirname, os.path.join(log_path, subdir_path.format(year, month, day)))
+        features.log_failed(path)
     
-if __name__ == '__main__':
-    parser = IsotropicParser()
-    features = FeatureExtractor('features.arff', '-arff' in sys.argv, '-no-sql' not in sys.argv)
+# Yields the (dirname, filename) of every log in a folder that should be processed on this run, in the order they should be processed.
+def log_files(path):
+    for dirname, dirnames, filenames in os.walk(path):
+        # Filter out everything but a single day
+        #if dirname == os.path.join(log_path, '2013', '03', '10'):
+        for filename in filenames:
+            file = os.path.join(dirname, filename)
+            stat = os.stat(file)
+            if should_process(file, stat.st_size, stat.st_mtime):
+                yield dirname, filename
+        # Walk over the directories in reverse order (this will search 2013 before 2012, 31 before 01, etc. This makes sure it starts the feature extraction with the most recent data.)
+        dirnames.sort(reverse=True)
+        
+# Yields the (dirname, filename) of the logs that were last processed with a status (and haven't been processed yet on this run)
+def manifest_files(status):
+    for file in manifest.get_paths(status):
+        if file not in manifest.processed and os.path.isfile(file):
+            yield os.path.split(file)
+    
+# Yields the (member, stream) of every game log in a daily .tar.bz2 archive that should be processed on this run, in archive order.
+def archive_logs(filename):
+    # Stream the archive, as the members are only read once and in order
+    archive = tarfile.open(filename, 'r|bz2')
+    try:
+        for member in archive:
+            name = os.path.basename(member.name)
+            if not member.isfile() or not log_filename_regex.match(name):
+                continue
+            if not should_process(archive_log_path(filename, member.name), member.size, member.mtime):
+                continue
+            stream = archive.extractfile(member)
+            yield member, stream
+            stream.close()
+    finally:
+        archive.close()
+        
+# The path that a log in an archive is recorded under in the manifest
+def archive_log_path(filename, name):
+    return '{0}:{1}'.format(filename, name)
+    
+# Parses every game log in a daily .tar.bz2 archive in memory, without extracting it.
+def process_archive(filename):
+    print 'Reading archive: {0}'.format(filename)
+    for member, stream in archive_logs(filename):
+        print 'Parsing: {0}'.format(archive_log_path(filename, member.name))
+        error = parser.read(os.path.basename(member.name), stream)
+        archive_log_processed(filename, member, error, abort_string(error))
+    
+def archive_log_processed(filename, member, error, reason):
+    path = archive_log_path(filename, member.name)
+    if error > 0:
+        print '{0} unhandled lines in file: {1}'.format(error, path)
+    elif error < 0:
+        print 'Aborting: {0}'.format(reason)
+    if error != filtered_abort:
+        manifest.record(path, member.size, member.mtime, error, reason)
+        log_processed(path, member.size, member.mtime, error)
+    
+# Parallel extraction (-j N)
+# Each worker process has its own parser and feature extractor, and sends back the outcome and the
+# instances for each log it parses. Only the main process writes to features.sql3 and moves logs around,
+# so the database and the folders end up the same as with a serial run (only the row order can differ,
+# unless -d is given).
+worker_parser = None
+worker_features = None
+worker_instances = []
+# The encoded events of the last game a worker parsed (when recording them)
+worker_game_events = [None]
+# The id of the last game a worker parsed
+worker_game_id = [None]
+worker_card_ids = None
+# How many logs are handed to the pool at a time
+parallel_batch_size = 256
+
+def init_worker(only_winners, use_line_templates, record_events, game_filter):
+    global worker_parser, worker_features, worker_card_ids, ignore_losers
+    # Leave Ctrl-C to the main process, which will shut the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Set here as well, as the workers won't have run __main__ on platforms that don't fork
+    ignore_losers = only_winners
+    worker_features = FeatureExtractor(None, False, False)
+    worker_parser = IsotropicParser()
+    worker_parser.use_line_templates = use_line_templates
+    worker_parser.game_filter = game_filter
+    if record_events:
+        worker_parser.game_class = RecordingGame
+        card_table = get_card_table()
+        worker_card_ids = dict((card_table[i], i) for i in range(len(card_table)))
+    register_handlers(worker_parser, worker_features)
+    # Hold on to the instances instead of writing them out
+    worker_parser.register_handler(parse_complete_event, worker_parse_complete_handler)
+    
+def worker_parse_complete_handler(game):
+    worker_instances.extend(worker_features.pending_instances)
+    del worker_features.pending_instances[:]
+    worker_game_id[0] = game.game_id
+    if worker_card_ids is not None:
+        worker_game_events[0] = encode_game(game, worker_card_ids)
+    
+# A job is either a log file (dirname, filename, None), or a log read out of an archive (archive, name, data).
+def parse_job(job):
+    dirname, filename, data = job
+    del worker_instances[:]
+    worker_game_events[0] = None
+    worker_game_id[0] = None
+    before = worker_parser.regex_attempt_counts()
+    if data is None:
+        error = worker_parser.read(os.path.join(dirname, filename))
+    else:
+        error = worker_parser.read(os.path.basename(filename), StringIO(data))
+    attempts = [after - start for after, start in zip(worker_parser.regex_attempt_counts(), before)]
+    return dirname, filename, error, abort_string(error), list(worker_instances), attempts, worker_game_events[0], worker_game_id[0]
+    
+# Hands the jobs to the pool in batches (so a whole archive isn't read into memory at once), and records
+# the results in the main process as they come back. With ordered set, the results are recorded in job
+# order, which reproduces the rows of a serial run exactly.
+def process_jobs(pool, jobs, processed, ordered):
+    jobs = iter(jobs)
+    while True:
+        batch = list(itertools.islice(jobs, parallel_batch_size))
+        if not batch:
+            break
+        if ordered:
+            results = pool.imap(parse_job, batch)
+        else:
+            results = pool.imap_unordered(parse_job, batch)
+        for dirname, filename, error, reason, instances, attempts, game_events, game_id in results:
+            if error == 0:
+                if event_store:
+                    event_store.write_encoded_game(game_events)
+                features.game_id = game_id
+                features.pending_instances.extend(instances)
+                features.parse_complete_handler(None)
+            else:
+                features.parse_aborted_handler(None, None, error)
+            parser.add_regex_attempt_counts(attempts)
+            processed(dirname, filename, error, reason)
+            
+def process_files_parallel(pool, files, ordered):
+    def processed(dirname, filename, error, reason):
+        print 'Parsing: {0}'.format(os.path.join(dirname, filename))
+        file_processed(dirname, filename, error, reason)
+    process_jobs(pool, ((dirname, filename, None) for dirname, filename in files), processed, ordered)
+    
+def process_archive_parallel(pool, filename, ordered):
+    print 'Reading archive: {0}'.format(filename)
+    # The members of the logs that are out in the pool, by name
+    members = {}
+    def jobs():
+        for member, stream in archive_logs(filename):
+            members[member.name] = member
+            yield filename, member.name, stream.read()
+    def processed(archive, name, error, reason):
+        print 'Parsing: {0}'.format(archive_log_path(archive, name))
+        archive_log_processed(archive, members.pop(name), error, reason)
+    process_jobs(pool, jobs(), processed, ordered)
+    
+# Writes each game that parsed completely to the event store (-events) before extracting its features
+def record_game(game):
+    event_store.write_game(game)
+    features.parse_complete_handler(game)
+    
+# Records each replayed game in the features db (replayed games don't come from a log)
+def replay_complete(game):
+    features.parse_complete_handler(game)
+    features.game_processed(None, None, None)
+    
+def register_handlers(parser, features):
     parser.register_handler(parsing_line_event, features.parsing_line_handler)
     parser.register_handler(turn_complete_event, features.turn_complete_handler)
     parser.register_handler(unhandled_line_event, features.unhandled_line_handler)
@@ -404,78 +942,194 @@ if __name__ == '__main__':
     parser.register_handler(parse_complete_event, features.parse_complete_handler)
     parser.register_handler(parse_aborted_event, features.parse_aborted_handler)
     
+# Returns the value following a command line flag, or None if the flag wasn't given
+def get_arg(flag):
+    if flag in sys.argv:
+        return sys.argv[sys.argv.index(flag) + 1]
+    return None
+    
+def get_card_args(flag):
+    arg = get_arg(flag)
+    if arg is None:
+        return None
+    cards = []
+    for card in arg.split(','):
+        clean = clean_card(card.strip())
+        if not clean:
+            print 'Not a card: {0}'.format(card)
+            sys.exit(1)
+        cards.append(clean)
+    return cards
+    
+def get_date_arg(flag):
+    arg = get_arg(flag)
+    if arg is None:
+        return None
+    return datetime.datetime.strptime(arg, '%Y-%m-%d').date()
+    
+# Returns the values following every use of a command line flag
+def get_args(flag):
+    return [sys.argv[i + 1] for i in range(len(sys.argv) - 1) if sys.argv[i] == flag]
+    
+# Returns the default sqlite PRAGMAs, overridden by the ones given on the command line
+def get_sql_pragmas(defaults):
+    pragmas = list(defaults)
+    for arg in get_args('-pragma'):
+        name, value = arg.split('=', 1)
+        pragmas = [(pragma, pragma_value) for (pragma, pragma_value) in pragmas if pragma != name] + [(name, value)]
+    return pragmas
+    
+# Returns the split given on the command line (as fractions for training, validation and testing), or the default split
+def get_split():
+    arg = get_arg('-split')
+    if arg is None:
+        return default_split
+    fractions = [float(fraction) for fraction in arg.split(',')]
+    if len(fractions) != len(default_split) or min(fractions) < 0 or sum(fractions) <= 0:
+        print 'The split should be {0} fractions: {1}'.format(len(default_split), ','.join(use for (use, fraction) in default_split))
+        sys.exit(1)
+    return [(default_split[i][0], fractions[i]) for i in range(len(default_split))]
+    
+# Builds the game filter from the command line, or returns None if there's nothing to filter on
+def get_game_filter():
+    num_players = get_arg('-players')
+    if num_players is not None:
+        num_players = [int(n) for n in num_players.split(',')]
+    game_filter = GameFilter(num_players, get_card_args('-require'), get_card_args('-forbid'), get_date_arg('-from'), get_date_arg('-to'))
+    if not (game_filter.num_players or game_filter.required_cards or game_filter.forbidden_cards or game_filter.start_date or game_filter.end_date):
+        return None
+    return game_filter
+    
+if __name__ == '__main__':
+    parser = IsotropicParser()
+    parser.use_line_templates = '-t' in sys.argv
+    sql_batch_size = int(get_arg('-sql-batch') or 1000)
+    incremental = '-incremental' in sys.argv
+    features = FeatureExtractor('features.arff', '-arff' in sys.argv, '-no-sql' not in sys.argv, get_sql_pragmas(incremental_sql_pragmas if incremental else default_sql_pragmas), sql_batch_size, get_arg('-columns'), incremental, get_split())
+    register_handlers(parser, features)
+    
     process_ignored = '-i' in sys.argv
     process_unhandled = '-u' in sys.argv
     process_errors = '-e' in sys.argv
     process_main = '-n' not in sys.argv
+    process_archives = '-a' in sys.argv
     ignore_losers = '-w' in sys.argv
+    jobs = int(get_arg('-j')) if '-j' in sys.argv else 1
+    ordered = '-d' in sys.argv
+    replay_events = '-replay' in sys.argv
+    dominion.validate_deck_stats = '-check-stats' in sys.argv
+    parser.game_filter = get_game_filter()
     if '-h' in sys.argv:
         print 'Command line args:'
-        print ' -i: Reprocess ignored directory'
-        print ' -u: Reprocess unhandled directory'
-        print ' -e: Reprocess error directory'
+        print ' -i: Reprocess the logs that were ignored'
+        print ' -u: Reprocess the logs that had unhandled lines'
+        print ' -e: Reprocess the logs that errored'
         print ' -n: Don\'t process the main directory'
+        print ' -a: Process the daily .tar.bz2 archives in {0} without extracting them'.format(' and '.join(archive_paths))
         print ' -w: Only log instances of winners'
+        print ' -t: Resolve log lines by their template (pays off when many regexes are registered)'
+        print ' -j N: Parse with N worker processes (0 for one per core)'
+        print ' -d: With -j, write the instances in the same order as a serial run'
+        print ' -players N[,N...]: Only process games with these numbers of players'
+        print ' -require Card[,Card...]: Only process games with all of these cards in the supply'
+        print ' -forbid Card[,Card...]: Only process games with none of these cards in the supply'
+        print ' -from YYYY-MM-DD, -to YYYY-MM-DD: Only process games from this range of dates'
+        print ' -check-stats: Check the deck stats kept as cards are gained and trashed against the whole deck each turn'
+        print ' -events: Record the parsed games to {0}'.format(event_store_path)
+        print ' -replay: Extract features from the games recorded in {0} instead of parsing the logs'.format(event_store_path)
         #print ' -sql: Export to sqlite db (default)'
         print ' -no-sql: Don\'t export to sqlite db'
+        print ' -pragma name=value: Set a sqlite PRAGMA on the features db (can be given more than once, defaults: {0})'.format(', '.join('{0}={1}'.format(name, value) for (name, value) in default_sql_pragmas))
+        print ' -incremental: Keep the games already in the sqlite db, and only add (or replace) the logs that are new or changed, one game per transaction'
+        print '  (with -columns, the column store is rewritten from every game in the db at the end of the run)'
+        print ' -split t,v,s: The fractions of the games whose instances are used for training, validation and testing (default {0})'.format(','.join(str(fraction) for (use, fraction) in default_split))
+        print ' -sql-batch n: Insert rows into the db n at a time, one transaction per batch (default 1000)'
+        print ' -columns dir: Also export a column store (float32 columns for numpy.memmap, grouped by card bought) to dir'
         print ' -arff: Export an arff file'
         #print ' -no-arff: Don\'t export an arff file (default)'
         exit(0)
         
+    # Record the games as they are parsed (replaying doesn't parse anything to record)
+    event_store = None
+    if '-events' in sys.argv and not replay_events:
+        event_store = EventStoreWriter(event_store_path)
+        parser.game_class = RecordingGame
+        parser.register_handler(parse_complete_event, record_game)
+        
+    manifest = ProcessingManifest(manifest_path)
+    
     # Start our overall timer
     start = time.time()
+    pool = None
     try:
         
+        if jobs != 1:
+            pool = multiprocessing.Pool(jobs if jobs > 0 else None, init_worker, (ignore_losers, parser.use_line_templates, event_store is not None, parser.game_filter))
+            def process_files(files):
+                process_files_parallel(pool, files, ordered)
+            def process_archive_file(filename):
+                process_archive_parallel(pool, filename, ordered)
+        else:
+            def process_files(files):
+                for dirname, filename in files:
+                    process_file(dirname, filename)
+            process_archive_file = process_archive
+        
+        # Replay the recorded games instead of parsing anything
+        if replay_events:
+            replayer = GameReplayer()
+            register_handlers(replayer, features)
+            replayer.register_handler(parse_complete_event, replay_complete)
+            replayer.replay_store(event_store_path)
+            process_ignored = process_errors = process_unhandled = process_archives = process_main = False
+        
         # Process ignored files
         if process_ignored:
-            for dirname, dirnames, filenames in os.walk(ignore_path):
-                for filename in filenames:
-                    process_file(dirname, filename)
-                # Walk over the directories in reverse order (in case they're nested)
-                dirnames.sort(reverse=True)
+            process_files(manifest_files(ignored_status))
         
         # Process errored files
         if process_errors:
-            for dirname, dirnames, filenames in os.walk(error_path):
-                for filename in filenames:
-                    process_file(dirname, filename)
-                # Walk over the directories in reverse order (in case they're nested)
-                dirnames.sort(reverse=True)
+            process_files(manifest_files(error_status))
         
         # Process unhandled files
         if process_unhandled:
-            for dirname, dirnames, filenames in os.walk(unhandled_path):
-                for filename in filenames:
-                    process_file(dirname, filename)
-                # Walk over the directories in reverse order (in case they're nested)
-                dirnames.sort(reverse=True)
+            process_files(manifest_files(unhandled_status))
+        
+        # Process the logs straight out of the daily archives
+        if process_archives:
+            for archive_path in archive_paths:
+                if os.path.exists(archive_path):
+                    # Most recent archives first, like the main directory
+                    for filename in sorted(os.listdir(archive_path), reverse=True):
+                        if archive_regex.match(filename):
+                            process_archive_file(os.path.join(archive_path, filename))
         
         # Iterate over all files in the log path
         # http://stackoverflow.com/questions/120656/directory-listing-in-python
         if process_main:
-            for dirname, dirnames, filenames in os.walk(log_path):
-                # Filter out everything but a single day
-                #if dirname == os.path.join(log_path, '2013', '03', '10'):
-                for filename in filenames:
-                    process_file(dirname, filename)
-                # Don't walk over the other paths, as they are iterated separately.
-                # This assumes that these folders are all subfolders of the main log folder, which should currently be the case.
-                if ignore_folder in dirnames:
-                    dirnames.remove(ignore_folder)
-                if error_folder in dirnames:
-                    dirnames.remove(error_folder)
-                if unhandled_folder in dirnames:
-                    dirnames.remove(unhandled_folder)
-                # Walk over the directories in reverse order (this will search 2013 before 2012, 31 before 01, etc. This makes sure it starts the feature extraction with the most recent data.)
-                dirnames.sort(reverse=True)
+            process_files(log_files(log_path))
     except KeyboardInterrupt:
         print 'Bailing out due to Ctrl-C'
     except Exception, e:
         print 'Catching "{0}" on line {1}'.format(e, sys.exc_info()[-1].tb_lineno)
         ex_type, ex, tb = sys.exc_info()
         traceback.print_tb(tb)
-        
+    
+    if pool:
+        pool.terminate()
+        pool.join()
     features.close()
+    manifest.close()
+    if event_store:
+        event_store.close()
+        print 'Recorded {0} games to {1} ({2} couldn\'t be recorded).'.format(event_store.games, event_store_path, event_store.skipped_games)
     print 'Finished building features. (Took {0} minutes)'.format((time.time() - start) / 60.0)
     print 'Built {0} instances from {1} files.'.format(features.instances, features.files)
-    print 'Ignored {0} files.'.format(features.ignored_files)
\ No newline at end of file
+    if features.sql:
+        print features.sql_insert_stats()
+    if features.incremental:
+        print 'Skipped {0} logs that were already in the db.'.format(features.skipped_logs)
+    print 'Ignored {0} files.'.format(features.ignored_files)
+    if parser.game_filter:
+        print 'Filtered out {0} files.'.format(features.filtered_files)
+    print parser.regex_attempt_stats()
\ No newline at end of file
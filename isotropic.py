@@ -1,6 +1,9 @@
 from dominion import *
 import re
+import sre_parse
+import sre_compile
 import os.path
+import datetime
 
 # General Purpose
 
@@ -115,6 +118,24 @@ outpost_turn_header_regex = re.compile('\\s*<img src="http://www\\.gravatar\\.co
 # how the game state should be changed.
 
 game_log_regexes = []
+# The regex strings (without the prefix) for each entry in game_log_regexes, used to build the dispatch index
+game_log_regex_strings = []
+# The cards tagged on each entry in game_log_regexes (None if it isn't card specific)
+game_log_regex_cards = []
+# Every card that is tagged on some regex
+game_log_tagged_cards = set()
+# Dispatch index over game_log_regexes (see GameRegexIndex below)
+game_log_index = None
+# Dispatch indexes over just the regexes that are active for a kingdom, indexed by the tagged cards that are in the game
+kingdom_indexes = {}
+# Regex for the card <span>s that are abstracted out of line templates (see LineLexer below)
+template_span_regex = None
+# Game log regexes specialized for a set of players, indexed by the sorted player names (see PlayerRegexes below)
+player_regex_sets = {}
+# Number of games seen for each set of players that doesn't have specialized regexes yet
+player_set_games = {}
+# Parsed game log regexes with a player group, indexed by position
+player_regex_trees = {}
 
 # This is the default game log regex matcher, and should be sufficient for most cases.
 # It checks for groups named 'actions', 'buys', 'money', 'vp', and 'cost' (reduced cost - Bridge, Princess, Highway).
@@ -156,9 +177,25 @@ def gain_matcher(game, match, player = None):
 def nothing_matcher(game = None, match = None, player = None):
     pass
 
-def add_game_regex(regex_string, matcher = None):
+# cards: The cards that can cause this line to show up in a log. If none of them can be in the game, the regex is skipped.
+#  Leave this as None for regexes that could be triggered by many (or unknown) cards.
+def add_game_regex(regex_string, matcher = None, cards = None):
+    global game_log_index, template_span_regex
+    if cards:
+        for card in cards:
+            assert_card(card)
     regex = re.compile(prefix_piece + regex_string)
     game_log_regexes.append((regex, matcher if matcher else nothing_matcher))
+    game_log_regex_strings.append(regex_string)
+    game_log_regex_cards.append(frozenset(cards) if cards else None)
+    if cards:
+        game_log_tagged_cards.update(cards)
+    # The dispatch indexes are rebuilt the next time they are needed
+    game_log_index = None
+    kingdom_indexes.clear()
+    template_span_regex = None
+    player_regex_sets.clear()
+    player_regex_trees.clear()
     return regex
 
 # These are here to allow them to be used in callbacks
@@ -352,11 +389,11 @@ add_game_regex(r'(?P<player>.+) has no cards? to draw\.')
 
 # Swindler
 # Matches: ... <player> turns up a <card> and trashes is.
-add_game_regex(r'(?P<player>.+) turns up an? ' + card_regex_piece + r' and trashes it\.', trash_matcher)
+add_game_regex(r'(?P<player>.+) turns up an? ' + card_regex_piece + r' and trashes it\.', trash_matcher, cards=['Swindler'])
 # Matches: ... replacing <player>'s <old_card> with a <new_card>.
-add_game_regex(r"replacing (?P<player>.+)'s " + card_regex_piece_formatable.format('old_card') + r' with an? ' + card_regex_piece_formatable.format('new_card') + r'\.', lambda game, match, player: game.gain(match.group('new_card'), player))
+add_game_regex(r"replacing (?P<player>.+)'s " + card_regex_piece_formatable.format('old_card') + r' with an? ' + card_regex_piece_formatable.format('new_card') + r'\.', lambda game, match, player: game.gain(match.group('new_card'), player), cards=['Swindler'])
 # Matches: ... No replacement is available.
-add_game_regex(r'No replacement is available\.')
+add_game_regex(r'No replacement is available\.', cards=['Swindler'])
 
 # Fortune Teller - others?
 # Matches: <player> puts the <card> back onto the deck.
@@ -372,7 +409,7 @@ add_game_regex(r'putting (?:the )?' + card_list_regex_piece + r' into the hand\.
 
 # Talisman
 # Matches: ... gaining another <card>.
-add_game_regex(r'gaining another ' + card_regex_piece + r'\.', gain_matcher)
+add_game_regex(r'gaining another ' + card_regex_piece + r'\.', gain_matcher, cards=['Talisman'])
 
 # Jack of All Trades (and perhaps others? Sea Hag maybe?)
 # Matches: ... discarding the top card of the deck.
@@ -399,21 +436,21 @@ add_game_regex(r'trashing the ' + card_regex_piece + r' for \+\$(?P<money>\d+)\.
 # Matches: ... which is worth +$n [(n cards in deck, n cards in discard)].
 #  deck_size
 #  discard_size
-add_game_regex(r'which is worth \+\$(?P<money>\d+)(?: \((?:(?P<deck_size>\d+) cards?|nothing) in deck, (?:(?P<discard_size>\d+) cards?|nothing) in discard\))?\.', default_matcher)
+add_game_regex(r'which is worth \+\$(?P<money>\d+)(?: \((?:(?P<deck_size>\d+) cards?|nothing) in deck, (?:(?P<discard_size>\d+) cards?|nothing) in discard\))?\.', default_matcher, cards=['Bank', "Philosopher's Stone"])
 
 # Royal Seal
 # Matches: ... putting the <card> on top of the deck.
-add_game_regex(r'putting the ' + card_regex_piece + r' on top of the deck\.')
+add_game_regex(r'putting the ' + card_regex_piece + r' on top of the deck\.', cards=['Royal Seal'])
 
 # Tournament
 # Matches: ... <player> discards a <discard> and gains a <gain> on the deck.
 #  discard: Card discarded
 #  gain: Card gained
-add_game_regex(r'(?P<player>.+) discards an? ' + card_regex_piece_formatable.format('discard') + r' (?:and|but) gains (?:an? ' + card_regex_piece_formatable.format('gain') + r' on the deck|nothing)\.', lambda game, match, player: game.gain(match.group('gain'), player, 'prizes' if match.group('gain') != 'Duchy' else 'supply') if match.group('gain') else None)
+add_game_regex(r'(?P<player>.+) discards an? ' + card_regex_piece_formatable.format('discard') + r' (?:and|but) gains (?:an? ' + card_regex_piece_formatable.format('gain') + r' on the deck|nothing)\.', lambda game, match, player: game.gain(match.group('gain'), player, 'prizes' if match.group('gain') != 'Duchy' else 'supply') if match.group('gain') else None, cards=['Tournament'])
 
 # Bag of Gold
 # Matches: ... gaining a <card> on the deck.
-add_game_regex(r'gaining a ' + card_regex_piece + r' on the deck\.', gain_matcher)
+add_game_regex(r'gaining a ' + card_regex_piece + r' on the deck\.', gain_matcher, cards=['Bag of Gold'])
 
 # Only has 3 (n) cards (Goons, Militia, Ghost Ship, etc.)
 # Matches: ... <player> only has n cards.
@@ -421,24 +458,24 @@ add_game_regex(r'(?P<player>.+) only has (?:(?P<cards>\d+) cards?|nothing)\.')
 
 # Reducing all costs by n (Princess, Highway)
 # Matches: ... reducing all costs by $n.
-add_game_regex(r'reducing all costs by \$(?P<cost>\d+)\.', default_matcher)
+add_game_regex(r'reducing all costs by \$(?P<cost>\d+)\.', default_matcher, cards=['Princess', 'Highway'])
 
 # Bridge
 # Matches: ... getting +n buys, +$n, and reducing all costs by $n.
-add_game_regex(r'getting \+(?P<buys>\d+) buys?, \+\$(?P<money>\d+), and reducing all costs by \$(?P<cost>\d+)\.', default_matcher)
+add_game_regex(r'getting \+(?P<buys>\d+) buys?, \+\$(?P<money>\d+), and reducing all costs by \$(?P<cost>\d+)\.', default_matcher, cards=['Bridge'])
 
 # Black Market
 # Matches: ... drawing <cards> from the <span class=card-none>Black Market</span> deck.
-add_game_regex(r'drawing ' + card_list_regex_piece + r' from the <span class=card-none>Black Market</span> deck\.')
+add_game_regex(r'drawing ' + card_list_regex_piece + r' from the <span class=card-none>Black Market</span> deck\.', cards=['Black Market'])
 # Matches: ... returning <cards> to the bottom of the <span class=card-none>Black Market</span> deck.
-add_game_regex(r'returning ' + card_list_regex_piece + r' to the bottom of the <span class=card-none>Black Market</span> deck\.')
+add_game_regex(r'returning ' + card_list_regex_piece + r' to the bottom of the <span class=card-none>Black Market</span> deck\.', cards=['Black Market'])
 
 # Bishop
 # Matches: ... <player> trashes a <card> and gets +n {vp}.
 def bishop_trash_matcher(game, match, player):
     game.trash(match.group('card'), player)
     default_matcher(game, match, player)
-add_game_regex(r'(?P<player>.+) trashes an? ' + card_regex_piece + r' and gets \+(?P<vp>\d+) ' + victory_point_symbol + r'\.', bishop_trash_matcher)
+add_game_regex(r'(?P<player>.+) trashes an? ' + card_regex_piece + r' and gets \+(?P<vp>\d+) ' + victory_point_symbol + r'\.', bishop_trash_matcher, cards=['Bishop'])
 # Matches: ... <player> has no cards to trash/in hand.
 add_game_regex(r'(?P<player>.+) has no cards (?:to trash|in hand)\.')
 
@@ -448,59 +485,59 @@ def salvager_trash_regex(game, match, player):
     if match.group('card'):
         game.trash(match.group('card'), player)
     default_matcher(game, match, player)
-add_game_regex(r'(?:trashing an? ' + card_regex_piece + r' for \+\$(?P<money>\d+) and|having no card to trash, but getting) \+(?P<buys>\d+) buys?\.', salvager_trash_regex)
+add_game_regex(r'(?:trashing an? ' + card_regex_piece + r' for \+\$(?P<money>\d+) and|having no card to trash, but getting) \+(?P<buys>\d+) buys?\.', salvager_trash_regex, cards=['Salvager'])
 
 # Scrying Pool (discarding is built into the main discarder)
 # Matches: ... letting <player> keep a <card>.
-add_game_regex(r'letting (?P<player>.+) keep an? ' + card_regex_piece + r'\.')
+add_game_regex(r'letting (?P<player>.+) keep an? ' + card_regex_piece + r'\.', cards=['Scrying Pool'])
 # Matches: ... revealing nothing (no cards).
 add_game_regex(r'revealing nothing \(no cards\)\.')
 
 # Nomad Camp
 # Matches: ... putting it on the deck
-add_game_regex(r'putting it on the deck\.')
+add_game_regex(r'putting it on the deck\.', cards=['Nomad Camp'])
 
 # Walled Village
 # Matches: ... <player> returns a <card> to the top of the deck.
-add_game_regex(r'(?P<player>.+) returns a ' + card_regex_piece + r' to the top of the deck\.')
+add_game_regex(r'(?P<player>.+) returns a ' + card_regex_piece + r' to the top of the deck\.', cards=['Walled Village'])
 
 # Embargo
 # Matches: ... embargoing the <card>.
-add_game_regex(r'embargoing the ' + card_regex_piece + r'\.', lambda game, match, player: game.embargo(match.group('card')))
+add_game_regex(r'embargoing the ' + card_regex_piece + r'\.', lambda game, match, player: game.embargo(match.group('card')), cards=['Embargo'])
 
 # Alchemist
 # Matches: ... <player> returns <cards> to the top of the deck.
-add_game_regex(r'(?P<player>.+) returns ' + card_list_regex_piece + r' to the top of the deck\.')
+add_game_regex(r'(?P<player>.+) returns ' + card_list_regex_piece + r' to the top of the deck\.', cards=['Alchemist'])
 
 # Venture (revealing and discarding is handled by the basic handlers, as it gets broken into three lines - the reveal, the discard, and the play.)
 # Matches: revealing and playing <cards>.
-add_game_regex(r'revealing and playing ' + card_list_regex_piece + r'\.', lambda game, match, player: foreach_card(match.group('cards'), lambda card: game.play(card)))
+add_game_regex(r'revealing and playing ' + card_list_regex_piece + r'\.', lambda game, match, player: foreach_card(match.group('cards'), lambda card: game.play(card)), cards=['Venture'])
 
 # Native Village
 # Matches: ... drawing a card and placing it on the <span class=card-none>Native Village</span> mat.
-add_game_regex(r'drawing a card and placing it on the <span class=card-none>Native Village</span> mat\.')
+add_game_regex(r'drawing a card and placing it on the <span class=card-none>Native Village</span> mat\.', cards=['Native Village'])
 # Matches: ... picking up n cards from the <span class=card-none>Native Village</span> mat.
-add_game_regex(r'picking up (?:(?P<cards>\d+) cards?|nothing) from the <span class=card-none>Native Village</span> mat.')
+add_game_regex(r'picking up (?:(?P<cards>\d+) cards?|nothing) from the <span class=card-none>Native Village</span> mat.', cards=['Native Village'])
 # Matches: ... drawing nothing to put on the <span class=card-none>Native Village</span> mat.
-add_game_regex(r'drawing nothing to put on the <span class=card-none>Native Village</span> mat\.')
+add_game_regex(r'drawing nothing to put on the <span class=card-none>Native Village</span> mat\.', cards=['Native Village'])
 
 # Haven
 # Matches: ... setting aside a card.
-add_game_regex(r'setting aside a card\.')
+add_game_regex(r'setting aside a card\.', cards=['Haven'])
 # Matches: ... <player> picks up a card that was set aside.
-add_game_regex(r'(?P<player>.+) picks up a card that was set aside\.')
+add_game_regex(r'(?P<player>.+) picks up a card that was set aside\.', cards=['Haven'])
 
 # Vault
 # Matches: ... <player> doesn't discard any cards.
-add_game_regex(r"(?P<player>.+) doesn't discard any cards\.")
+add_game_regex(r"(?P<player>.+) doesn't discard any cards\.", cards=['Vault'])
 
 # Sea Hag
 # Matches: ... <player> draws and discards <cards>.
-add_game_regex(r'(?P<player>.+) draws and discards ' + card_list_regex_piece + r'\.')
+add_game_regex(r'(?P<player>.+) draws and discards ' + card_list_regex_piece + r'\.', cards=['Sea Hag'])
 
 # Scout
 # Matches: ... putting nothing into the hand.
-add_game_regex(r'putting nothing into the hand\.')
+add_game_regex(r'putting nothing into the hand\.', cards=['Scout'])
 
 # Develop / Transmute
 # Matches: ... but there's no $n[ or $n] card to gain.
@@ -508,58 +545,58 @@ add_game_regex(r"but there's no \$(?P<cost1>-?\d+)(?: " + potion_cost_symbol + r
 
 # Watchtower
 # Matches: ... putting the <card> on the deck.
-add_game_regex(r'putting the ' + card_regex_piece + r' on the deck\.')
+add_game_regex(r'putting the ' + card_regex_piece + r' on the deck\.', cards=['Watchtower'])
 
 # Lighthouse
 # Matches: ... <span class=card-duration>Lighthouse</span> provides <player> immunity to the attack.
-add_game_regex(r'<span class=card-duration>Lighthouse</span> provides (?P<player>.+) immunity to the attack\.')
+add_game_regex(r'<span class=card-duration>Lighthouse</span> provides (?P<player>.+) immunity to the attack\.', cards=['Lighthouse'])
 
 # Island
 # Matches: ... setting aside the <span class=card-victory-action>Island</span> with an? <card>.
-add_game_regex(r'setting aside the <span class=card-victory-action>Island</span> (?:with an? ' + card_regex_piece + r'|\(no other cards in hand\))\.')
+add_game_regex(r'setting aside the <span class=card-victory-action>Island</span> (?:with an? ' + card_regex_piece + r'|\(no other cards in hand\))\.', cards=['Island'])
 # Matches: ... setting aside nothing.
 add_game_regex(r'setting aside nothing\.')
 
 # Mint
 # Matches: ... revealing a <card> and gaining another one.
-add_game_regex(r'revealing an? ' + card_regex_piece + r' and gaining another one\.', gain_matcher)
+add_game_regex(r'revealing an? ' + card_regex_piece + r' and gaining another one\.', gain_matcher, cards=['Mint'])
 # Matches: ... but reveals no treasure card.
-add_game_regex(r'but reveals no treasure card\.')
+add_game_regex(r'but reveals no treasure card\.', cards=['Mint'])
 
 # Pearl Diver
 # Matches: ... but leaving the bottom card of the deck where it is.
-add_game_regex(r'but leaving the bottom card of the deck where it is\.')
+add_game_regex(r'but leaving the bottom card of the deck where it is\.', cards=['Pearl Diver'])
 # Matches: ... and moving the bottom card of the deck to the top.
-add_game_regex(r'and moving the bottom card of the deck to the top\.')
+add_game_regex(r'and moving the bottom card of the deck to the top\.', cards=['Pearl Diver'])
 # Matches: ... but has no cards to look at.
 add_game_regex(r'but has no cards to look at\.')
 
 # Thief
 # Matches: ... <other_player> trashes one of <player>'s <card>.
-add_game_regex(r"(?P<other_player>.+) trashes one of (?P<player>.+)'s " + card_regex_piece + r'\.', lambda game, match, player: game.trash(sanitize_card(match.group('card')), player))
+add_game_regex(r"(?P<other_player>.+) trashes one of (?P<player>.+)'s " + card_regex_piece + r'\.', lambda game, match, player: game.trash(sanitize_card(match.group('card')), player), cards=['Thief'])
 # Matches: ... <player> gains the trashed <card>.
-add_game_regex(r'(?P<player>.+) gains the trashed ' + card_regex_piece + r'\.', lambda game, match, player: game.gain(match.group('card'), player, 'trash'))
+add_game_regex(r'(?P<player>.+) gains the trashed ' + card_regex_piece + r'\.', lambda game, match, player: game.gain(match.group('card'), player, 'trash'), cards=['Thief'])
 
 # Trading Post
 # Matches: ... <player> trashes <cards>, gaining a <card> in hand.
 def trading_post_matcher(game, match, player):
     foreach_card(match.group('cards'), lambda card: game.trash(card, player))
     game.gain(match.group('card'), player)
-add_game_regex(r'(?P<player>.+) trashes ' + card_list_regex_piece + r', gaining a ' + card_regex_piece + r' in hand\.', trading_post_matcher)
+add_game_regex(r'(?P<player>.+) trashes ' + card_list_regex_piece + r', gaining a ' + card_regex_piece + r' in hand\.', trading_post_matcher, cards=['Trading Post'])
 
 # Young Witch
 # Matches: ... <player> reveals a Bane card (a <card>).
-add_game_regex(r'(?P<player>.+) reveals a Bane card \(an? ' + card_regex_piece + r'\)\.')
+add_game_regex(r'(?P<player>.+) reveals a Bane card \(an? ' + card_regex_piece + r'\)\.', cards=['Young Witch'])
 
 # Tactician
 # Matches: ... discarding the hand (n cards).
-add_game_regex(r'discarding the hand \((?P<cards>\d+) cards?\)\.')
+add_game_regex(r'discarding the hand \((?P<cards>\d+) cards?\)\.', cards=['Tactician'])
 # Matches: ... but has no cards to discard.
 add_game_regex(r'but has no cards to discard\.')
 
 # Tunnel
 # Matches: ... <player> reveal[ing|s] a <reveal> and gain[ing|s] a <gain>.
-add_game_regex(r'(?:(?P<player>.+) )?reveal(?:ing|s) an? ' + card_regex_piece_formatable.format('reveal') + r' and gain(?:ing|s) (?:an? ' + card_regex_piece + r'|nothing)\.', gain_matcher)
+add_game_regex(r'(?:(?P<player>.+) )?reveal(?:ing|s) an? ' + card_regex_piece_formatable.format('reveal') + r' and gain(?:ing|s) (?:an? ' + card_regex_piece + r'|nothing)\.', gain_matcher, cards=['Tunnel'])
 
 # Ambassador
 # Matches: ... returning n copies to the supply.
@@ -573,23 +610,23 @@ def ambassador_matcher(game, match, player):
             game.return_to_supply(card, player)
     else:
         game.return_to_supply(card, player)
-add_game_regex(r'returning (?P<copies>\d+) copies to the supply\.', ambassador_matcher)
+add_game_regex(r'returning (?P<copies>\d+) copies to the supply\.', ambassador_matcher, cards=['Ambassador'])
 # Matches: ... returning it to the supply.
-add_game_regex(r'returning it to the supply\.', ambassador_matcher)
+add_game_regex(r'returning it to the supply\.', ambassador_matcher, cards=['Ambassador'])
 # Matches: ... but has no card to reveal.
 add_game_regex(r'but has no card to reveal\.')
 # Matches: ... which can't be returned to the supply.
-add_game_regex(r"which can't be returned to the supply\.")
+add_game_regex(r"which can't be returned to the supply\.", cards=['Ambassador'])
 
 # Horse Traders
 # Matches: ... setting it aside.
-add_game_regex(r'setting it aside\.')
+add_game_regex(r'setting it aside\.', cards=['Horse Traders'])
 # Matches: ... <player> restores the <card> to the hand and draws n cards.
-add_game_regex(r'(?P<player>.+) restores the ' + card_regex_piece + r' to the hand and draws (?:(?P<cards>\d+) cards?|nothing)\.')
+add_game_regex(r'(?P<player>.+) restores the ' + card_regex_piece + r' to the hand and draws (?:(?P<cards>\d+) cards?|nothing)\.', cards=['Horse Traders'])
 
 # Oracle
 # Matches: ... <player> draws and reveals <cards>.
-add_game_regex(r'(?P<player>.+) draws and reveals ' + card_list_regex_piece + r'\.')
+add_game_regex(r'(?P<player>.+) draws and reveals ' + card_list_regex_piece + r'\.', cards=['Oracle'])
 # Matches: ... [<other_player> makes] <player> [puts them back on the deck/discards them].
 add_game_regex(r'(?:(?P<other_player>.+) makes )?(?P<player>.+) (?:puts? (?:them|it) back on the deck|discards? (?:them|it))\.')
 
@@ -599,13 +636,13 @@ add_game_regex(r'but has no action card to play with it\.')
 
 # King's Court
 # Matches: ... but plays no action with it.
-add_game_regex(r'but plays no action with it\.')
+add_game_regex(r'but plays no action with it\.', cards=["King's Court"])
 # Matches: ... <player> had played the <card> with a <span class=card-none>King's Court</span>.
-add_game_regex(r"(?P<player>.+) had played the " + card_regex_piece + r" with a <span class=card-none>(?:King's Court|Throne Room)</span>\.")
+add_game_regex(r"(?P<player>.+) had played the " + card_regex_piece + r" with a <span class=card-none>(?:King's Court|Throne Room)</span>\.", cards=["King's Court", 'Throne Room'])
 
 # Harvest
 # Matches: ... revealing and discarding <cards> and getting +$n.
-add_game_regex(r'revealing and discarding ' + card_list_regex_piece + r' and getting \+\$(?P<money>\d+)\.', default_matcher)
+add_game_regex(r'revealing and discarding ' + card_list_regex_piece + r' and getting \+\$(?P<money>\d+)\.', default_matcher, cards=['Harvest'])
 
 # Envoy
 # Matches: ... drawing <cards>.
@@ -623,49 +660,49 @@ add_game_regex(r'and discarding (?:them|it)\.')
 
 # Duchess
 # Matches: ... <player> draws a card and puts it back.
-add_game_regex(r'(?P<player>.+) draws a card and puts it back\.')
+add_game_regex(r'(?P<player>.+) draws a card and puts it back\.', cards=['Duchess'])
 
 # Trader
 # Matches: ... <player> reveals a <span class=card-reaction>Trader</span> to gain a <silver> instead of a <card>.
 #  The card needs to be returned to the supply, as it was already gained. The silver doesn't need to be gained now though, as it will be gained on the next line.
-add_game_regex(r'(?P<player>.+) reveals a <span class=card-reaction>Trader</span> to gain an? ' + card_regex_piece_formatable.format('silver') + r' instead of an? ' + card_regex_piece + r'\.', lambda game, match, player: game.return_to_supply(match.group('card'), player, trader=True))
+add_game_regex(r'(?P<player>.+) reveals a <span class=card-reaction>Trader</span> to gain an? ' + card_regex_piece_formatable.format('silver') + r' instead of an? ' + card_regex_piece + r'\.', lambda game, match, player: game.return_to_supply(match.group('card'), player, trader=True), cards=['Trader'])
 
 # Inn
 # Matches: ... shuffling <cards> into the draw pile.
-add_game_regex(r'shuffling ' + card_list_regex_piece + r' into the draw pile\.')
+add_game_regex(r'shuffling ' + card_list_regex_piece + r' into the draw pile\.', cards=['Inn'])
 # Matches: ... but the discard pile has no actions.
-add_game_regex(r'but the discard pile has no actions\.')
+add_game_regex(r'but the discard pile has no actions\.', cards=['Inn'])
 
 # Moneylender
 # Matches: ... trashing a <card> for +$n.
 def moneylender_matcher(game, match, player):
     game.trash(match.group('card'), player)
     default_matcher(game, match, player)
-add_game_regex(r'trashing an? ' + card_regex_piece + r' for \+\$(?P<money>\d+)\.', moneylender_matcher)
+add_game_regex(r'trashing an? ' + card_regex_piece + r' for \+\$(?P<money>\d+)\.', moneylender_matcher, cards=['Moneylender'])
 # Matches: ... but has no <span class=card-treasure>Copper</span> to trash.
-add_game_regex(r'but has no <span class=card-treasure>Copper</span> to trash\.')
+add_game_regex(r'but has no <span class=card-treasure>Copper</span> to trash\.', cards=['Moneylender'])
 
 # Cartographer
 # Matches: ... looking at the top n cards of the deck.
-add_game_regex(r'looking at the top (?:(?P<cards>\d+) cards?|nothing) of the deck\.')
+add_game_regex(r'looking at the top (?:(?P<cards>\d+) cards?|nothing) of the deck\.', cards=['Cartographer'])
 # Matches: ... discarding n cards and putting n cards back on the deck.
-add_game_regex(r'discarding (?:(?P<discards>\d+) cards?|nothing) and putting (?:(?P<put_back>\d+) cards?|nothing) back on the deck\.')
+add_game_regex(r'discarding (?:(?P<discards>\d+) cards?|nothing) and putting (?:(?P<put_back>\d+) cards?|nothing) back on the deck\.', cards=['Cartographer'])
 
 # Coppersmith
 # Matches: ... making each <span class=card-treasure>Copper</span> worth $2.
-add_game_regex(r'making each <span class=card-treasure>Copper</span> worth \$(?P<value>\d+)\.', lambda game, match, player: game.set_copper_value(int(match.group('value'))))
+add_game_regex(r'making each <span class=card-treasure>Copper</span> worth \$(?P<value>\d+)\.', lambda game, match, player: game.set_copper_value(int(match.group('value'))), cards=['Coppersmith'])
 
 # Contraband
 # Matches: ... <other_player> prohibits <player> from buying <card>.
-add_game_regex(r'(?P<other_player>.+) prohibits (?P<player>.+) from buying ' + card_regex_piece + r'\.', lambda game, match, player: game.prohibit(sanitize_card(match.group('card'))))
+add_game_regex(r'(?P<other_player>.+) prohibits (?P<player>.+) from buying ' + card_regex_piece + r'\.', lambda game, match, player: game.prohibit(sanitize_card(match.group('card'))), cards=['Contraband'])
 
 # Golem
 # Matches: ... playing no other action card.
-add_game_regex(r'playing no other action card\.')
+add_game_regex(r'playing no other action card\.', cards=['Golem'])
 
 # Possession
 # Matches: ... <player> discards the "trashed" cards? (<cards>).
-add_game_regex(r'(?P<player>.+) discards the "trashed" cards? \(' + card_list_regex_piece + r'\)\.', lambda game, match, player: foreach_card(match.group('cards'), lambda card: game.gain(card, player, 'trash', True)))
+add_game_regex(r'(?P<player>.+) discards the "trashed" cards? \(' + card_list_regex_piece + r'\)\.', lambda game, match, player: foreach_card(match.group('cards'), lambda card: game.gain(card, player, 'trash', True)), cards=['Possession'])
 
 # Spice Merchant
 # Matches: ... but trashes nothing.
@@ -673,11 +710,11 @@ add_game_regex(r'but trashes nothing\.')
 
 # Cutpurse
 # Matches: ... <player> reveals <cards> (no <card>). (<card> should be Copper)
-add_game_regex(r'(?P<player>.+) reveals ' + card_list_regex_piece + r' \(no ' + card_regex_piece + r'\)\.')
+add_game_regex(r'(?P<player>.+) reveals ' + card_list_regex_piece + r' \(no ' + card_regex_piece + r'\)\.', cards=['Cutpurse'])
 
 # Chancellor
 # Matches: ... [not] putting the deck into the discard pile.
-add_game_regex(r'(?:not )?putting the deck into the discard pile\.')
+add_game_regex(r'(?:not )?putting the deck into the discard pile\.', cards=['Chancellor'])
 
 # Remake
 # Matches: ... <player> has no card to trash.
@@ -685,65 +722,65 @@ add_game_regex(r'(?P<player>.+) has no card to trash\.')
 
 # Wishing Well
 # Matches: ... wishing for a <card> [and finding one|but finding a <found> instead].
-add_game_regex(r'wishing for an? ' + card_regex_piece + r' (?:and finding one|but finding an? ' + card_regex_piece_formatable.format('found') + r' instead)\.')
+add_game_regex(r'wishing for an? ' + card_regex_piece + r' (?:and finding one|but finding an? ' + card_regex_piece_formatable.format('found') + r' instead)\.', cards=['Wishing Well'])
 # Matches: ... <player> has no cards to wish for.
-add_game_regex(r'(?P<player>.+) has no cards to wish for\.')
+add_game_regex(r'(?P<player>.+) has no cards to wish for\.', cards=['Wishing Well'])
 
 # Saboteur
 # Matches: ... <player> reveals a <card> and trashes it.
-add_game_regex(r'(?P<player>.+) reveals an? ' + card_regex_piece + r' and trashes it\.', trash_matcher)
+add_game_regex(r'(?P<player>.+) reveals an? ' + card_regex_piece + r' and trashes it\.', trash_matcher, cards=['Saboteur'])
 # Matches: ... The <card> is trashed. (This has to use some reveal state to know which players card should be trashed.
-add_game_regex(r'The ' + card_regex_piece + r' is trashed\.', lambda game, match, player: game.trash(match.group('card'), game.get_last_reveal_player()))
+add_game_regex(r'The ' + card_regex_piece + r' is trashed\.', lambda game, match, player: game.trash(match.group('card'), game.get_last_reveal_player()), cards=['Saboteur'])
 # Matches: ... <player> gains a <card> to replace it.
-add_game_regex(r'(?P<player>.+) gains (?:an? ' + card_regex_piece + r'|nothing) to replace it\.', gain_matcher)
+add_game_regex(r'(?P<player>.+) gains (?:an? ' + card_regex_piece + r'|nothing) to replace it\.', gain_matcher, cards=['Saboteur'])
 # Matches: ... <player> reveals <cards> but has no card to sabotage.
-add_game_regex(r'(?P<player>.+) reveals ' + card_list_regex_piece + r' but has no card to sabotage\.')
+add_game_regex(r'(?P<player>.+) reveals ' + card_list_regex_piece + r' but has no card to sabotage\.', cards=['Saboteur'])
 
 # Pirate Ship
 # Matches: ... attacking the other players.
-add_game_regex(r'attacking the other players\.')
+add_game_regex(r'attacking the other players\.', cards=['Pirate Ship'])
 # Matches: ... <other_player> trashes <player>'s <card>.
-add_game_regex(r"(?P<other_player>.+) trashes (?P<player>.+)'s " + card_regex_piece + r'\.', trash_matcher)
+add_game_regex(r"(?P<other_player>.+) trashes (?P<player>.+)'s " + card_regex_piece + r'\.', trash_matcher, cards=['Pirate Ship'])
 # Matches: ... <player> gains a <span class=card-none>Pirate Ship</span> token.
-add_game_regex(r'(?P<player>.+) gains a <span class=card-none>Pirate Ship</span> token\.', lambda game, match, player: game.add_pirate_ship_token(1, player))
+add_game_regex(r'(?P<player>.+) gains a <span class=card-none>Pirate Ship</span> token\.', lambda game, match, player: game.add_pirate_ship_token(1, player), cards=['Pirate Ship'])
 
 # Minion
 # Matches: ... <player> discard[ing|s] the hand.
-add_game_regex(r'(?:(?P<player>.+) )?discard(?:ing|s) the hand\.')
+add_game_regex(r'(?:(?P<player>.+) )?discard(?:ing|s) the hand\.', cards=['Minion'])
 # Matches: ... <player> has n cards in hand.
-add_game_regex(r'(?P<player>.+) has (?P<cards>\d+) cards in hand\.')
+add_game_regex(r'(?P<player>.+) has (?P<cards>\d+) cards in hand\.', cards=['Minion'])
 # Matches: ... <player> has nothing in hand.
-add_game_regex(r'(?P<player>.+) has nothing in hand\.')
+add_game_regex(r'(?P<player>.+) has nothing in hand\.', cards=['Minion'])
 
 # Counting House
 # Matches: ... putting <cards> from the discard pile into the hand.
-add_game_regex(r'putting ' + card_list_regex_piece + r' from the discard pile into the hand\.')
+add_game_regex(r'putting ' + card_list_regex_piece + r' from the discard pile into the hand\.', cards=['Counting House'])
 # Matches: ... but there are no <span class=card-treasure>Coppers</span> in the discard pile.
-add_game_regex(r'but there are no <span class=card-treasure>Coppers</span> in the discard pile\.')
+add_game_regex(r'but there are no <span class=card-treasure>Coppers</span> in the discard pile\.', cards=['Counting House'])
 
 # Library
 # Matches: ... setting aside a <card>.
-add_game_regex(r'setting aside an? ' + card_regex_piece + r'\.')
+add_game_regex(r'setting aside an? ' + card_regex_piece + r'\.', cards=['Library'])
 
 # Torturer
 # Matches: ... <player> gains nothing in hand.
-add_game_regex(r'(?P<player>.+) gains nothing in hand\.')
+add_game_regex(r'(?P<player>.+) gains nothing in hand\.', cards=['Torturer'])
 
 # Secret Chamber
 # Matches: ... returning n cards to the deck.
-add_game_regex(r'returning (?P<cards>\d+) cards? to the deck\.')
+add_game_regex(r'returning (?P<cards>\d+) cards? to the deck\.', cards=['Secret Chamber'])
 
 # Jester
 # Matches: ... There are no <card> available to gain. (card is plural)
-add_game_regex(r'There are no ' + card_regex_piece + r' available to gain\.')
+add_game_regex(r'There are no ' + card_regex_piece + r' available to gain\.', cards=['Jester'])
 
 # Trusty Steed
 # Matches: ... gaining <cards> and putting the deck into the discard. (cards should be 4 <span class=card-treasure>Silvers</span>)
-add_game_regex(r'gaining ' + card_list_regex_piece + r' and putting the deck into the discard\.', lambda game, match, player: foreach_card(match.group('cards'), lambda card: game.gain(card, player)))
+add_game_regex(r'gaining ' + card_list_regex_piece + r' and putting the deck into the discard\.', lambda game, match, player: foreach_card(match.group('cards'), lambda card: game.gain(card, player)), cards=['Trusty Steed'])
 
 # Explorer
 # Matches: ... revealing a <card> and gaining a <card> in hand.
-add_game_regex(r'revealing a ' + card_regex_piece_formatable.format('revealed') + r' and gaining a ' + card_regex_piece_formatable.format('gain') + r' in hand\.', lambda game, match, player: game.gain(match.group('gain'), player))
+add_game_regex(r'revealing a ' + card_regex_piece_formatable.format('revealed') + r' and gaining a ' + card_regex_piece_formatable.format('gain') + r' in hand\.', lambda game, match, player: game.gain(match.group('gain'), player), cards=['Explorer'])
 
 # Trade Route
 # Matches: ... but has no card to trash.
@@ -751,23 +788,23 @@ add_game_regex(r'but has no card to trash\.')
 
 # Expand
 # Matches: ... but has nothing to expand.
-add_game_regex(r'but has nothing to expand\.')
+add_game_regex(r'but has nothing to expand\.', cards=['Expand'])
 
 # Mine
 # Matches: ... but has no treasure card to trash.
-add_game_regex(r'but has no treasure card to trash\.')
+add_game_regex(r'but has no treasure card to trash\.', cards=['Mine'])
 
 # Remodel
 # Matches: ... but has nothing to remodel.
-add_game_regex(r'but has nothing to remodel\.')
+add_game_regex(r'but has nothing to remodel\.', cards=['Remodel'])
 
 # Border Village
 # Matches: ... gaining nothing with it.
-add_game_regex(r'gaining nothing with it\.')
+add_game_regex(r'gaining nothing with it\.', cards=['Border Village'])
 
 # Transmute
 # Matches: ... having no cards to trash.
-add_game_regex(r'having no cards to trash\.')
+add_game_regex(r'having no cards to trash\.', cards=['Transmute'])
 
 # Spy
 # Matches: ... <player> has no card to reveal.
@@ -775,18 +812,344 @@ add_game_regex(r'(?P<player>.+) has no card to reveal\.')
 
 # Ill-Gotten Gains
 # Matches: ... gaining nothing in the hand.
-add_game_regex(r'gaining nothing in the hand\.')
+add_game_regex(r'gaining nothing in the hand\.', cards=['Ill-Gotten Gains'])
 # Matches: ... revealing a <card> and gaining nothing.
-add_game_regex(r'revealing an? ' + card_regex_piece + r' but gaining nothing\.')
+add_game_regex(r'revealing an? ' + card_regex_piece + r' but gaining nothing\.', cards=['Ill-Gotten Gains', "Fool's Gold"])
 
 # Fool's Gold
 # Matches: ... revealing a <card> but gaining nothing.
-add_game_regex(r'revealing a ' + card_regex_piece + r' but gaining nothing\.')
-
-
-
+add_game_regex(r'revealing a ' + card_regex_piece + r' but gaining nothing\.', cards=["Fool's Gold"])
+
+
+##################
+# Dispatch Index #
+##################
+# Trying every regex in game_log_regexes against every line is the main cost of parsing, as most lines
+# only match well down the list. The dispatch index keys each regex on the literal text it starts with
+# (once the shared prefix_piece is stripped off), so each line is only tried against the handful of regexes
+# that could possibly match it. Regexes that start with a player name are keyed on the literal text following
+# the player instead, as the line can be split on the (already known) player names.
+# Regexes that can't be keyed are tried against every line. Candidates are always tried in the order they were
+# added, so the first regex to match is the same one a scan over all of game_log_regexes would find.
+
+# Number of literal characters each regex is keyed on
+dispatch_key_length = 4
+# Strips the prefix off of a line (the same prefix_piece that add_game_regex prepends to every regex)
+prefix_regex = re.compile(prefix_piece)
+
+# Checks if a parsed regex is just .+ (which is how every player group is matched)
+def is_dot_plus(items):
+    if len(items) != 1 or items[0][0] != sre_parse.MAX_REPEAT:
+        return False
+    low, high, sub = items[0][1]
+    return low == 1 and high == sre_parse.MAXREPEAT and list(sub) == [(sre_parse.ANY, None)]
+
+# Finds every way the start of a parsed regex can be spelled out, adding (lead, key) pairs to keys.
+#  lead: None if the regex starts with literal text, or the literal text before the player group if it starts with a player
+#  key: The first dispatch_key_length literal characters (after the player, if there is a lead)
+# Returns False if some path through the regex doesn't start with enough literal text to be keyed.
+def expand_dispatch_keys(items, lead, text, keys, group_names):
+    if len(text) >= dispatch_key_length:
+        keys.add((lead, text[:dispatch_key_length]))
+        return True
+    if not items:
+        return False
+    op, av = items[0]
+    rest = items[1:]
+    if op == sre_parse.LITERAL:
+        return expand_dispatch_keys(rest, lead, text + unichr(av), keys, group_names)
+    elif op == sre_parse.SUBPATTERN:
+        group, sub = av[0], list(av[-1])
+        # A (?P<player>.+) group at the start splits the key into the lead and the text following the player
+        if group_names.get(group) == 'player' and lead is None and is_dot_plus(sub):
+            return expand_dispatch_keys(rest, text, u'', keys, group_names)
+        return expand_dispatch_keys(sub + rest, lead, text, keys, group_names)
+    elif op == sre_parse.BRANCH:
+        return all(expand_dispatch_keys(list(branch) + rest, lead, text, keys, group_names) for branch in av[1])
+    elif op == sre_parse.MAX_REPEAT or op == sre_parse.MIN_REPEAT:
+        low, high, sub = av
+        # Optional pieces can be either skipped or included. Anything else can't be spelled out.
+        if low == 0 and high == 1:
+            return expand_dispatch_keys(rest, lead, text, keys, group_names) and expand_dispatch_keys(list(sub) + rest, lead, text, keys, group_names)
+    return False
+
+# Returns the set of (lead, key) pairs that a regex string (without the prefix) can be dispatched on, or None if it can't be keyed.
+def get_dispatch_keys(regex_string):
+    parsed = sre_parse.parse(regex_string)
+    group_names = dict((index, name) for (name, index) in parsed.pattern.groupdict.items())
+    keys = set()
+    if not expand_dispatch_keys(list(parsed), None, u'', keys, group_names):
+        return None
+    for (lead, key) in keys:
+        # If the regex could start with a '.' or whitespace, the prefix_piece could give some of it back, so it can't be keyed off of the stripped line.
+        start = key if lead is None else lead
+        if start and (start[0] == '.' or start[0].isspace()):
+            return None
+    return keys
+
+class GameRegexIndex:
+
+    # positions: The positions of the regexes to index (all of them, if None)
+    def __init__(self, regex_strings, regexes, positions = None):
+        # Regexes are referred to by their position in the lists passed in
+        self.regexes = regexes
+        self.positions = range(len(regex_strings)) if positions is None else positions
+        # Positions of the regexes that have to be tried against every line
+        self.unkeyed = []
+        # Key -> positions of the regexes that start with that literal text
+        self.keyed = {}
+        # Lead -> key -> positions of the regexes that start with the lead, a player, and then the key
+        self.player_keyed = {}
+        # Cache of the (sorted) candidate lists, indexed by the keys that were found on a line
+        self.candidates = {}
+        # Line template -> position of the first regex that matched it (see LineLexer)
+        self.templates = {}
+        for position in self.positions:
+            keys = get_dispatch_keys(regex_strings[position])
+            if keys is None:
+                self.unkeyed.append(position)
+                continue
+            for (lead, key) in keys:
+                if lead is None:
+                    self.keyed.setdefault(key, []).append(position)
+                else:
+                    self.player_keyed.setdefault(lead, {}).setdefault(key, []).append(position)
+        # Try the longest leads first so the lookup order is stable
+        self.leads = sorted(self.player_keyed.keys(), key=lambda lead: (-len(lead), lead))
+
+    # Returns the list of (position, regex, matcher) that could match the line, in the order they should be tried.
+    def get_candidates(self, line, players):
+        rest = line[prefix_regex.match(line).end():]
+        found = [rest[:dispatch_key_length]]
+        for lead in self.leads:
+            if rest.startswith(lead):
+                for player in players:
+                    start = len(lead) + len(player)
+                    if rest.startswith(player, len(lead)):
+                        found.append((lead, rest[start:start + dispatch_key_length]))
+        found = tuple(found)
+        if found not in self.candidates:
+            positions = set(self.unkeyed)
+            positions.update(self.keyed.get(found[0], []))
+            for (lead, key) in found[1:]:
+                positions.update(self.player_keyed[lead].get(key, []))
+            self.candidates[found] = [(position, self.regexes[position][0], self.regexes[position][1]) for position in sorted(positions)]
+        return self.candidates[found]
+
+# Returns the dispatch index for game_log_regexes, building it if any regexes were added since it was last built
+def get_game_log_index():
+    global game_log_index
+    if game_log_index is None:
+        game_log_index = GameRegexIndex(game_log_regex_strings, game_log_regexes)
+    return game_log_index
+
+# Returns the set of cards that can show up in a game with the given supply.
+# Returns None if any card could show up (Black Market can bring in cards from outside of the supply).
+def get_kingdom_cards(supply):
+    if 'Black Market' in supply:
+        return None
+    kingdom = set(supply)
+    # Tournament brings the prizes with it
+    if 'Tournament' in kingdom:
+        kingdom.update(prize_cards)
+    return kingdom
+
+# Returns the dispatch index over just the regexes that can show up in a game with the given supply.
+# Kingdoms repeat across games, so these are cached by which of the tagged cards are in the game.
+def get_kingdom_index(supply):
+    kingdom = get_kingdom_cards(supply)
+    if kingdom is None:
+        return get_game_log_index()
+    key = frozenset(game_log_tagged_cards.intersection(kingdom))
+    if key not in kingdom_indexes:
+        positions = [position for position in range(len(game_log_regexes)) if game_log_regex_cards[position] is None or game_log_regex_cards[position] & key]
+        kingdom_indexes[key] = GameRegexIndex(game_log_regex_strings, game_log_regexes, positions)
+    return kingdom_indexes[key]
+
+
+#####################
+# Template Dispatch #
+#####################
+# Once the card <span> wrappers, numbers and player names are abstracted out, the lines in the game logs are
+# highly repetitive. Each line is lexed into a template (the line with those pieces swapped for placeholders)
+# and a tuple of the arguments that were pulled out of it. The first regex that matched a template is stored
+# under it, so later lines with the same template are resolved with a dictionary lookup and a single regex.
+# The regexes can't tell the abstracted pieces apart (cards are matched by the generic card pieces, numbers by
+# \d+ and players by the validated player group), so lines sharing a template are matched by the same regex.
+# Cards that are spelled out in a regex (Copper, Black Market, Lighthouse, etc.) are left in the template as is, and
+# player names are only swapped out where they aren't part of a longer word.
+
+template_card = u'\x01'
+template_number = u'\x02'
+template_player = u'\x03'
+template_number_regex = re.compile(r'\d+')
+
+# Returns the regex for the card <span>s that get abstracted out of templates, building it if any regexes were added since it was last built.
+# This is the same as card_regex, except for the card names that are spelled out in some game log regex.
+def get_template_span_regex():
+    global template_span_regex
+    if template_span_regex is None:
+        literal_cards = [card for card in cards.union(plural_cards.keys()) if any(card in regex_string for regex_string in game_log_regex_strings)]
+        # Longest names first, so a name that starts with another card's name isn't cut short
+        literal_cards.sort(key=lambda card: (-len(card), card))
+        template_span_regex = re.compile('<[\\w=\\-"\' ]+>(?!(?:' + '|'.join(re.escape(card) for card in literal_cards) + ')<)(?P<card>[\\w\\-\' ]+)<[/\\w=\\-"\' ]+>')
+    return template_span_regex
+
+class LineLexer:
+
+    def __init__(self, players):
+        # Longest names first, so a name that starts with another player's name isn't cut short
+        names = u'|'.join(re.escape(player) for player in sorted(players, key=lambda player: -len(player)))
+        self.span_regex = get_template_span_regex()
+        self.player_regex = re.compile(u'(?<!\\w)(?:' + names + u')(?!\\w)')
+        
+    # Returns the template for a line.
+    # This is on the hot path, so each piece is swapped out with its own substitution rather than a callback.
+    def template(self, line):
+        return template_number_regex.sub(template_number, self.player_regex.sub(template_player, self.span_regex.sub(template_card, line)))
+        
+# Checks that lines can be lexed for the players - names that have placeholders or digits in them could be confused for other pieces
+def can_lex_players(players):
+    for player in players:
+        for c in player:
+            if c.isdigit() or c == template_card or c == template_number or c == template_player:
+                return False
+    return True
+
+
+##################
+# Player Regexes #
+##################
+# Most of the game log regexes grab the player with a greedy (?P<player>.+), and used to have the match thrown out
+# when the player it grabbed wasn't in the game. Once the players are known, each regex is specialized so that the
+# player group can only match one of their names, which saves the backtracking over the rest of the line as well as
+# the validation. The specialized regexes are compiled the first time they are tried, and the sets of them are cached
+# by the player names, as the same players play each other over and over.
+# Compiling is slow next to the time it saves on a single game (the dispatch index already keeps most lines down to a
+# regex or two), so the regexes are only specialized once the same players have shown up together in
+# player_regex_min_games games. Until then, the player is validated as before. The regexes are also only parsed once,
+# and the parsed player group is swapped out for each set of players.
+
+player_group_piece = '(?P<player>.+)'
+# Number of games a set of players has to show up in before their regexes are specialized
+player_regex_min_games = 20
+# Only this many sets are cached, so a long run doesn't hold on to every set of players it has seen
+max_player_regex_sets = 200
+
+# Returns a copy of a parsed regex with the subpattern of the group swapped out for the replacement, or None if the
+# group isn't in it. Only the path down to the group is copied, everything else is shared with the original.
+def replace_group(items, group, replacement):
+    for i in range(len(items)):
+        op, av = items[i]
+        if op == sre_parse.SUBPATTERN:
+            if av[0] == group:
+                av = av[:-1] + (replacement,)
+            else:
+                sub = replace_group(av[-1], group, replacement)
+                av = av[:-1] + (sub,) if sub is not None else None
+        elif op == sre_parse.BRANCH:
+            branches = [replace_group(branch, group, replacement) for branch in av[1]]
+            av = (av[0], [branches[j] if branches[j] is not None else av[1][j] for j in range(len(branches))]) if any(branch is not None for branch in branches) else None
+        elif op == sre_parse.MAX_REPEAT or op == sre_parse.MIN_REPEAT:
+            sub = replace_group(av[2], group, replacement)
+            av = (av[0], av[1], sub) if sub is not None else None
+        else:
+            av = None
+        if av is not None:
+            data = list(items)
+            data[i] = (op, av)
+            return sre_parse.SubPattern(items.pattern, data)
+    return None
+
+# Returns the parsed regex at position in game_log_regexes, or None if it doesn't have a player group to specialize
+def get_player_regex_tree(position):
+    if position not in player_regex_trees:
+        regex_string = game_log_regex_strings[position]
+        if player_group_piece in regex_string:
+            player_regex_trees[position] = sre_parse.parse(prefix_piece + regex_string)
+        else:
+            player_regex_trees[position] = None
+    return player_regex_trees[position]
 
+class PlayerRegexes:
 
+    def __init__(self, players):
+        # Longest names first, so a name that starts with another player's name isn't cut short
+        self.player_tree = sre_parse.parse(u'|'.join(re.escape(player) for player in sorted(players, key=lambda player: (-len(player), player))))
+        self.regexes = [None] * len(game_log_regexes)
+        
+    # Returns the regex at position in game_log_regexes, with the player group specialized for the players.
+    # Note that the specialized regexes are compiled from the parsed regex, so they don't have a pattern string.
+    def get(self, position):
+        regex = self.regexes[position]
+        if regex is None:
+            tree = get_player_regex_tree(position)
+            if tree is not None:
+                regex = sre_compile.compile(replace_group(tree, tree.pattern.groupdict['player'], self.player_tree))
+            else:
+                regex = game_log_regexes[position][0]
+            self.regexes[position] = regex
+        return regex
+        
+# Returns the specialized regexes for the players, or None if these players haven't been seen together often enough yet
+def get_player_regexes(players):
+    key = tuple(sorted(players))
+    if key not in player_regex_sets:
+        games = player_set_games.get(key, 0) + 1
+        if games < player_regex_min_games:
+            if len(player_set_games) >= max_player_regex_sets * player_regex_min_games:
+                player_set_games.clear()
+            player_set_games[key] = games
+            return None
+        if len(player_regex_sets) >= max_player_regex_sets:
+            player_regex_sets.clear()
+        player_regex_sets[key] = PlayerRegexes(players)
+        player_set_games.pop(key, None)
+    return player_regex_sets[key]
+
+
+
+
+
+# The cards that DominionGame.init_game adds to every supply (they aren't listed in the header)
+basic_supply_cards = frozenset(['Copper', 'Silver', 'Gold', 'Estate', 'Duchy', 'Province', 'Curse'])
+
+# Picks out a slice of the games, based only on what is known from the header and scores of a log.
+#  num_players: The player counts to keep
+#  required_cards: Cards that must all be in the supply
+#  forbidden_cards: Cards that can't be in the supply
+#  start_date, end_date: The range of dates (datetime.date) to keep, inclusive
+# Any of these can be left as None to not filter on it.
+class GameFilter:
+
+    def __init__(self, num_players = None, required_cards = None, forbidden_cards = None, start_date = None, end_date = None):
+        self.num_players = set(num_players) if num_players else None
+        self.required_cards = set(required_cards) if required_cards else None
+        self.forbidden_cards = set(forbidden_cards) if forbidden_cards else None
+        self.start_date = start_date
+        self.end_date = end_date
+        
+    def matches(self, game):
+        if self.num_players and game.get_num_players() not in self.num_players:
+            return False
+        if self.required_cards or self.forbidden_cards:
+            supply = basic_supply_cards.union(game.get_cards_in_supply())
+            if self.required_cards and not self.required_cards.issubset(supply):
+                return False
+            if self.forbidden_cards and not self.forbidden_cards.isdisjoint(supply):
+                return False
+        if self.start_date or self.end_date:
+            if game.year is None:
+                return False
+            date = datetime.date(game.year, game.month, game.day)
+            if self.start_date and date < self.start_date:
+                return False
+            if self.end_date and date > self.end_date:
+                return False
+        return True
+
+# Matches: Log file names (game-YYYYMMDD-HHMMSS-xxxxxxxx.html)
+log_filename_regex = re.compile(r'game-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})-(?P<hour>\d{2})(?P<minute>\d{2})(?P<second>\d{2})-[\d\w]{8}\.html')
 
 # Separator matchers
 br_regex = re.compile(r'\s*<br>$')
@@ -812,6 +1175,7 @@ illegal_player_name_abort = -6
 incomplete_file_abort = -7
 duplicate_player_name_abort = -8
 unhandled_line_abort = -9
+filtered_abort = -10
 
 # Most recent assertion that failed
 assertion_exception = None
@@ -837,6 +1201,8 @@ def abort_string(abort):
         return "Duplicate player name{0}".format(": '{0}'".format(illegal_player_name) if illegal_player_name else "")
     elif abort == unhandled_line_abort:
         return "Unhandled line"
+    elif abort == filtered_abort:
+        return "Filtered out"
     else:
         return "Unknown Reason"
 
@@ -848,6 +1214,27 @@ class IsotropicParser:
         self.allow_games_with_resign = False
         self.allow_ties = False
         self.allow_invalid_end_state = False
+        # Try each line only against the regexes in the dispatch index that could match it
+        self.use_dispatch_index = True
+        # Regex attempt counters (over every file read), with and without the dispatch index
+        self.lines_dispatched = 0
+        self.regex_attempts = 0
+        self.linear_regex_attempts = 0
+        # Lines that only matched a regex that was pruned for the game's kingdom
+        self.pruned_regex_matches = 0
+        # Resolve lines by their template when a line with the same template was already matched.
+        # The dispatch index already narrows most lines down to a regex or two, so lexing every line only pays off
+        # when there are a lot of regexes registered (the cost of templates doesn't grow with the number of regexes).
+        self.use_line_templates = False
+        self.template_hits = 0
+        # Try each line with the regexes specialized for the game's players, instead of validating the player after each match
+        self.use_player_regexes = True
+        # The class of the game built up for each log (event_store.RecordingGame records it so it can be replayed later)
+        self.game_class = DominionGame
+        # Skips the games it doesn't match, once the header and scores are read (see GameFilter)
+        self.game_filter = None
+        # Keep a snapshot of the game at the start of each turn (in game.turn_snapshots)
+        self.keep_turn_snapshots = False
         
     def register_handler(self, event, handler):
         self.event_handlers[event] = handler
@@ -863,12 +1250,19 @@ class IsotropicParser:
             else:
                 self.event_handlers[event](self.game, arg0, arg1, arg2)
         
-    def read(self, filename):
-        self.file = open(filename, 'rb')
+    # Opens a log (or takes the stream it is read from) and resets the parser and its game for it
+    def open_log(self, filename, stream = None):
+        if stream is None:
+            self.file = open(filename, 'rb')
+        else:
+            self.file = stream
+        self.lines = iter(self.file)
         # Reset the game instance associated with this parser
-        self.game = DominionGame()
+        self.game = self.game_class()
+        if self.keep_turn_snapshots:
+            self.game.enable_turn_snapshots()
         
-        match = re.match(r'game-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})-(?P<hour>\d{2})(?P<minute>\d{2})(?P<second>\d{2})-[\d\w]{8}\.html', os.path.basename(filename))
+        match = log_filename_regex.match(os.path.basename(filename))
         if match:
             year = int(match.group('year'))
             month = int(match.group('month'))
@@ -881,13 +1275,27 @@ class IsotropicParser:
         self.unhandled_lines = 0
         self.line_num = 0
         self.players = [] # cache list of players for regex player validation
+        self.unindexable_players = False
+        # Regexes to try on each line (narrowed down to the game's kingdom once the supply is read)
+        self.line_index = get_game_log_index()
+        # Lexes lines into templates (created once the players are known)
+        self.lexer = None
+        # Regexes specialized for the players (set once the players are known)
+        self.player_regexes = None
         self.abort = False
+        
+    # Reads a game log. If stream is given, the log is read from it (for example, a member of a tar archive),
+    # and filename is only used for the timestamp. The caller is responsible for closing the stream.
+    def read(self, filename, stream = None):
+        self.open_log(filename, stream)
         self.handle_event(parse_started_event)
         
         try:
             self.read_header()
             if not self.abort:
                 self.read_scores()
+            if not self.abort:
+                self.filter_game()
             if not self.abort:
                 self.read_game()
             if not self.abort:
@@ -909,7 +1317,8 @@ class IsotropicParser:
             # The next() iterator on the file most likely raised this because the file wasn't completely extracted
             self.abort = incomplete_file_abort
             
-        self.file.close()
+        if stream is None:
+            self.file.close()
         if not self.abort:
             if self.unhandled_lines == 0:
                 #print 'Parsing complete.'
@@ -922,6 +1331,11 @@ class IsotropicParser:
             self.handle_event(parse_aborted_event, self.line_num, self.abort)
             return self.abort # Aborting means this file should be skipped, as it is invalid for some reason (single player, players resigned, unprocessed cards)
         
+    # Skips games that the game filter doesn't match (once the header and scores are read)
+    def filter_game(self):
+        if self.game_filter and not self.game_filter.matches(self.game):
+            self.abort = filtered_abort
+        
     def read_header(self):
         # Get some game metadata from the first line
         first_line = self.next() # Read the first line
@@ -950,6 +1364,8 @@ class IsotropicParser:
         cards_in_supply = self.next()
         # Young Witch causes <span class=bane-star>&diams;</span> to be added as a 'card', but that will be filtered by the foreach_card
         foreach_card(cards_in_supply, lambda card: self.game.add_card_to_supply(card))
+        # Skip the card specific regexes for cards that can't show up in this game
+        self.line_index = get_kingdom_index(self.game.get_cards_in_supply())
             
         self.next() # Skip line 5
         
@@ -992,6 +1408,8 @@ class IsotropicParser:
                     return
                 # Cache the player locally for regex validation
                 self.players.append(player)
+                if player[0] == '.' or player[0].isspace():
+                    self.unindexable_players = True
                 #foreach_cards(cards, lambda count, card: pr('  {0} {1} ({2})'.format(count, card, sanitize_card(card))))
                 self.game.add_player(player)
                 self.game.set_final_score(player, score)
@@ -1020,6 +1438,11 @@ class IsotropicParser:
         # Initialize the game (this should be called after all the supply piles are established though)
         self.game.init_game()
         
+        if self.use_line_templates and can_lex_players(self.players):
+            self.lexer = LineLexer(self.players)
+        if self.use_player_regexes:
+            self.player_regexes = get_player_regexes(self.players)
+        
         self.next() # Read the blank line after the separator
 
         # Read the contents of the trash
@@ -1161,17 +1584,62 @@ class IsotropicParser:
         # Please keep the common/generic type lines first, for efficiencies sake.
         # Card specific checks should happen last, as they will only occur in games where that card is.
         
-        # Loop through each regex we have for the game log, try it, and if it matches, call its corresponding matcher and return.
-        for regex, matcher in game_log_regexes:
+        self.lines_dispatched += 1
+        # If a line with the same template was already matched, only its regex needs to be tried
+        template = None
+        if self.lexer:
+            template = self.lexer.template(line)
+            if template in self.line_index.templates:
+                position = self.line_index.templates[template]
+                if self.match_line(line, [(position, game_log_regexes[position][0], game_log_regexes[position][1])]) is not None:
+                    self.template_hits += 1
+                    return True
+        position = self.match_line(line, self.get_candidates(self.line_index, line))
+        if position is not None:
+            if template is not None:
+                self.line_index.templates[template] = position
+            return True
+        # Before giving up on the line, try the regexes that were skipped because their cards aren't in the kingdom.
+        # If one of these matches, the regex is most likely missing one of the cards that can trigger it.
+        if len(self.line_index.positions) != len(game_log_regexes):
+            active = set(self.line_index.positions)
+            candidates = [(position, regex, matcher) for (position, regex, matcher) in self.get_candidates(get_game_log_index(), line) if position not in active]
+            if self.match_line(line, candidates) is not None:
+                self.pruned_regex_matches += 1
+                return True
+        
+        self.linear_regex_attempts += len(game_log_regexes)
+        # Default return
+        return False
+        
+    # Returns the (position, regex, matcher) list from the index that could match the line, or every regex in the index if it can't be used.
+    def get_candidates(self, index, line):
+        # Player names starting with a '.' or whitespace could be partly eaten by the prefix, so they can't be looked up in the index.
+        if self.use_dispatch_index and not self.unindexable_players:
+            return index.get_candidates(line, self.players)
+        else:
+            return [(position, game_log_regexes[position][0], game_log_regexes[position][1]) for position in index.positions]
+        
+    # Tries each (position, regex, matcher) in order, calling the matcher for the first regex that matches.
+    # Returns the position of the regex that matched, or None if none of them did.
+    def match_line(self, line, candidates):
+        # Loop through each candidate regex, try it, and if it matches, call its corresponding matcher and return.
+        for position, regex, matcher in candidates:
+            if self.player_regexes:
+                regex = self.player_regexes.get(position)
+            self.regex_attempts += 1
             match = regex.match(line)
             player = None
-            # Sanity check the player (make sure that the player field doesn't eat parts that make this not really match. The .+ used to grab players is greedy.)
             if match and 'player' in match.groupdict():
                 player = match.group('player')
-                if player is not None and player not in self.players:
+                # Sanity check the player (make sure that the player field doesn't eat parts that make this not really match. The .+ used to grab players is greedy.)
+                # The player regexes can only match the players' names, so this is only needed without them.
+                if not self.player_regexes and player is not None and player not in self.players:
                     match = None
             # If there's still a match, call the matcher function with the game, match, and player (which could be None)
             if match:
+                # A linear scan over game_log_regexes would have tried every regex up to this one
+                self.linear_regex_attempts += position + 1
                 # Check the state of revealed cards - if there were revealed cards before processing this line, they were revealed by the last line and should be reset after this line.
                 # This is because revealed cards should only affect the single line after them (its possible that the prefix could provide a better granularity to this...)
                 reset_revealed = self.game.get_revealed()
@@ -1179,10 +1647,8 @@ class IsotropicParser:
                 # Reset the revealed cards
                 if reset_revealed:
                     self.game.reset_revealed()
-                return True
-            
-        # Default return
-        return False
+                return position
+        return None
         
     # This matches a regex, and if there is a 'player' group, makes sure the player is valid.
     # This is much easier than refreshing the regexes once the players names are found.
@@ -1196,6 +1662,22 @@ class IsotropicParser:
                 return None
         return match
     
+    # Returns a summary of how many regexes were tried per line, with the dispatch index and for a linear scan
+    def regex_attempt_stats(self):
+        lines = self.lines_dispatched if self.lines_dispatched else 1
+        return 'Regex attempts per line: {0:.2f} (linear scan: {1:.2f}) over {2} lines ({3} resolved by template, {4} only matched regexes pruned for the kingdom)'.format(self.regex_attempts / float(lines), self.linear_regex_attempts / float(lines), self.lines_dispatched, self.template_hits, self.pruned_regex_matches)
+    
+    # The raw counters behind regex_attempt_stats, so that the stats from several parsers (one per worker process) can be summed up
+    def regex_attempt_counts(self):
+        return (self.lines_dispatched, self.regex_attempts, self.linear_regex_attempts, self.template_hits, self.pruned_regex_matches)
+    
+    def add_regex_attempt_counts(self, counts):
+        self.lines_dispatched += counts[0]
+        self.regex_attempts += counts[1]
+        self.linear_regex_attempts += counts[2]
+        self.template_hits += counts[3]
+        self.pruned_regex_matches += counts[4]
+    
     def unmatched_line(self, line, regex = None):
         if regex is None:
             self.handle_event(unexpected_line_event, self.line_num, line, None)
@@ -1213,7 +1695,7 @@ class IsotropicParser:
         assert self.game.get_player(player) is self.game.get_player(), "Acting player was not expected!"
     
     def next(self):
-        s = unicode(self.file.next(), 'utf-8').strip()
+        s = unicode(self.lines.next(), 'utf-8').strip()
         self.line_num += 1
         self.handle_event(parsing_line_event, self.line_num, s)
         return s
@@ -0,0 +1,108 @@
+from isotropic import *
+import dominion
+import sys
+import os
+import time
+import gc
+from array import array
+
+# Memory Benchmark
+# ----------------
+# Parses the logs in a directory and reports how much memory the game state (the DominionGame, its players and their
+# piles) takes up once each game has been parsed, and how many objects make it up.
+# Python 2 doesn't count allocations (outside of debug builds), so the objects created while parsing are counted
+# with the garbage collector instead: it counts every container object (lists, dicts, class instances, etc.) created
+# and not yet freed, so with it disabled, the count after each line less the count before it is the number of
+# containers left behind by that line.
+
+# Objects that are shared by every game (the card tables, etc.) aren't counted as part of any game
+shared_ids = set(id(value) for value in vars(dominion).values())
+shared_ids.update(id(table) for table in dominion.initial_supply_tables.values())
+
+# Returns the total size (in bytes) and number of the objects reachable from obj that haven't been seen yet
+def deep_size(obj, seen):
+    if id(obj) in seen or id(obj) in shared_ids or obj is None or isinstance(obj, (bool, int, long, float)):
+        return 0, 0
+    # Card names are shared with the card tables
+    if isinstance(obj, basestring) and obj in card_ids:
+        return 0, 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    count = 1
+    children = []
+    if isinstance(obj, dict):
+        children = obj.keys() + obj.values()
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = list(obj)
+    elif not isinstance(obj, (basestring, array, bytearray)):
+        if hasattr(obj, '__dict__'):
+            size += sys.getsizeof(obj.__dict__)
+            children = obj.__dict__.values()
+        for cls in type(obj).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                if hasattr(obj, slot):
+                    children.append(getattr(obj, slot))
+    for child in children:
+        child_size, child_count = deep_size(child, seen)
+        size += child_size
+        count += child_count
+    return size, count
+
+# Counts the container objects left behind by each line while the parser reads it
+class AllocationCounter:
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.lines = 0
+        self.objects = 0
+        self.read_line = parser.read_line
+        parser.read_line = self.count_line
+
+    def count_line(self, *args, **kwargs):
+        before = gc.get_count()[0]
+        ret = self.read_line(*args, **kwargs)
+        self.objects += gc.get_count()[0] - before
+        self.lines += 1
+        return ret
+
+def log_files(path):
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            yield os.path.join(dirpath, filename)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or '-h' in sys.argv:
+        print 'Usage: memory_benchmark.py <log directory>'
+        exit(0)
+
+    parser = IsotropicParser()
+    counter = AllocationCounter(parser)
+    games = 0
+    total_size = 0
+    total_objects = 0
+    player_size = 0
+    players = 0
+    start = time.time()
+    gc.disable()
+    for filename in log_files(sys.argv[1]):
+        if parser.read(filename) != 0:
+            continue
+        games += 1
+        size, objects = deep_size(parser.game, set())
+        total_size += size
+        total_objects += objects
+        for player in parser.game.players.values():
+            # The game is marked as seen, so only the player's own objects are counted
+            size, objects = deep_size(player, set([id(parser.game)]))
+            player_size += size
+            players += 1
+        gc.collect()
+    gc.enable()
+    elapsed = time.time() - start
+
+    print 'Parsed {0} games ({1} lines) in {2:.2f} seconds'.format(games, counter.lines, elapsed)
+    if games:
+        print 'Game state: {0:.0f} bytes in {1:.0f} objects per game ({2:.0f} bytes per player)'.format(float(total_size) / games, float(total_objects) / games, float(player_size) / players)
+    if counter.lines:
+        print 'Containers left behind per line: {0:.2f}'.format(float(counter.objects) / counter.lines)
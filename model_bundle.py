@@ -0,0 +1,122 @@
+import json
+import mmap
+import struct
+import numpy
+
+# Model Bundle
+# ------------
+# Loading the predictor from a folder of networks means reading and parsing a json file per card, when a game only
+# ever uses the networks for the cards in its supply. A bundle packs every network into one file instead: a header that
+# indexes the networks by card, followed by their weights as float32 blocks. The file is memory mapped, and a network is
+# only read out of it (without copying the weights) when it's first needed.
+#
+# Bundle layout (all integers little endian):
+#  magic, then a uint32 header length and the header (json), padded out to a multiple of 8 bytes. Then the blocks.
+# The header maps each card to its network:
+#  dense networks: {'inputs': [input labels], 'layers': [{'shape': [nodes, sources], 'weights': offset, 'biases': offset}]}
+#   Each layer's weights are a float32 nodes x sources matrix (C order), and its biases a float32 vector of nodes,
+#   at their offsets from the start of the blocks.
+#  other networks (that can't be evaluated as dense layers): {'json': offset, 'length': length}, the network's json.
+
+model_bundle_magic = 'TACTMDL1'
+header_length = struct.Struct('<I')
+block_dtype = numpy.dtype('<f4')
+block_alignment = 8
+
+def pad(length):
+    return -length % block_alignment
+
+# Writes networks (BackpropNetworks, with the json they were loaded from for any that aren't dense) to a new bundle
+def write_bundle(filename, networks, json_strs):
+    header = {}
+    blocks = []
+    offset = [0]
+    def add_block(data):
+        blocks.append(data + '\0' * pad(len(data)))
+        start = offset[0]
+        offset[0] += len(blocks[-1])
+        return start
+    for card in sorted(networks):
+        network = networks[card]
+        if network.dense:
+            layers = []
+            for weights, biases in network.layers:
+                layers.append({
+                    'shape': list(weights.shape),
+                    'weights': add_block(weights.astype(block_dtype).tostring()),
+                    'biases': add_block(biases.astype(block_dtype).tostring()),
+                })
+            header[card] = {'inputs': network.input_labels, 'layers': layers}
+        else:
+            data = json_strs[card].encode('utf-8')
+            header[card] = {'json': add_block(data), 'length': len(data)}
+    header = json.dumps(header, sort_keys=True)
+    header += ' ' * pad(len(model_bundle_magic) + header_length.size + len(header))
+    with open(filename, 'wb') as file:
+        file.write(model_bundle_magic)
+        file.write(header_length.pack(len(header)))
+        file.write(header)
+        for block in blocks:
+            file.write(block)
+
+# Reads the networks out of a bundle as they're asked for
+class ModelBundle:
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.data[:len(model_bundle_magic)] == model_bundle_magic, 'Not a model bundle'
+        start = len(model_bundle_magic) + header_length.size
+        length = header_length.unpack_from(self.data, len(model_bundle_magic))[0]
+        self.index = json.loads(self.data[start:start + length])
+        self.blocks = start + length
+
+    def __contains__(self, card):
+        return card in self.index
+
+    def get_cards(self):
+        return sorted(self.index)
+
+    def get_block(self, offset, count):
+        return numpy.frombuffer(self.data, dtype=block_dtype, count=count, offset=self.blocks + offset)
+
+    # Returns the input labels and the (weights, biases) of each layer for a dense network (as views of the bundle),
+    # or None if the network isn't dense
+    def get_layers(self, card):
+        entry = self.index[card]
+        if 'layers' not in entry:
+            return None
+        layers = []
+        for layer in entry['layers']:
+            nodes, sources = layer['shape']
+            layers.append((self.get_block(layer['weights'], nodes * sources).reshape(nodes, sources), self.get_block(layer['biases'], nodes)))
+        return entry['inputs'], layers
+
+    # Returns the json for a network that isn't dense
+    def get_json(self, card):
+        entry = self.index[card]
+        start = self.blocks + entry['json']
+        return self.data[start:start + entry['length']].decode('utf-8')
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+if __name__ == '__main__':
+    import sys
+    import time
+    from predictor import BackpropNetwork, read_network_folder
+    if len(sys.argv) < 3 or '-h' in sys.argv:
+        print 'Usage: model_bundle.py <network folder> <bundle file>'
+        print ' Compiles the .json networks in a folder into a bundle for predictor.py'
+        exit(0)
+
+    start = time.time()
+    networks = {}
+    json_strs = {}
+    for card, json_str in read_network_folder(sys.argv[1]):
+        networks[card] = BackpropNetwork(card, json_str)
+        json_strs[card] = json_str
+    write_bundle(sys.argv[2], networks, json_strs)
+    dense = len([network for network in networks.values() if network.dense])
+    print 'Compiled {0} networks ({1} dense) into {2} in {3:.2f} seconds'.format(len(networks), dense, sys.argv[2], time.time() - start)
@@ -0,0 +1,262 @@
+from predictor import *
+import asyncore
+import asynchat
+import socket
+import collections
+import errno
+import select
+import time
+
+# Prediction Service
+# ------------------
+# Keeps the networks loaded and serves predictions for many games at once, over a local socket. Each game is a session
+# (a PredictorSession, as played by the command line predictor) kept under an id that the client picks.
+#
+# Requests and responses are json objects, one per line. Each request has a command, and the session it's for (except
+# for stats). Any id given in a request is passed back in its response.
+#  {"session": s, "command": "new", "supply": [cards], "players": [names]}: starts a new game (the base cards are
+#   added to the supply by the game)
+#  {"session": s, "command": "<line>"}: runs a line of the game loop, like "gain Gold", "bob trashes Estate", "buys 2",
+#   "money 3", "actions", "turn", etc. Returns the messages for it and the status of the game.
+#  {"session": s, "command": "predict", "count": n}: returns the best n cards to buy (default 5), as [card, score]
+#  {"session": s, "command": "status"}: returns the status of the game
+#  {"session": s, "command": "end"}: ends the game
+#  {"command": "stats"}: returns the p50/p99 latency (in ms, from the request being read to the response being sent)
+#   of the recent requests of each kind, and how the predictions have been batched
+# Errors are returned as {"error": message}.
+#
+# Predictions aren't answered right away: requests that arrive within batch_window of the first one waiting (or until
+# max_batch are waiting) are scored together with one evaluation of each network stack for all of their supplies. Any
+# other request flushes the waiting predictions first, so replies still come back in the order they were asked for.
+
+default_socket_path = 'predictor.sock'
+default_batch_window = 0.002
+default_max_batch = 64
+# How many of the most recent latencies are kept for each kind of request
+latency_window = 10000
+
+# Keeps the latencies of the recent requests of a kind, for its percentiles
+class LatencyCounter:
+
+    def __init__(self):
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.count = 0
+
+    def add(self, latency):
+        self.latencies.append(latency)
+        self.count += 1
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def get_stats(self):
+        stats = {'count': self.count}
+        for name, fraction in [('p50_ms', 0.5), ('p99_ms', 0.99)]:
+            latency = self.percentile(fraction)
+            stats[name] = round(latency * 1000.0, 3) if latency is not None else None
+        return stats
+
+# A client connection, which reads a request per line and writes a response per line
+class ServiceConnection(asynchat.async_chat):
+
+    def __init__(self, service, sock, map):
+        asynchat.async_chat.__init__(self, sock, map)
+        self.service = service
+        self.buffer = []
+        self.set_terminator('\n')
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.buffer).strip()
+        self.buffer = []
+        if line:
+            self.service.handle_request(self, line, time.time())
+
+    def send_response(self, response):
+        if self.connected:
+            self.push(json.dumps(response) + '\n')
+
+    def handle_close(self):
+        self.close()
+
+class PredictionService(asyncore.dispatcher):
+
+    def __init__(self, predictor, socket_path=default_socket_path, port=None, batch_window=default_batch_window, max_batch=default_max_batch):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.predictor = predictor
+        self.sessions = {}
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        # The prediction requests waiting to be batched: (connection, request, received time, session)
+        self.pending = []
+        self.batch_deadline = None
+        self.batches = 0
+        self.batched_predictions = 0
+        self.latencies = {'predict': LatencyCounter(), 'command': LatencyCounter()}
+
+        if port is not None:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind(('127.0.0.1', port))
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.bind(socket_path)
+        self.listen(64)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            ServiceConnection(self, pair[0], self.map)
+
+    def respond(self, connection, request, received, response, kind='command'):
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        connection.send_response(response)
+        self.latencies[kind].add(time.time() - received)
+
+    def handle_request(self, connection, line, received):
+        request = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Requests should be json objects')
+            command = request.get('command')
+            name = request.get('session')
+            if command == 'predict' and name in self.sessions:
+                count = request.get('count', 5)
+                if not isinstance(count, (int, long)) or isinstance(count, bool) or count < 0:
+                    raise ValueError('count should be a non-negative integer')
+                self.pending.append((connection, request, received, self.sessions[name]))
+                if self.batch_deadline is None:
+                    self.batch_deadline = received + self.batch_window
+                if len(self.pending) >= self.max_batch:
+                    self.flush_predictions()
+                return
+            # Anything answered right away waits for the predictions before it, so that the replies on a connection
+            # come back in order, and each prediction is scored on the game as it was when it was asked for
+            self.flush_predictions()
+            if command == 'stats':
+                self.respond(connection, request, received, self.get_stats())
+                return
+            if command == 'new':
+                self.respond(connection, request, received, self.new_session(name, request))
+                return
+            if name not in self.sessions:
+                raise ValueError('No session: {0}'.format(name))
+            session = self.sessions[name]
+            if command == 'status':
+                self.respond(connection, request, received, {'session': name, 'status': session.get_status()})
+            elif command == 'end':
+                del self.sessions[name]
+                self.respond(connection, request, received, {'session': name, 'ended': True})
+            elif isinstance(command, basestring):
+                msgs = session.run_command(command)
+                self.respond(connection, request, received, {'session': name, 'messages': msgs, 'status': session.get_status()})
+            else:
+                raise ValueError('No command')
+        except Exception, e:
+            self.flush_predictions()
+            self.respond(connection, request, received, {'error': '{0}: {1}'.format(type(e).__name__, e)})
+
+    def new_session(self, name, request):
+        if name is None:
+            raise ValueError('No session given')
+        supply = []
+        for card in request.get('supply', []):
+            if not clean_card(card):
+                raise ValueError('Not a card: {0}'.format(card))
+            supply.append(clean_card(card))
+        players = request.get('players', [])
+        if not players:
+            raise ValueError('A game needs at least one player')
+        session = PredictorSession(supply, players)
+        self.sessions[name] = session
+        return {'session': name, 'status': session.get_status()}
+
+    # Scores every waiting prediction request together. Each request gets its own reply (or error), so one bad request
+    # can't take out the rest of the batch or the event loop.
+    def flush_predictions(self):
+        pending = self.pending
+        self.pending = []
+        self.batch_deadline = None
+        if not pending:
+            return
+        try:
+            scores = self.predictor.pick_cards([session.game for (connection, request, received, session) in pending])
+        except Exception, e:
+            # Score them one at a time instead, so only the requests that fail get an error
+            scores = []
+            for connection, request, received, session in pending:
+                try:
+                    scores.append(self.predictor.pick_card(session.game))
+                except Exception, e:
+                    scores.append(e)
+        self.batches += 1
+        self.batched_predictions += len(pending)
+        for (connection, request, received, session), game_scores in zip(pending, scores):
+            try:
+                if isinstance(game_scores, Exception):
+                    raise game_scores
+                predictions = [[card, score] for (score, card) in game_scores[:request.get('count', 5)]]
+                response = {'session': request.get('session'), 'predictions': predictions}
+            except Exception, e:
+                response = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+            try:
+                self.respond(connection, request, received, response, 'predict')
+            except Exception:
+                # The connection went away
+                pass
+
+    def get_stats(self):
+        return {
+            'latency': dict((kind, counter.get_stats()) for (kind, counter) in self.latencies.items()),
+            'sessions': len(self.sessions),
+            'batches': self.batches,
+            'mean_batch_size': round(float(self.batched_predictions) / self.batches, 2) if self.batches else None,
+        }
+
+    # Runs the event loop, flushing the waiting predictions once their batch window is up
+    def serve(self):
+        while self.map:
+            timeout = 1.0
+            if self.batch_deadline is not None:
+                timeout = max(0.0, self.batch_deadline - time.time())
+            try:
+                asyncore.loop(timeout=timeout, map=self.map, count=1)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            if self.batch_deadline is not None and time.time() >= self.batch_deadline:
+                self.flush_predictions()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or '-h' in sys.argv:
+        print 'Usage: prediction_service.py <network folder or bundle> [options]'
+        print ' -socket path: Listen on a unix socket at path (default {0})'.format(default_socket_path)
+        print ' -port n: Listen on localhost port n instead'
+        print ' -window ms: How long to wait for more prediction requests to batch together (default {0})'.format(default_batch_window * 1000)
+        print ' -max-batch n: The most prediction requests to batch together (default {0})'.format(default_max_batch)
+        exit(0)
+
+    predictor = load_predictor(sys.argv[1])
+    port = int(get_arg('-port')) if '-port' in sys.argv else None
+    socket_path = get_arg('-socket') or default_socket_path
+    batch_window = float(get_arg('-window')) / 1000.0 if '-window' in sys.argv else default_batch_window
+    max_batch = int(get_arg('-max-batch')) if '-max-batch' in sys.argv else default_max_batch
+    service = PredictionService(predictor, socket_path, port, batch_window, max_batch)
+    print 'Serving predictions on {0}'.format('localhost:{0}'.format(port) if port is not None else socket_path)
+    try:
+        service.serve()
+    except KeyboardInterrupt:
+        print 'Bailing out due to Ctrl-C'
+    service.close()
+    if port is None and os.path.exists(socket_path):
+        os.remove(socket_path)
@@ -6,6 +6,12 @@ import os.path
 from features import *
 from dominion import *
 
+# The networks are evaluated as dense layers with numpy when it's available, or node by node when it isn't
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class BackpropNode(object):
     def __init__(self, network, id):
         self.network = network
@@ -77,8 +83,34 @@ class OutputNode(BackpropNode):
             self.stale = False
         return self.out
         
+# Returns the sigmoid of each value in an array. This is the same as 1 / (1 + exp(-net)), but can't overflow.
+def dense_sigmoid(net):
+    return 0.5 + 0.5 * numpy.tanh(0.5 * net)
+    
+# Splits the hidden and output nodes into layers, where each node only takes the nodes in the layer before it (and the
+# bias). The inputs are layer 0, and the output node is in the last layer. Returns None if the nodes can't be layered.
+def get_layers(bias_ids, input_nodes, hidden_nodes, output_nodes):
+    layer_of = dict((node.id, 0) for node in input_nodes)
+    layers = [input_nodes]
+    for node in hidden_nodes + output_nodes:
+        sources = [id for id in node.weights if id not in bias_ids]
+        if not sources or any(id not in layer_of for id in sources):
+            return None
+        layer = max(layer_of[id] for id in sources) + 1
+        if any(layer_of[id] != layer - 1 for id in sources):
+            return None
+        if layer == len(layers):
+            layers.append([])
+        layers[layer].append(node)
+        layer_of[node.id] = layer
+    # The output has to be the whole last layer
+    if layers[-1] != output_nodes:
+        return None
+    return layers
+    
 class BackpropNetwork:
-    def __init__(self, card, json_str):
+    # Networks are either loaded from json, or from layers that were already compiled (with load_layers)
+    def __init__(self, card, json_str=None):
         # Input nodes are mapped to by label. This makes updating based on the current state of the game easier.
         self.inputs = {}
         # Nodes that can be marked stale (hidden and output)
@@ -87,74 +119,329 @@ class BackpropNetwork:
         self.output = None
         # All nodes in the system are here, indexed by id.
         self.nodes = {}
+        # The nodes compiled into dense layers: the input values (in the order of input_labels), and the weights and biases
+        # of each layer after the inputs. Nodes are only used to evaluate the network when it isn't dense.
+        self.dense = False
+        self.input_labels = []
+        self.input_index = {}
+        self.input_values = None
+        self.layers = []
         
         self.card = card
-        self.load_json(json_str)
+        if json_str is not None:
+            self.load_json(json_str)
         
     def load_json(self, json_str):
         json_object = json.loads(json_str)
+        bias_ids = set()
+        input_nodes = []
+        hidden_nodes = []
+        output_nodes = []
         # Read in the bias node
         for json_node in json_object['bias']:
             node = BiasNode(self, json_node['id'])
             self.nodes[node.id] = node
+            bias_ids.add(node.id)
         # Read in the input nodes
         for json_node in json_object['inputs']:
             node = InputNode(self, json_node['id'], json_node['label'])
             self.nodes[node.id] = node
             self.inputs[node.label] = node
+            input_nodes.append(node)
         # Read in the hidden nodes
         for json_node in json_object['hidden']:
             node = HiddenNode(self, json_node['id'], json_node['weights'])
             self.nodes[node.id] = node
             self.staleable_nodes.append(node)
+            hidden_nodes.append(node)
         # Read in the output node
         for json_node in json_object['output']:
             node = OutputNode(self, json_node['id'], json_node['weights'])
             self.nodes[node.id] = node
             self.staleable_nodes.append(node)
             self.output = node
-            
+            output_nodes.append(node)
+        self.compile(bias_ids, input_nodes, hidden_nodes, output_nodes)
+        
+    # Compiles the nodes into a weight matrix and bias vector for each layer, so the network can be evaluated with a
+    # matrix product per layer instead of a method call per edge
+    def compile(self, bias_ids, input_nodes, hidden_nodes, output_nodes):
+        self.input_labels = [node.label for node in input_nodes]
+        self.input_index = dict((self.input_labels[i], i) for i in range(len(self.input_labels)))
+        if numpy is None or len(output_nodes) != 1:
+            return
+        layers = get_layers(bias_ids, input_nodes, hidden_nodes, output_nodes)
+        if layers is None:
+            return
+        self.input_values = numpy.zeros(len(input_nodes))
+        self.layers = []
+        for i in range(1, len(layers)):
+            sources = dict((layers[i - 1][j].id, j) for j in range(len(layers[i - 1])))
+            weights = numpy.zeros((len(layers[i]), len(layers[i - 1])))
+            biases = numpy.zeros(len(layers[i]))
+            for j in range(len(layers[i])):
+                for id, weight in layers[i][j].weights.items():
+                    if id in bias_ids:
+                        biases[j] += weight
+                    else:
+                        weights[j, sources[id]] = weight
+            self.layers.append((weights, biases))
+        self.dense = True
+        
+    # Loads the dense layers of a compiled network (from a model bundle). These networks don't have any nodes.
+    def load_layers(self, input_labels, layers):
+        self.input_labels = list(input_labels)
+        self.input_index = dict((self.input_labels[i], i) for i in range(len(self.input_labels)))
+        self.input_values = numpy.zeros(len(self.input_labels))
+        self.layers = layers
+        self.dense = True
+        
     def get_node(self, id):
         return self.nodes[id]
         
     def load_input(self, label, val):
-        self.inputs[label].set_output(val)
+        if self.dense:
+            self.input_values[self.input_index[label]] = val
+        else:
+            self.inputs[label].set_output(val)
         
     def load_inputs(self, game):
-        for label in self.inputs:
+        for label in self.input_labels:
             self.load_input(label, Feature.sql_names[label].extract(game, self.card))
+            
+    # Loads the inputs from a row of features already extracted for this card, given the column of each input in the row
+    def load_row(self, row, columns):
+        for label, column in zip(self.input_labels, columns):
+            self.load_input(label, row[column])
         
     def mark_stale(self):
-        for node in self.staleable_nodes:
-            node.mark_stale()
+        if not self.dense:
+            for node in self.staleable_nodes:
+                node.mark_stale()
             
     def get_output(self):
+        if self.dense:
+            return self.get_dense_output()
         return self.output.get_output()
+        
+    # Hidden layers have a sigmoid output, and the output layer is left continuous
+    def get_dense_output(self):
+        values = self.input_values
+        for weights, biases in self.layers[:-1]:
+            values = dense_sigmoid(weights.dot(values) + biases)
+        weights, biases = self.layers[-1]
+        return float(weights.dot(values)[0] + biases[0])
 
+# The dense networks of many cards, stacked so that they can all be evaluated at once. The networks have to share the same
+# inputs and number of layers, but the hidden layers can differ in size: each layer is padded out to the largest one, and
+# the padded nodes have no weights in or out, so they don't change the output.
+class NetworkStack:
+    def __init__(self, networks, input_columns):
+        self.cards = [network.card for network in networks]
+        self.card_index = dict((self.cards[i], i) for i in range(len(self.cards)))
+        self.input_labels = networks[0].input_labels
+        # The column of each input in the rows extracted by the predictor's feature plan
+        self.input_columns = numpy.array(input_columns, dtype=int)
+        # A weight tensor (card, node, node in the previous layer) and a bias matrix (card, node) for each layer
+        self.layers = []
+        sources = len(self.input_labels)
+        for layer in range(len(networks[0].layers)):
+            nodes = max(network.layers[layer][0].shape[0] for network in networks)
+            weights = numpy.zeros((len(networks), nodes, sources))
+            biases = numpy.zeros((len(networks), nodes))
+            for i in range(len(networks)):
+                network_weights, network_biases = networks[i].layers[layer]
+                weights[i, :network_weights.shape[0], :network_weights.shape[1]] = network_weights
+                biases[i, :network_biases.shape[0]] = network_biases
+            self.layers.append((weights, biases))
+            sources = nodes
+            
+    # Returns the layers of the stack for just some of its cards
+    def select(self, cards):
+        indices = [self.card_index[card] for card in cards]
+        return [(weights[indices], biases[indices]) for (weights, biases) in self.layers]
+        
+    # Evaluates the networks for some cards at once, given the layers selected for them and their inputs (card, input)
+    @staticmethod
+    def evaluate(layers, inputs):
+        values = inputs
+        for weights, biases in layers[:-1]:
+            values = dense_sigmoid(numpy.matmul(weights, values[:, :, None])[:, :, 0] + biases)
+        weights, biases = layers[-1]
+        return numpy.matmul(weights, values[:, :, None])[:, 0, 0] + biases[:, 0]
+        
 class DominionBackpropPredictor:
     def __init__(self):
         self.networks = {}
+        # Model bundles that networks are loaded from as they're needed
+        self.bundles = []
+        # The dense networks are evaluated together in stacks (unless stacked is turned off), which are built when they're first needed
+        self.stacked = True
+        self.stacks = None
+        # The features the networks take are extracted together by a plan, with the column of each input label in its rows
+        self.plan = None
+        self.plan_columns = {}
+        # The layers of the stacks selected for the last supply picked from
+        self.stack_of = {}
+        self.supply = None
+        self.supply_stacks = []
+        self.unstacked_cards = []
         self.average = 38.25765735;
         self.stddev = 18.68538455;
         self.normalization_min = self.average - (2 * self.stddev)
         self.normalization_max = self.average + (2 * self.stddev)
         
     def add_network(self, card, json_str):
-        self.networks[card] = BackpropNetwork(card, json_str)
+        self.set_network(card, BackpropNetwork(card, json_str))
+        
+    def set_network(self, card, network):
+        self.networks[card] = network
+        self.stacks = None
+        self.supply = None
+        
+    def add_bundle(self, bundle):
+        self.bundles.append(bundle)
+        
+    # Returns the network for a card, loading it from a bundle the first time it's needed
+    def get_network(self, card):
+        if card not in self.networks:
+            for bundle in self.bundles:
+                if card in bundle:
+                    compiled = bundle.get_layers(card)
+                    if compiled is None:
+                        self.add_network(card, bundle.get_json(card))
+                    else:
+                        network = BackpropNetwork(card)
+                        network.load_layers(*compiled)
+                        self.set_network(card, network)
+                    break
+        return self.networks[card]
+        
+    # Binds the input labels of the networks to the columns of a feature plan over just the features they take, so each
+    # feature is computed once per game state (or once per card, for the few that depend on the card bought), then
+    # stacks the dense networks that share the same inputs and number of layers
+    def build_stacks(self):
+        labels = set(label for network in self.networks.values() for label in network.input_labels)
+        features = [feature for feature in Feature.features if feature.sql_name in labels]
+        self.plan = FeaturePlan(features)
+        self.plan_columns = dict((features[i].sql_name, i) for i in range(len(features)))
+        groups = {}
+        for card in sorted(self.networks):
+            network = self.networks[card]
+            if network.dense:
+                groups.setdefault((tuple(network.input_labels), len(network.layers)), []).append(network)
+        self.stacks = [NetworkStack(networks, self.get_input_columns(networks[0])) for networks in groups.values()]
+        self.stack_of = {}
+        for stack in self.stacks:
+            for card in stack.cards:
+                self.stack_of[card] = stack
+                
+    def get_input_columns(self, network):
+        return [self.plan_columns[label] for label in network.input_labels]
+        
+    # Splits the cards in the supply between the stacks (and the networks that aren't in one), selecting the layers for
+    # each stack. This is kept for as long as the supply stays the same.
+    def select_supply(self, supply):
+        for card in supply:
+            self.get_network(card)
+        if self.stacks is None:
+            self.build_stacks()
+        self.supply = supply
+        self.supply_stacks = []
+        self.unstacked_cards = []
+        for stack in self.stacks:
+            cards = [card for card in supply if self.stack_of.get(card) is stack]
+            if cards:
+                # The rows extracted for these cards (in supply order), and their inputs
+                rows = numpy.array([supply.index(card) for card in cards], dtype=int)
+                self.supply_stacks.append((stack, cards, stack.select(cards), numpy.ix_(rows, stack.input_columns)))
+        for card in supply:
+            if card not in self.stack_of:
+                self.unstacked_cards.append(card)
         
     def unnormalize_score(self, score):
         return (score * (self.normalization_max - self.normalization_min)) + self.normalization_min
         
+    # Returns the (score, card) for each card in the supply, best first
     def pick_card(self, game):
+        if not self.stacked or numpy is None:
+            return self.pick_card_unstacked(game)
+        supply = game.get_cards_in_supply()
+        if supply != self.supply:
+            self.select_supply(supply)
+        # Extract the features for the game state once, then fill in the ones that depend on the card for each card
+        self.plan.extract_turn(game)
+        rows = [self.plan.extract_card(card) for card in supply]
+        matrix = numpy.array(rows, dtype=float)
         scores = []
-        for card in game.get_cards_in_supply(): #self.networks:
+        for stack, cards, layers, inputs in self.supply_stacks:
+            outputs = NetworkStack.evaluate(layers, matrix[inputs])
+            scores.extend((self.unnormalize_score(float(outputs[i])), cards[i]) for i in range(len(cards)))
+        for card in self.unstacked_cards:
             network = self.networks[card]
             network.mark_stale()
-            network.load_inputs(game)
+            network.load_row(rows[supply.index(card)], self.get_input_columns(network))
             scores.append((self.unnormalize_score(network.get_output()), card))
         scores.sort()
         scores.reverse()
         return scores
+        
+    # Returns the (score, card) lists for many games at once, evaluating each stack once for every card in all of
+    # their supplies (so predictions for concurrent games can be batched together)
+    def pick_cards(self, games):
+        if len(games) == 1 or not self.stacked or numpy is None:
+            return [self.pick_card(game) for game in games]
+        supplies = [game.get_cards_in_supply() for game in games]
+        for supply in supplies:
+            for card in supply:
+                self.get_network(card)
+        if self.stacks is None:
+            self.build_stacks()
+        # A row of features for each card in each supply, along with the game it's for
+        rows = []
+        owners = []
+        for i in range(len(games)):
+            self.plan.extract_turn(games[i])
+            for card in supplies[i]:
+                rows.append(self.plan.extract_card(card))
+                owners.append((i, card))
+        matrix = numpy.array(rows, dtype=float)
+        scores = [[] for game in games]
+        # The rows for each stack
+        members = {}
+        for j in range(len(owners)):
+            i, card = owners[j]
+            if card in self.stack_of:
+                members.setdefault(self.stack_of[card], []).append(j)
+            else:
+                network = self.networks[card]
+                network.mark_stale()
+                network.load_row(rows[j], self.get_input_columns(network))
+                scores[i].append((self.unnormalize_score(network.get_output()), card))
+        for stack, stack_rows in members.items():
+            layers = stack.select([owners[j][1] for j in stack_rows])
+            outputs = NetworkStack.evaluate(layers, matrix[numpy.ix_(stack_rows, stack.input_columns)])
+            for j, output in zip(stack_rows, outputs):
+                scores[owners[j][0]].append((self.unnormalize_score(float(output)), owners[j][1]))
+        for game_scores in scores:
+            game_scores.sort()
+            game_scores.reverse()
+        return scores
+        
+    # Scores each card in the supply with its own network, one at a time
+    def pick_card_unstacked(self, game):
+        scores = []
+        for card in game.get_cards_in_supply(): #self.networks:
+            scores.append(self.score_card(game, card))
+        scores.sort()
+        scores.reverse()
+        return scores
+        
+    def score_card(self, game, card):
+        network = self.get_network(card)
+        network.mark_stale()
+        network.load_inputs(game)
+        return (self.unnormalize_score(network.get_output()), card)
     
 #def predict(game, count):
 #    
@@ -197,25 +484,82 @@ add_predictor_regex(r'(?:(?P<player>.*) )?trashe?s? (?P<card>.*)',
     lambda match, player: "{0} trashing a {1}".format(player.name, clean_card(match.group('card'))))
 
 
-if __name__ == '__main__':
-    # Setup the predictor
+# A game played out through the predictor, by the command line predictor below or by a session of prediction_service.py
+class PredictorSession:
+    def __init__(self, supply, players):
+        self.game = DominionGame()
+        for card in supply:
+            self.game.add_card_to_supply(card)
+        self.players = list(players)
+        for player in self.players:
+            self.game.add_player(player)
+        self.game.init_game()
+        # Bootstrap the game
+        self.cur_player = 0
+        self.game.start_new_turn(self.players[0], 1) #increment_turn=True
+        
+    def next_turn(self):
+        self.cur_player = (self.cur_player + 1) % len(self.players)
+        self.game.start_new_turn(self.players[self.cur_player], increment_turn=self.cur_player == 0)
+        
+    def get_status(self):
+        game = self.game
+        return "{0}'s turn {1}, {2} actions {3} buys ${4}".format(game.get_player(game.possessor).name, game.turn_number, game.actions, game.buys, game.money)
+        
+    # Runs a line of the game loop (the next turn, or anything the predictor loop regexes match), returning the messages for it
+    def run_command(self, line):
+        if line == 'next turn' or line == 'turn':
+            self.next_turn()
+            return []
+        msgs = []
+        game = self.game
+        for regex, matcher, msg_func in predictor_loop_regexes:
+            match = regex.match(line)
+            if match:
+                player = game.possessor
+                if 'player' in match.groupdict():
+                    if match.group('player'):
+                        player = match.group('player')
+                player = game.get_player(player)
+                matcher(game, match, player)
+                msg = msg_func(match, player)
+                if msg:
+                    msgs.append(msg)
+        return msgs
+        
+# Returns a predictor for the networks at a path: either a folder of .json files, or a bundle compiled from one by
+# model_bundle.py (which only loads the networks for the cards in the supply)
+def load_predictor(path):
     predictor = DominionBackpropPredictor()
-    # Assume backprop, as thats what we know how to load
-    folder = sys.argv[1] if len(sys.argv) >1 else 'Backprop'
+    if os.path.isfile(path):
+        from model_bundle import ModelBundle
+        predictor.add_bundle(ModelBundle(path))
+    else:
+        for card, json_str in read_network_folder(path):
+            #print 'Loading {0} predictor'.format(card)
+            predictor.add_network(card, json_str)
+    return predictor
+    
+# Yields the (card, json) of each network in a folder of .json networks (named for their cards)
+def read_network_folder(folder):
     for file in os.listdir(folder):
         card, ext = os.path.splitext(file)
         card = clean_card(card)
         if not card:
             card = 'None'
         if ext == '.json':
-            #print 'Loading {0} predictor'.format(card)
             json_file = open(os.path.join(folder, file))
             json_str = json_file.read()
             json_file.close()
-            predictor.add_network(card, json_str)
+            yield card, json_str
+            
+if __name__ == '__main__':
+    # Setup the predictor
+    # Assume backprop, as thats what we know how to load
+    predictor = load_predictor(sys.argv[1] if len(sys.argv) >1 else 'Backprop')
     
     # Setup the game
-    game = DominionGame()
+    supply = []
     
     print 'Setup the initial supply'
     done = False
@@ -225,7 +569,7 @@ if __name__ == '__main__':
         if line is '' or line.lower() == 'done':
             done = True
         elif card:
-            game.add_card_to_supply(card)
+            supply.append(card)
             print '  Adding {0} to supply'.format(card)
         else:
             print '  Unrecognized card: {0}'.format(line)
@@ -244,34 +588,25 @@ if __name__ == '__main__':
                 print '  Add at least one player first'
         else:
             players.append(line)
-            game.add_player(line)
     
     # Start the game
     print
     print 'Starting Game!'
-    game.init_game()
-    
-    # Bootstrap the game
-    cur_player = 0
-    game.start_new_turn(players[0], 1) #increment_turn=True
+    session = PredictorSession(supply, players)
+    game = session.game
     
     # Game lop
     predict_regex = re.compile(r'predict(?: (?P<count>\d+))?')
     done = False
     while not done:
         print
-        print "{0}'s turn {1}, {2} actions {3} buys ${4}".format(game.get_player(game.possessor).name, game.turn_number, game.actions, game.buys, game.money)
+        print session.get_status()
         line = raw_input("> ")
         
         if line == 'quit':
             done = True
             continue
         
-        if line == 'next turn' or line == 'turn':
-            cur_player = (cur_player + 1) % len(players)
-            game.start_new_turn(players[cur_player], increment_turn=cur_player == 0)
-            continue
-        
         match = predict_regex.match(line)
         if match:
             count = int(match.group('count')) if match.group('count') else 5
@@ -280,18 +615,8 @@ if __name__ == '__main__':
             for i in range(count):
                 print '  {0} ({1})'.format(scores[i][1], scores[i][0])
         
-        for regex, matcher, msg_func in predictor_loop_regexes:
-            match = regex.match(line)
-            if match:
-                player = game.possessor
-                if 'player' in match.groupdict():
-                    if match.group('player'):
-                        player = match.group('player')
-                player = game.get_player(player)
-                matcher(game, match, player)
-                msg = msg_func(match, player)
-                if msg:
-                    print ' {0}'.format(msg)
+        for msg in session.run_command(line):
+            print ' {0}'.format(msg)
         
     
     #print 'Predictions:'
@@ -0,0 +1,131 @@
+from predictor import *
+import random
+import time
+
+# Predictor Benchmark
+# -------------------
+# Times how many times a second the backprop networks can be evaluated, node by node and as dense layers, and checks
+# that both give the same output. The networks are loaded from a folder of .json files (as written by DominionML-SQL),
+# or random networks in the same format are built over the features if no folder is given. Each evaluation loads a
+# new set of random input values, so that the network has to be evaluated again each time.
+# Then it times how long the predictor takes to pick a card from a supply, scoring each card with its own network and
+# with the networks stacked together (with random networks, the hidden layers differ in size from card to card).
+
+# The columns that DominionML-SQL doesn't train on (outputs, and values only known at the end of the game)
+trainer_excluded_labels = set(["id", "card_bought", "card_output_weight", "player_current_score", "player_score_increase", "player_final_score", "average_final_score", "player_won", "player_gained_victory_cards", "player_gained_core_victory_cards", "randomizer", "use", "game_id", "game_year", "game_month", "game_day", "game_hour", "game_minute", "game_second"])
+
+# Returns the json for a random network with a layer of hidden nodes per size in hidden_sizes
+def random_network_json(rand, labels, hidden_sizes):
+    next_id = [0]
+    def new_id():
+        next_id[0] += 1
+        return next_id[0] - 1
+    def new_weights(sources):
+        weights = dict((str(id), rand.uniform(-1.0, 1.0)) for id in sources)
+        weights[str(bias['id'])] = rand.uniform(-1.0, 1.0)
+        return weights
+    bias = {'id': new_id()}
+    inputs = [{'id': new_id(), 'label': label} for label in labels]
+    layer = [node['id'] for node in inputs]
+    hidden = []
+    for size in hidden_sizes:
+        nodes = [{'id': new_id(), 'weights': new_weights(layer)} for i in range(size)]
+        hidden += nodes
+        layer = [node['id'] for node in nodes]
+    output = [{'id': new_id(), 'weights': new_weights(layer)}]
+    return json.dumps({'bias': [bias], 'inputs': inputs, 'hidden': hidden, 'output': output})
+
+def load_networks(folder):
+    return [BackpropNetwork(card, json_str) for (card, json_str) in sorted(read_network_folder(folder))]
+
+# Evaluates each network count times (with the same inputs whichever way it's evaluated), returning the outputs and the time it took
+def evaluate(networks, input_sets, dense):
+    outputs = []
+    start = time.time()
+    for network, inputs in zip(networks, input_sets):
+        network.dense = dense and network.layers != []
+        for values in inputs:
+            for label, value in zip(network.input_labels, values):
+                network.load_input(label, value)
+            network.mark_stale()
+            outputs.append(network.get_output())
+    return outputs, time.time() - start
+
+# Returns a game with a supply and players, in the middle of its first turn
+def sample_game(rand, kingdom, kingdom_size=10):
+    game = DominionGame()
+    for card in rand.sample(kingdom, min(kingdom_size, len(kingdom))):
+        game.add_card_to_supply(card)
+    for player in ['alice', 'bob']:
+        game.add_player(player)
+    game.init_game()
+    game.start_new_turn('alice', 1)
+    game.add_money(5)
+    return game
+
+# Times how long it takes to pick a card, returning the scores and the milliseconds per pick
+def time_picks(predictor, game, count):
+    start = time.time()
+    for i in range(count):
+        scores = predictor.pick_card(game)
+    return scores, (time.time() - start) * 1000.0 / count
+
+if __name__ == '__main__':
+    if '-h' in sys.argv:
+        print 'Usage: predictor_benchmark.py [<network folder>] [-n <evaluations per network>] [-hidden <size>[,<size>...]]'
+        exit(0)
+
+    count = int(get_arg('-n')) if '-n' in sys.argv else 1000
+    rand = random.Random(0)
+    folder = len(sys.argv) > 1 and not sys.argv[1].startswith('-')
+    if folder:
+        networks = load_networks(sys.argv[1])
+    else:
+        hidden_sizes = [int(size) for size in get_arg('-hidden').split(',')] if '-hidden' in sys.argv else [32]
+        labels = [feature.sql_name for feature in Feature.features if feature.sql_name not in trainer_excluded_labels]
+        networks = [BackpropNetwork(card, random_network_json(rand, labels, hidden_sizes)) for card in ['None', 'Silver', 'Gold', 'Province']]
+    if not networks:
+        print 'No networks to evaluate'
+        exit(1)
+    if numpy is None:
+        print 'numpy isn\'t available, so the networks can only be evaluated node by node'
+    elif not all(network.dense for network in networks):
+        print 'Some of the networks can\'t be evaluated as dense layers, so they are evaluated node by node either way'
+
+    input_sets = [[[rand.random() for label in network.input_labels] for i in range(count)] for network in networks]
+    evaluations = len(networks) * count
+    node_outputs, node_time = evaluate(networks, input_sets, False)
+    print 'Node by node: {0} evaluations in {1:.3f} seconds ({2:.0f} evaluations/sec)'.format(evaluations, node_time, evaluations / node_time)
+    if numpy is not None:
+        dense_outputs, dense_time = evaluate(networks, input_sets, True)
+        print 'Dense layers: {0} evaluations in {1:.3f} seconds ({2:.0f} evaluations/sec, {3:.1f}x)'.format(evaluations, dense_time, evaluations / dense_time, node_time / dense_time)
+        print 'Largest difference between the outputs: {0:.3g}'.format(max(abs(a - b) for (a, b) in zip(node_outputs, dense_outputs)))
+
+    # Pick from a random kingdom (random networks are built for every card in the supply)
+    predictor = DominionBackpropPredictor()
+    kingdom = [card for card in sorted(supply_cards) if card_flags[card_ids[card]] & action_flag]
+    if folder:
+        predictor.networks = dict((network.card, network) for network in networks)
+        kingdom = [card for card in kingdom if card in predictor.networks]
+    game = sample_game(rand, kingdom)
+    if folder:
+        missing = [card for card in game.get_cards_in_supply() if card not in predictor.networks]
+        if missing:
+            print 'Not picking from a supply, as there are no networks for: {0}'.format(', '.join(missing))
+            exit(0)
+    else:
+        for card in game.get_cards_in_supply():
+            predictor.add_network(card, random_network_json(rand, labels, [size + rand.randint(-size / 4, 0) for size in hidden_sizes]))
+    picks = max(1, count / 10)
+    predictor.stacked = False
+    unstacked_scores, unstacked_time = time_picks(predictor, game, picks)
+    predictor.stacked = True
+    stacked_scores, stacked_time = time_picks(predictor, game, picks)
+    print 'Picking from {0} cards: {1:.3f} ms per pick one network at a time, {2:.3f} ms per pick stacked ({3:.1f}x)'.format(len(game.supply_ids), unstacked_time, stacked_time, unstacked_time / stacked_time)
+    print 'Same order: {0}, largest difference between the scores: {1:.3g}'.format([card for (score, card) in unstacked_scores] == [card for (score, card) in stacked_scores], max(abs(a[0] - b[0]) for (a, b) in zip(unstacked_scores, stacked_scores)))
+    # How much of a pick is evaluating the networks (the rest is extracting their inputs)
+    start = time.time()
+    for i in range(picks):
+        for stack, cards, layers, inputs in predictor.supply_stacks:
+            NetworkStack.evaluate(layers, numpy.zeros((len(cards), len(stack.input_labels))))
+    print 'Evaluating the stacked networks takes {0:.3f} ms of each pick'.format((time.time() - start) * 1000.0 / picks)